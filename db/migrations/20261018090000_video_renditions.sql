@@ -0,0 +1,13 @@
+-- migrate:up
+CREATE TABLE IF NOT EXISTS "video_renditions" (
+    "video_id" INTEGER NOT NULL,
+    "quality" INTEGER NOT NULL,
+    "num_segments" INTEGER NOT NULL,
+    "ready_at" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY("video_id", "quality"),
+    FOREIGN KEY ("video_id") REFERENCES "videos"("id")
+    ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+-- migrate:down
+DROP TABLE IF EXISTS `video_renditions`;
@@ -0,0 +1,26 @@
+-- migrate:up
+CREATE TABLE IF NOT EXISTS "jobs" (
+    "id" INTEGER NOT NULL UNIQUE,
+    "kind" VARCHAR NOT NULL,
+    "video_id" INTEGER NOT NULL,
+    "quality" INTEGER,
+    "state" VARCHAR NOT NULL DEFAULT 'queued',
+    "priority" INTEGER NOT NULL DEFAULT 0,
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+    "max_attempts" INTEGER NOT NULL DEFAULT 5,
+    "run_after" REAL NOT NULL DEFAULT 0,
+    "worker" VARCHAR,
+    "lease_until" REAL,
+    "error" VARCHAR,
+    "created_at" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updated_at" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY("id"),
+    FOREIGN KEY ("video_id") REFERENCES "videos"("id")
+    ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS "jobs_claim" ON "jobs" ("state", "priority", "run_after");
+
+-- migrate:down
+DROP INDEX IF EXISTS `jobs_claim`;
+DROP TABLE IF EXISTS `jobs`;
@@ -0,0 +1,5 @@
+-- migrate:up
+ALTER TABLE "jobs" ADD COLUMN "progress" REAL;
+
+-- migrate:down
+ALTER TABLE `jobs` DROP COLUMN `progress`;
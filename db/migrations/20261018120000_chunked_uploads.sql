@@ -0,0 +1,26 @@
+-- migrate:up
+CREATE TABLE IF NOT EXISTS "uploads" (
+    "id" VARCHAR NOT NULL UNIQUE,
+    "author" VARCHAR NOT NULL,
+    "title" VARCHAR NOT NULL,
+    "extension" VARCHAR NOT NULL,
+    "file_size" INTEGER NOT NULL,
+    "chunk_size" INTEGER NOT NULL,
+    "created_at" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY("id"),
+    FOREIGN KEY ("author") REFERENCES "users"("username")
+    ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS "upload_chunks" (
+    "upload_id" VARCHAR NOT NULL,
+    "chunk" INTEGER NOT NULL,
+    "sha256" VARCHAR NOT NULL,
+    PRIMARY KEY("upload_id", "chunk"),
+    FOREIGN KEY ("upload_id") REFERENCES "uploads"("id")
+    ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+-- migrate:down
+DROP TABLE IF EXISTS `upload_chunks`;
+DROP TABLE IF EXISTS `uploads`;
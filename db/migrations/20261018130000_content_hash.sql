@@ -0,0 +1,7 @@
+-- migrate:up
+ALTER TABLE "videos" ADD COLUMN "content_hash" VARCHAR;
+CREATE INDEX IF NOT EXISTS "videos_content_hash" ON "videos" ("content_hash");
+
+-- migrate:down
+DROP INDEX IF EXISTS `videos_content_hash`;
+ALTER TABLE `videos` DROP COLUMN `content_hash`;
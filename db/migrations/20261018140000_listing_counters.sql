@@ -0,0 +1,50 @@
+-- migrate:up
+-- counts for the listings, kept up to date by triggers (instead of a COUNT(*) on every page)
+CREATE TABLE IF NOT EXISTS "counters" (
+    "name" VARCHAR NOT NULL UNIQUE,
+    "value" INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY("name")
+);
+INSERT OR REPLACE INTO "counters" ("name", "value") VALUES ('users', (SELECT COUNT(*) FROM "users"));
+
+-- the number of visible (length > 0) videos each user has
+ALTER TABLE "users" ADD COLUMN "video_count" INTEGER NOT NULL DEFAULT 0;
+UPDATE "users" SET "video_count" = (
+    SELECT COUNT(*) FROM "videos" WHERE "videos"."author" = "users"."username" AND "videos"."length" > 0
+);
+
+CREATE TRIGGER IF NOT EXISTS "users_count_insert" AFTER INSERT ON "users"
+BEGIN
+    UPDATE "counters" SET "value" = "value" + 1 WHERE "name" = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS "users_count_delete" AFTER DELETE ON "users"
+BEGIN
+    UPDATE "counters" SET "value" = "value" - 1 WHERE "name" = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS "videos_count_insert" AFTER INSERT ON "videos" WHEN NEW."length" > 0
+BEGIN
+    UPDATE "users" SET "video_count" = "video_count" + 1 WHERE "username" = NEW."author";
+END;
+
+CREATE TRIGGER IF NOT EXISTS "videos_count_delete" AFTER DELETE ON "videos" WHEN OLD."length" > 0
+BEGIN
+    UPDATE "users" SET "video_count" = "video_count" - 1 WHERE "username" = OLD."author";
+END;
+
+CREATE TRIGGER IF NOT EXISTS "videos_count_update" AFTER UPDATE OF "length", "author" ON "videos"
+WHEN (OLD."length" > 0) != (NEW."length" > 0) OR OLD."author" != NEW."author"
+BEGIN
+    UPDATE "users" SET "video_count" = "video_count" - 1 WHERE "username" = OLD."author" AND OLD."length" > 0;
+    UPDATE "users" SET "video_count" = "video_count" + 1 WHERE "username" = NEW."author" AND NEW."length" > 0;
+END;
+
+-- migrate:down
+DROP TRIGGER IF EXISTS `videos_count_update`;
+DROP TRIGGER IF EXISTS `videos_count_delete`;
+DROP TRIGGER IF EXISTS `videos_count_insert`;
+DROP TRIGGER IF EXISTS `users_count_delete`;
+DROP TRIGGER IF EXISTS `users_count_insert`;
+ALTER TABLE `users` DROP COLUMN `video_count`;
+DROP TABLE IF EXISTS `counters`;
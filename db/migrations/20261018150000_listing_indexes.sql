@@ -0,0 +1,12 @@
+-- migrate:up
+-- VIDEO_PAGE lists an author's visible videos in id order (WHERE author = ? AND length > 0 [AND id > ?] ORDER BY id).
+-- Partial, so videos still processing (length <= 0) aren't in it, and covering (SQLite wants the length in there too,
+-- even though the index only has long enough videos), so the listing never touches the table.
+CREATE INDEX IF NOT EXISTS "videos_listing" ON "videos" ("author", "id", "title", "length") WHERE "length" > 0;
+
+-- every video of an author, whatever its length (for the users -> videos foreign key cascades)
+CREATE INDEX IF NOT EXISTS "videos_author" ON "videos" ("author");
+
+-- migrate:down
+DROP INDEX IF EXISTS `videos_author`;
+DROP INDEX IF EXISTS `videos_listing`;
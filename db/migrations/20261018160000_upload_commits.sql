@@ -0,0 +1,5 @@
+-- migrate:up
+ALTER TABLE "uploads" ADD COLUMN "committing" INTEGER NOT NULL DEFAULT 0;
+
+-- migrate:down
+ALTER TABLE `uploads` DROP COLUMN `committing`;
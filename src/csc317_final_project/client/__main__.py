@@ -1,13 +1,17 @@
 import socket
-import json
 import threading
 import time
 from tempfile import TemporaryDirectory
 from typing import Optional, Dict, Union
 from pathlib import Path
 from wonderful_gui import GUI
+from page_cache import PageCache
+from abr import AbrController
+from prefetch import ConnectionPool, SegmentPrefetcher
 from PySide6 import QtWidgets
-from queue import Queue
+from csc317_final_project.protocol import MessageStream, negotiate
+
+control_lock = threading.RLock() #the control connection's shared with page revalidation (see request_page), one request at a time
 
 def run_client(gui: GUI) -> None:
     """
@@ -23,32 +27,36 @@ def run_client(gui: GUI) -> None:
         except Exception:
             quit()
 
+        connection = MessageStream(client_socket) #just for control requests, segments get their own connections
+        negotiate(connection) #switches to length-prefixed messages if the server supports them
+        segment_pool = ConnectionPool((server_ip, server_port))
+
         while True:
-            login(client_socket, gui)
-            navigate(client_socket, gui)
+            login(connection, gui)
+            navigate(connection, gui, segment_pool)
 
 
-def login(client_socket: socket.socket, gui: GUI) -> None:
+def login(connection: MessageStream, gui: GUI) -> None:
     """
     Checks and handles login flags from gui
     """
     while True: # login loop
             if gui.login_flag.is_set():
                 gui.login_flag = False
-                login_finished = handle_login_attempt(client_socket, gui, "LOGIN")
+                login_finished = handle_login_attempt(connection, gui, "LOGIN")
 
                 if login_finished:
                     break
 
             if gui.registration_flag.is_set():
                 gui.registration_flag = False
-                register_finished = handle_login_attempt(client_socket, gui, "REGISTER")
+                register_finished = handle_login_attempt(connection, gui, "REGISTER")
 
                 if register_finished:
                     break
 
 
-def navigate(client_socket: socket.socket, gui: GUI) -> None:
+def navigate(connection: MessageStream, gui: GUI, segment_pool: ConnectionPool) -> None:
     """
     Check and handles navigation flags from gui
     Also allows start of downloading and viewing videos
@@ -56,10 +64,8 @@ def navigate(client_socket: socket.socket, gui: GUI) -> None:
     in_videos_page = False
     author = ""
     previous_pages = [] #holds page number of previous pages
-    current_segment = Queue()
-    stop_signal = threading.Event()
-    thread_running = threading.Event()
-    thread_lock = threading.Lock()
+    page_cache = PageCache() #pages we've seen, so going back to them is instant
+    abr = AbrController([]) #picks each segment's quality, keeps its throughput measurements between videos
 
     while True:
         if gui.page_flag.is_set():
@@ -73,9 +79,8 @@ def navigate(client_socket: socket.socket, gui: GUI) -> None:
             else:
                 page_request["type"] = "USERS"
 
-            page = request_server(client_socket, page_request)
+            request_page(connection, gui, page_cache, page_request)
             #check errors
-            send_to_gui(page, gui)
 
         if gui.user_flag.is_set():
             gui.user_flag = False
@@ -86,9 +91,8 @@ def navigate(client_socket: socket.socket, gui: GUI) -> None:
             author_request["type"] = "VIDEO_PAGE"
             author_request["author"] = author
             author_request["page_num"] = 0
-            author_page = request_server(client_socket, author_request)
+            request_page(connection, gui, page_cache, author_request)
             #check errors
-            send_to_gui(author_page, gui)
         
         if gui.home_flag.is_set():
             gui.home_flag = False
@@ -96,9 +100,8 @@ def navigate(client_socket: socket.socket, gui: GUI) -> None:
             home_request = {}
             home_request["type"] = "USERS"
             home_request["page_num"] = 0
-            home_page = request_server(client_socket, home_request)
+            request_page(connection, gui, page_cache, home_request)
             #check errors
-            send_to_gui(home_page, gui)
         
         if gui.back_flag.is_set():
             gui.back_flag = False
@@ -115,9 +118,8 @@ def navigate(client_socket: socket.socket, gui: GUI) -> None:
                 in_videos_page = True
 
             last_page_request["page_num"] = last_page_num
-            last_page = request_server(client_socket, last_page_request)
+            request_page(connection, gui, page_cache, last_page_request)
             #check errors
-            send_to_gui(last_page, gui)
 
         if gui.video_flag.is_set():
             gui.video_flag = False
@@ -129,42 +131,31 @@ def navigate(client_socket: socket.socket, gui: GUI) -> None:
             video_info_request["type"] ="VIDEO_INFO"
             video_info_request["video_id"] = video_id
 
-            video_info = request_server(client_socket, video_info_request)
-            send_to_gui(video_info, gui)
+            video_info = request_page(connection, gui, page_cache, video_info_request, wait=True) #always the current info, even if a cached one was shown first
 
-            starting_quality = video_info["max_quality"]
             num_segment = video_info["num_segments"]
+            abr.set_qualities(video_info.get("available_qualities", list(range(video_info["max_quality"] + 1))))
 
             with TemporaryDirectory() as segment_dir:
-                download_video_thread = threading.Thread(target=request_video,
-                                                         args=(client_socket,
-                                                               segment_dir,
-                                                               video_id,
-                                                               0,
-                                                               starting_quality,
-                                                               num_segment,
-                                                               current_segment,
-                                                               stop_signal,
-                                                               thread_running,
-                                                               thread_lock))
-
-                back_to_navigation = wait_for_thread_end(gui, thread_running)
-
-                if not back_to_navigation:
-                    thread_running.set()
-                    download_video_thread.start()
-                    run_video(client_socket, gui, segment_dir, video_id, num_segment, current_segment, stop_signal, thread_running, thread_lock)
+                prefetcher = SegmentPrefetcher(segment_pool, segment_dir, video_id, num_segment, abr)
+                prefetcher.start()
+
+                try:
+                    run_video(gui, prefetcher)
+                finally:
+                    prefetcher.stop() #(waits for the fetchers, so nothing's writing into segment_dir when it's deleted)
+                    segment_pool.close() #no video playing, no need to keep the connections open
 
         if gui.upload_flag.is_set():
             gui.upload_flag = False
-            upload_video(client_socket, gui.upload_file_path)
+            upload_video(connection, gui.upload_file_path)
 
         #if gui.logout_flag.is_set():
             #gui.logout_flag = False
             #break #return to login
         
     
-def run_video(client_socket: socket.socket, gui: GUI, segment_dir: TemporaryDirectory, video_id: int, num_segment: int, current_segment: Queue, stop_signal: threading.Event, thread_running: threading.Event, thread_lock: threading.Lock) -> None:
+def run_video(gui: GUI, prefetcher: SegmentPrefetcher) -> None:
     """
     Gives video segments to gui and responds to video flags in gui
     """
@@ -172,111 +163,24 @@ def run_video(client_socket: socket.socket, gui: GUI, segment_dir: TemporaryDire
         if gui.segment_request_flag.is_set():
             gui.segment_request_flag = False
             next_segment = gui.segment_num
-            quality = gui.segment_quality
-            get_segment(client_socket, gui, segment_dir, video_id, quality, next_segment, num_segment, current_segment, stop_signal, thread_running, thread_lock)
+            get_segment(gui, prefetcher, next_segment)
         
         if check_back_to_navigation(gui):
-            if thread_running.is_set():
-                with thread_lock:
-                    stop_signal.set() #stop download_video_thread
+            break #returns to navigation to handle flag (the prefetcher's stopped there)
 
-            break #returns to navigation to handle flag
+        time.sleep(0.01)
 
 
-def get_segment(client_socket: socket.socket, gui: GUI, segment_dir: TemporaryDirectory, video_id: int, quality: int, segment_id: int, num_segment: int, current_segment: Queue, stop_signal: threading.Event, thread_running: threading.Event, thread_lock: threading.Lock) -> None:
-    """
-    gets video segment and gives it to gui
+def get_segment(gui: GUI, prefetcher: SegmentPrefetcher, segment_id: int) -> None:
     """
-    video = f"{video_id}_{quality}_{segment_id}.mp4"
-    video_path = Path(segment_dir).joinpath(video)
-
-    while True:
-        if video_path.exists():
-            with thread_lock:
-                downloading_segment = ""
-
-                if current_segment.qsize() > 0:
-                    downloading_segment = current_segment.get()
-                    current_segment.put(downloading_segment)
-
-            if downloading_segment == video:
-                continue
-
-            gui.next_segment = video_path
-            gui.segment_ready_flag = True
-            break #go back to checking flags in run_video
-
-        else:
-            if thread_running.is_set():
-                downloading_segment = ""
-                with thread_lock:
-                    if current_segment.qsize() > 0:
-                        downloading_segment = current_segment.get()
-                        current_segment.put(downloading_segment)
-                    else:
-                        continue #wait to see what is being downloaded
-
-                if downloading_segment == video: #checks if video is being downloaded currently
-                    continue
-
-                with thread_lock:
-                    stop_signal.set() #stops current download thread if it is downloading different segment than requested segment
-    
-            download_video_thread = threading.Thread(target=request_video,
-                                                     args=(client_socket,
-                                                           segment_dir,
-                                                           video_id,
-                                                           segment_id,
-                                                           quality,
-                                                           num_segment,
-                                                           current_segment,
-                                                           stop_signal,
-                                                           thread_running,
-                                                           thread_lock),
-                                                           daemon = True)
-            
-            back_to_navigation = wait_for_thread_end(gui, thread_running)
-
-            if back_to_navigation: #check whether to continue download attempt
-                break
-
-            thread_running.set()
-            download_video_thread.start()
-
-
-def request_video(client_socket: socket.socket, segment_dir: TemporaryDirectory, video_id: int, starting_segment: int, quality: int, num_segment: int, current_segment: Queue, stop_signal: threading.Event, thread_running: threading.Event, thread_lock: threading.Lock) -> None:
+    gets video segment (in whichever quality the abr picked for it) and gives it to gui
     """
-    Requests video segments
-    """
-    next_segment = starting_segment
-    last_segment = num_segment - 1
-    next_segment_request = {}
-    next_segment_request["type"] = "VIDEO"
-    next_segment_request["video_id"] = video_id
-
-    while next_segment <= last_segment and not stop_signal.is_set():
-        segment_name = f"{video_id}_{quality}_{next_segment}.mp4"
-        extended_segment_name = Path(segment_dir).joinpath(segment_name)
-
-        if Path(extended_segment_name).exists():
-            next_segment += 1
-            continue #go to next segment for downloading if the current segment has already been downloaded
-
-        with thread_lock:
-            current_segment.put(segment_name) #stores current segment being downloaded for checking in network_thread
-
-        next_segment_request["segment_id"] = next_segment
-        next_segment_request["quality"] = quality
-        video_metadata = request_server(client_socket, next_segment_request)
-        receive_reply(client_socket, video_metadata, segment_dir)
-        next_segment += 1
-
-        with thread_lock:
-            current_segment.get() #remove stored segement_name
+    prefetcher.set_playhead(segment_id) #moves the look ahead window, this segment's fetched first
+    video_path = prefetcher.wait_for(segment_id, lambda: check_back_to_navigation(gui))
 
-    with thread_lock:
-        stop_signal.clear() #allows reuse of stop_signal
-        thread_running.clear()
+    if video_path is not None:
+        gui.next_segment = video_path
+        gui.segment_ready_flag = True
 
 
 def check_back_to_navigation(gui: GUI) -> bool:
@@ -287,19 +191,6 @@ def check_back_to_navigation(gui: GUI) -> bool:
     return go_to_navigation
 
 
-def wait_for_thread_end(gui: GUI, thread_running: threading.Event) -> bool:
-    """
-    Waits for download thread to finish stopping
-    """
-    while thread_running.is_set():
-        time.sleep(0.1)
-
-        if check_back_to_navigation(gui):
-            return True
-        
-    return False
-
-
 def send_to_gui(server_response: Dict, gui: GUI) -> None:
     """
     Informs gui of server response
@@ -308,7 +199,7 @@ def send_to_gui(server_response: Dict, gui: GUI) -> None:
     gui.response_flag = True
 
 
-def handle_login_attempt(client_socket: socket.socket, gui: GUI, type: str) -> bool:
+def handle_login_attempt(connection: MessageStream, gui: GUI, type: str) -> bool:
     """
     gives login info to server and signals gui with server response
     """
@@ -316,7 +207,7 @@ def handle_login_attempt(client_socket: socket.socket, gui: GUI, type: str) -> b
 
     if login_data: #continues if valid attempt
         login_data["type"] = type
-        server_response = request_server(client_socket, login_data)
+        server_response = request_server(connection, login_data)
 
         if server_response["type"] == "ERROR":
             gui.login_failure = True
@@ -361,7 +252,7 @@ def get_upload_file(request_dict: Dict[str, Union[str, int]]) -> Optional[bytes]
 
 
 def upload_video(
-    client_socket: socket.socket, path: str
+    connection: MessageStream, path: str
 ) -> None:
     """
     Uploads video to server
@@ -372,47 +263,21 @@ def upload_video(
     request_dict["title"] = "You have no choice. Deal with it."
     byte_file = get_upload_file(request_dict)
 
-    request_server(client_socket, request_dict)
-    client_socket.sendall(byte_file)
+    with control_lock:
+        request_server(connection, request_dict)
+        connection.conn.sendall(byte_file)
 
-    data = client_socket.recv(1024) #three blind mice, see how they run
+        connection.recv_obj() #three blind mice, see how they run
 
 
-def receive_reply(client_socket: socket.socket, metadata: Dict, segment_dir: TemporaryDirectory) -> None:
-    """
-    Recieves reply from server. If the command type is DOWNLOAD, sends the
-    request dictionary and recieves the file. Otherwise, recieve and print
-    message from server.
-    """
-    file_name = metadata.get("target")
-    extended_file_name = Path(segment_dir).joinpath(file_name)
-    file_size = metadata.get("file_size")
-    print(f"Downloading {extended_file_name} of size {file_size} bytes")
-    client_socket.sendall(b'{"type": "ACK"}')  # acknowledge the metadata
-    # let's do it
-    bytes_received = 0
-
-    with open(extended_file_name, "wb") as file:
-        while bytes_received < file_size:
-            data = client_socket.recv(1024)
-
-            if not data:
-                break
-
-            file.write(data)
-            bytes_received += len(data)
-
-    print(f"Downloaded {extended_file_name} of size {bytes_received} bytes")
-
-
-def delete_video(client_socket: socket.socket, video_id: int) -> None:
+def delete_video(connection: MessageStream, video_id: int) -> None:
     """
     Deletes the video from the server and prints the response from the server. 
     """
     request_dict = {}
     request_dict['type'] = 'DELETE'
     request_dict['video_id'] = video_id
-    response = request_server(client_socket, request_dict)
+    response = request_server(connection, request_dict)
 
     if response['success']:
         print('The video has been successfully deleted')
@@ -420,14 +285,65 @@ def delete_video(client_socket: socket.socket, video_id: int) -> None:
         print('Video Deletion is unsuccessful. Please make sure the video_id is correct and try again.')
                 
 
-def request_server(client_socket: socket.socket, request_dict: Dict) -> Dict:
+def request_page(connection: MessageStream, gui: GUI, page_cache: PageCache, request_dict: Dict, wait: bool = False) -> Dict:
+    """
+    Sends a page to the gui. If we've seen it before it's shown straight away,
+    then checked with the server (with if_version) on another thread, while the user's already looking at it
+    (or before returning, if wait is set)
+    Returns the page as it is now (or as we last saw it, if it's being checked in the background)
+    """
+    cached_page = page_cache.get(request_dict)
+    page_cache.showing(request_dict)
+
+    if cached_page is None:
+        return revalidate_page(connection, gui, page_cache, request_dict, None)
+
+    send_to_gui(cached_page, gui)
+
+    if wait:
+        return revalidate_page(connection, gui, page_cache, request_dict, cached_page)
+
+    threading.Thread(target=revalidate_page, args=(connection, gui, page_cache, request_dict, cached_page), daemon=True).start()
+    return cached_page
+
+
+def revalidate_page(connection: MessageStream, gui: GUI, page_cache: PageCache, request_dict: Dict, cached_page: Optional[Dict]) -> Dict:
+    """
+    Gets a page from the server (only if it changed, if we have it already) and redraws it if it did change,
+    unless the user's moved on to another page in the meantime
+    Returns the current page
+    """
+    if cached_page is not None:
+        request_dict = dict(request_dict, if_version=cached_page["version"])
+
+    try:
+        page = request_server(connection, request_dict)
+    except Exception as e:
+        if cached_page is None:
+            raise
+
+        print(f"Couldn't check if the page changed: {e}") #(not worth more than that, they've got the cached one)
+        return cached_page
+
+    if page.get("type") == "NOT_MODIFIED":
+        return cached_page #what they're looking at is still right
+
+    page_cache.store(request_dict, page)
+
+    if page_cache.is_showing(request_dict):
+        send_to_gui(page, gui)
+
+    return page
+
+
+def request_server(connection: MessageStream, request_dict: Dict) -> Dict:
     """
     Sends request dictionary to server and recieves server response
     """
-    request_json = json.dumps(request_dict)
-    client_socket.sendall(request_json.encode("utf-8"))
-    response_json = client_socket.recv(1024).decode("utf-8") #error message not dictionary; need to fix
-    response = json.loads(response_json)
+    with control_lock:
+        connection.send_obj(request_dict)
+        response = connection.recv_obj()
+
     return response
     
 
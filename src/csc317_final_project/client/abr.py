@@ -0,0 +1,167 @@
+import threading
+import time
+from typing import List, Optional
+
+from csc317_final_project.server.quality import VideoQuality
+
+SEGMENT_DURATION = 3  # seconds per segment, same as the gui
+SAFETY = 0.8  # only use this much of the measured throughput, it's never as steady as it looks
+START_BANDWIDTH = 1_500_000  # bits/s to assume before the first segment's measured
+FAST_HALF_LIFE = 2  # seconds of downloading, the fast average reacts to drops quickly
+SLOW_HALF_LIFE = 8  # ...and the slow one ignores short spikes
+# less than this (the segment the gui's waiting on isn't downloaded yet) and we're stalling,
+# go straight to the lowest quality
+PANIC_BUFFER = SEGMENT_DURATION
+UP_BUFFER = 3 * SEGMENT_DURATION  # only switch up with at least this much buffered...
+UP_MARGIN = 1.2  # ...and the throughput covers the next quality with room to spare...
+MIN_HOLD = 3  # ...and the current quality's been kept for at least this many segments
+# every video has this one, so it's what we ask for if we weren't told what a video has
+FALLBACK_QUALITY = int(VideoQuality.ONE_FORTY_FOUR_P)
+
+
+def get_bitrate(quality: int) -> int:
+    """
+    Returns the bits/s a quality is encoded at (video and audio)
+    """
+    config = VideoQuality(quality).get_resolution_config()
+    return (int(config[4].rstrip("k")) + int(config[5].rstrip("k"))) * 1000
+
+
+class Ewma:
+    """
+    Exponentially weighted moving average, weighted by how long each sample took
+    (so a segment that took 5 seconds counts for more than one that took 0.1)
+    """
+
+    def __init__(self, half_life: float):
+        self.alpha = 0.5 ** (1 / half_life)
+        self.estimate = 0.0
+        self.total_weight = 0.0
+
+    def add(self, weight: float, value: float) -> None:
+        adjusted_alpha = self.alpha**weight
+        self.estimate = value * (1 - adjusted_alpha) + adjusted_alpha * self.estimate
+        self.total_weight += weight
+
+    def get(self) -> float:
+        zero_factor = 1 - self.alpha**self.total_weight  # corrects for starting at 0
+        return self.estimate / zero_factor
+
+
+class AbrController:
+    """
+    Picks the quality of each segment to download, from how fast segments have been downloading
+    and how much video is buffered ahead of the playhead.
+
+    Drops quality as soon as the throughput (or the buffer) can't keep up, but only goes back up one step at a time,
+    once the buffer's healthy and the current quality's been kept for a few segments. (Otherwise it'd flip back and forth)
+    """
+
+    def __init__(self, available_qualities: List[int]):
+        self.lock = threading.Lock()
+        self.fast = Ewma(FAST_HALF_LIFE)
+        self.slow = Ewma(SLOW_HALF_LIFE)
+        self.samples = 0
+        self.active = 0  # downloads going right now (see start_download)
+        self.busy_since = 0.0
+        self.set_qualities(available_qualities)
+
+    def set_qualities(self, available_qualities: List[int]) -> None:
+        """
+        Switches to a new video's quality ladder (keeps what's been measured so far)
+        """
+        with self.lock:
+            self.qualities = sorted(available_qualities)
+            self.quality: Optional[int] = None
+            self.segments_at_quality = 0
+
+    def start_download(self) -> None:
+        """
+        Call as a segment starts downloading, if several might download at once
+        (they share the connection's bandwidth, so each one's own speed says little, see record_download)
+        """
+        with self.lock:
+            if self.active == 0:
+                self.busy_since = time.monotonic()
+
+            self.active += 1
+
+    def cancel_download(self) -> None:
+        with self.lock:
+            self.active = max(0, self.active - 1)
+
+    def record_download(self, size: int, seconds: float) -> None:
+        """
+        Call after each segment is downloaded, with its size in bytes and how long it took
+        If it was started with start_download, it's instead measured against the time since the last download finished
+        (or since downloading started), which adds up to the whole connection's throughput when they overlap
+        """
+        with self.lock:
+            if self.active > 0:
+                now = time.monotonic()
+                seconds = now - self.busy_since
+                self.busy_since = now
+                self.active -= 1
+
+            seconds = max(seconds, 0.001)
+            self.fast.add(seconds, size * 8 / seconds)
+            self.slow.add(seconds, size * 8 / seconds)
+            self.samples += 1
+
+    def get_throughput(self) -> float:
+        """
+        Returns the estimated bits/s (the lower of the two averages, to be safe)
+        """
+        with self.lock:
+            if self.samples == 0:
+                return START_BANDWIDTH
+            return min(self.fast.get(), self.slow.get())
+
+    def choose(self, buffer_seconds: float) -> int:
+        """
+        Returns the quality to download the next segment in, given how many seconds of video are ready to play
+        """
+        throughput = self.get_throughput() * SAFETY
+
+        with self.lock:
+            if not self.qualities:
+                return FALLBACK_QUALITY
+
+            fitting = [
+                quality
+                for quality in self.qualities
+                if get_bitrate(quality) <= throughput
+            ]
+            target = fitting[-1] if fitting else self.qualities[0]
+
+            if self.quality is None:  # first segment, nothing to be smooth about
+                self.quality = target
+                self.segments_at_quality = 1
+                return target
+
+            current = self.quality
+
+            if buffer_seconds < PANIC_BUFFER and self.samples > 0:
+                target = self.qualities[0]
+            elif target > current:
+                next_up = self.qualities[self.qualities.index(current) + 1]
+                can_switch_up = (
+                    buffer_seconds >= UP_BUFFER
+                    and self.segments_at_quality >= MIN_HOLD
+                    and throughput >= get_bitrate(next_up) * UP_MARGIN
+                )
+                target = next_up if can_switch_up else current
+            elif (
+                target < current
+                and buffer_seconds >= UP_BUFFER
+                and throughput / SAFETY >= get_bitrate(current)
+            ):
+                target = current  # still keeping up (just without the margin), ride it out on the buffer
+
+            if target == current:
+                self.segments_at_quality += 1
+            else:
+                self.quality = target
+                self.segments_at_quality = 1
+
+            return target
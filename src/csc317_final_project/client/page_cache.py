@@ -0,0 +1,68 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+MAX_PAGES = 64  # pages kept, the least recently used one goes first
+
+
+class PageCache:
+    """
+    Keeps the pages (USERS, VIDEO_PAGE and VIDEO_INFO responses) we've already seen,
+    so going back (or home) to one can show it straight away.
+    Each page keeps the version the server gave it, to check it's still current with if_version.
+    """
+
+    def __init__(self, max_pages: int = MAX_PAGES):
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.shown = None  # the page the gui's on (see showing)
+        self.lock = threading.Lock()
+
+    def key(self, request: Dict) -> str:
+        """
+        Same request (apart from if_version) means same page
+        """
+        return json.dumps(
+            {name: value for name, value in request.items() if name != "if_version"},
+            sort_keys=True,
+        )
+
+    def get(self, request: Dict) -> Optional[Dict]:
+        """
+        Returns the page we have for this request, or None
+        """
+        key = self.key(request)
+
+        with self.lock:
+            page = self.pages.get(key)
+
+            if page is not None:
+                self.pages.move_to_end(key)
+
+            return page
+
+    def store(self, request: Dict, response: Dict) -> None:
+        """
+        Keeps a server response for this request. Errors (and older servers) don't come with a version, so they're not kept
+        """
+        if "version" not in response:
+            return
+
+        key = self.key(request)
+
+        with self.lock:
+            self.pages[key] = response
+            self.pages.move_to_end(key)
+
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+    def showing(self, request: Dict) -> None:
+        """
+        Remembers which page the gui's on, so a page that turns out to have changed is only redrawn if it's still there
+        """
+        self.shown = self.key(request)
+
+    def is_showing(self, request: Dict) -> bool:
+        return self.shown == self.key(request)
@@ -0,0 +1,374 @@
+import math
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from abr import SEGMENT_DURATION, AbrController
+
+from csc317_final_project.protocol import MessageStream, negotiate
+
+SEGMENT_FETCHERS = 3  # segments downloading at once, each on its own connection
+# how far past the playhead to download (if LOOK_AHEAD_SECONDS isn't set)...
+LOOK_AHEAD_SEGMENTS = 5
+LOOK_AHEAD_SECONDS = None  # ...or how many seconds past the playhead to download
+# seconds before trying a segment that failed again (doubled after every failure)
+RETRY_DELAY = 1
+# tries per segment before giving up on it (say the server doesn't have it)
+MAX_ATTEMPTS = 5
+CONNECT_TIMEOUT = 5  # seconds to wait for the server when opening a connection
+
+
+class ConnectionPool:
+    """
+    Connections to the server just for segments, so navigating (on the main connection) never waits behind
+    a segment download. Connections are opened when they're first needed, and a broken one is replaced
+    """
+
+    def __init__(self, address: Tuple[str, int], size: int = SEGMENT_FETCHERS):
+        self.address = address
+        self.size = size
+        self.idle = []
+        self.opened = 0
+        self.available = threading.Condition()
+
+    def connect(self) -> MessageStream:
+        conn = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        # (only the connecting is timed, downloads take as long as they take)
+        conn.settimeout(None)
+        connection = MessageStream(conn)
+        negotiate(connection)
+        return connection
+
+    def acquire(self) -> MessageStream:
+        """
+        Returns an idle connection, opening one if there's room, or waiting for one otherwise
+        """
+        with self.available:
+            while not self.idle and self.opened >= self.size:
+                self.available.wait()
+
+            if self.idle:
+                return self.idle.pop()
+
+            self.opened += 1
+
+        try:
+            return self.connect()
+        except Exception:
+            with self.available:
+                self.opened -= 1
+                self.available.notify()
+            raise
+
+    def release(self, connection: MessageStream, broken: bool = False) -> None:
+        """
+        Gives a connection back. Broken ones (or ones left halfway through a download) get closed instead
+        """
+        with self.available:
+            if broken:
+                connection.conn.close()
+                self.opened -= 1
+            else:
+                self.idle.append(connection)
+
+            self.available.notify()
+
+    def close(self) -> None:
+        """
+        Closes the idle connections (call once nothing's using the pool, the next acquire opens new ones)
+        """
+        with self.available:
+            for connection in self.idle:
+                connection.conn.close()
+
+            self.opened -= len(self.idle)
+            self.idle = []
+
+
+def receive_reply(
+    connection: MessageStream,
+    metadata: Dict,
+    segment_dir: TemporaryDirectory,
+    abr: Optional[AbrController] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Path:
+    """
+    Recieves a DOWNLOAD from the server into segment_dir.
+    It's written under a hidden name first and renamed once it's all there, so a half downloaded segment is never played
+    Tells the abr how long the file took to download, if given one
+    Gives up halfway (raising InterruptedError) if should_stop says so, which leaves the connection unusable
+    Returns where the file ended up
+    """
+    if metadata.get("type") != "DOWNLOAD":
+        raise Exception(metadata.get("message", f"Expected a DOWNLOAD, got {metadata}"))
+
+    file_name = metadata.get("target")
+    extended_file_name = Path(segment_dir).joinpath(file_name)
+    partial_file_name = Path(segment_dir).joinpath(f".{file_name}.part")
+    file_size = metadata.get("file_size")
+    print(f"Downloading {extended_file_name} of size {file_size} bytes")
+
+    if (
+        connection.download_needs_ack
+    ):  # older protocol versions wait for us before sending the file
+        connection.send_obj({"type": "ACK"})  # acknowledge the metadata
+    # let's do it
+    bytes_received = 0
+    download_start = time.monotonic()
+
+    if abr is not None:
+        abr.start_download()
+
+    try:
+        with open(partial_file_name, "wb") as file:
+            while bytes_received < file_size:
+                if should_stop is not None and should_stop():
+                    raise InterruptedError(f"Stopped downloading {file_name}")
+
+                data = connection.recv_raw(min(65536, file_size - bytes_received))
+
+                if not data:
+                    raise ConnectionError(
+                        f"Server closed the connection {file_size - bytes_received} bytes early"
+                    )
+
+                file.write(data)
+                bytes_received += len(data)
+    except BaseException:
+        if abr is not None:
+            abr.cancel_download()
+
+        try:
+            os.remove(partial_file_name)
+        except OSError:
+            pass
+        raise
+
+    if abr is not None:
+        abr.record_download(bytes_received, time.monotonic() - download_start)
+
+    os.replace(partial_file_name, extended_file_name)
+    print(f"Downloaded {extended_file_name} of size {bytes_received} bytes")
+    return extended_file_name
+
+
+class SegmentPrefetcher:
+    """
+    Downloads a video's segments ahead of the playhead, several at once (one per pooled connection)
+    Always fetches the missing segment closest to the playhead first, and never more than the look ahead window past it
+    """
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        segment_dir: TemporaryDirectory,
+        video_id: int,
+        num_segment: int,
+        abr: AbrController,
+        fetchers: int = SEGMENT_FETCHERS,
+        look_ahead_segments: int = LOOK_AHEAD_SEGMENTS,
+        look_ahead_seconds: Optional[float] = LOOK_AHEAD_SECONDS,
+    ):
+        self.pool = pool
+        self.segment_dir = segment_dir
+        self.video_id = video_id
+        self.num_segment = num_segment
+        self.abr = abr
+        self.fetchers = fetchers
+
+        if look_ahead_seconds is not None:
+            look_ahead_segments = math.ceil(look_ahead_seconds / SEGMENT_DURATION)
+
+        self.window = max(1, look_ahead_segments)
+        self.playhead = 0  # segment the gui's waiting on (or playing)
+        self.done: Dict[int, Path] = {}
+        self.in_flight: Set[int] = set()
+        self.retry_at: Dict[
+            int, float
+        ] = {}  # segments that failed, and when to try them again
+        self.attempts: Dict[int, int] = {}
+        self.failed: Set[int] = set()  # segments we gave up on (see MAX_ATTEMPTS)
+        self.downloading: Set[MessageStream] = (
+            set()
+        )  # connections in the middle of a download, so stop can cut them off
+        self.stopped = False
+        self.changed = threading.Condition()
+        self.threads = []
+
+    def start(self) -> None:
+        for number in range(self.fetchers):
+            thread = threading.Thread(
+                target=self.fetch_loop, name=f"segment-fetcher-{number}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        """
+        Stops fetching. Downloads already going are cut off (their connections are shut down, which wakes up
+        a fetcher stuck waiting on the server, and closed instead of reused)
+        Waits for every fetcher to finish, so nothing's still writing into segment_dir once it's deleted
+        """
+        with self.changed:
+            self.stopped = True
+            downloading = list(self.downloading)
+            self.changed.notify_all()
+
+        for connection in downloading:
+            try:
+                connection.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # (already closed)
+
+        for thread in self.threads:
+            thread.join()
+
+    def set_playhead(self, segment_id: int) -> None:
+        """
+        Moves the window (the gui asks for segment_id as it starts playing the one before it)
+        """
+        with self.changed:
+            self.playhead = segment_id
+            self.changed.notify_all()
+
+    def buffered_seconds(self) -> float:
+        """
+        Returns how much video's ready to play past the one being played: every segment from the playhead on
+        that's been downloaded without a gap (so 0 when the segment the gui's waiting on isn't here yet)
+        """
+        with self.changed:
+            segment_id = self.playhead
+
+            while segment_id in self.done:
+                segment_id += 1
+
+            return (segment_id - self.playhead) * SEGMENT_DURATION
+
+    def next_to_fetch(self) -> Optional[int]:
+        """
+        Returns the missing segment closest to the playhead (within the window), or None if there's nothing to do
+        (call with self.changed held)
+        """
+        now = time.monotonic()
+        last = min(self.num_segment, self.playhead + self.window)
+
+        for segment_id in range(self.playhead, last):
+            if (
+                segment_id in self.done
+                or segment_id in self.in_flight
+                or segment_id in self.failed
+            ):
+                continue
+
+            if self.retry_at.get(segment_id, 0) > now:
+                continue
+
+            return segment_id
+
+        return None
+
+    def fetch_loop(self) -> None:
+        while True:
+            with self.changed:
+                segment_id = self.next_to_fetch()
+
+                while segment_id is None and not self.stopped:
+                    self.changed.wait(
+                        timeout=RETRY_DELAY
+                    )  # (wakes up now and then for retries)
+                    segment_id = self.next_to_fetch()
+
+                if self.stopped:
+                    return
+
+                self.in_flight.add(segment_id)
+
+            path = None
+            try:
+                path = self.fetch(segment_id)
+            except Exception as e:
+                if not self.stopped:
+                    print(f"Couldn't download segment {segment_id}: {e}")
+
+            with self.changed:
+                self.in_flight.discard(segment_id)
+
+                if path is not None:
+                    self.done[segment_id] = path
+                    self.retry_at.pop(segment_id, None)
+                elif not self.stopped:
+                    attempts = self.attempts.get(segment_id, 0) + 1
+                    self.attempts[segment_id] = attempts
+
+                    if attempts >= MAX_ATTEMPTS:
+                        print(
+                            f"Giving up on segment {segment_id} after {attempts} tries"
+                        )
+                        self.failed.add(segment_id)
+                    else:
+                        self.retry_at[segment_id] = (
+                            time.monotonic() + RETRY_DELAY * 2 ** (attempts - 1)
+                        )
+
+                self.changed.notify_all()
+
+    def fetch(self, segment_id: int) -> Optional[Path]:
+        quality = self.abr.choose(self.buffered_seconds())
+        request = {}
+        request["type"] = "VIDEO"
+        request["video_id"] = self.video_id
+        request["quality"] = quality
+        request["segment_id"] = segment_id
+
+        connection = self.pool.acquire()
+        broken = True  # unless we get all the way through
+        try:
+            with self.changed:
+                if self.stopped:  # (while we were waiting for a connection)
+                    broken = False
+                    return None
+
+                self.downloading.add(connection)
+
+            connection.send_obj(request)
+            metadata = connection.recv_obj()
+
+            if (
+                metadata.get("type") == "ERROR"
+            ):  # nothing left to read, the connection's fine
+                broken = False
+                raise Exception(metadata.get("message"))
+
+            if self.stopped:
+                return None  # (the file's still coming though, so the connection's closed instead)
+
+            path = receive_reply(
+                connection, metadata, self.segment_dir, self.abr, lambda: self.stopped
+            )
+            broken = False
+            return path
+        finally:
+            with self.changed:
+                self.downloading.discard(connection)
+
+            self.pool.release(connection, broken)
+
+    def wait_for(
+        self, segment_id: int, should_stop: Callable[[], bool]
+    ) -> Optional[Path]:
+        """
+        Waits for a segment to be downloaded, returning its path
+        Returns None if should_stop says so first, or if the segment couldn't be downloaded
+        """
+        with self.changed:
+            while segment_id not in self.done:
+                if should_stop() or self.stopped or segment_id in self.failed:
+                    return None
+
+                self.changed.wait(timeout=0.1)
+
+            return self.done[segment_id]
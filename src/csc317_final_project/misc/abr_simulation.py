@@ -0,0 +1,231 @@
+"""
+Replays bandwidth traces against the client's quality selection (see client/abr.py), without a server or a GUI.
+
+Each segment is "downloaded" at whatever bandwidth the trace has at the time (plus a round trip), while the buffer
+drains in real time, and the player stalls whenever it runs dry. Reports the rebuffer ratio (the share of the
+session spent stalled), the average bitrate, and how often the quality switched, for the ABR controller and for
+always fetching the highest quality (what the client used to do).
+
+Traces are either built in (see TRACES), or a file of "<seconds> <kbit/s>" lines, which is looped if it's shorter
+than the video.
+
+$ uv run python -m csc317_final_project.misc.abr_simulation --trace all
+$ uv run python -m csc317_final_project.misc.abr_simulation --trace-file my_trace.txt --segments 200
+"""
+
+import argparse
+import random
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from csc317_final_project.client.abr import SEGMENT_DURATION, AbrController, get_bitrate
+from csc317_final_project.server.quality import VideoQuality
+
+Trace = List[Tuple[float, float]]  # (seconds, bits/s)
+
+
+def random_walk_trace(seed: int = 0) -> Trace:
+    """
+    A bandwidth that wanders between 0.5 and 12 Mbit/s, changing every couple of seconds.
+    """
+    rng = random.Random(seed)
+    bandwidth = 4_000_000.0
+    trace = []
+    for _ in range(300):
+        bandwidth = min(12_000_000, max(500_000, bandwidth * rng.uniform(0.6, 1.5)))
+        trace.append((2.0, bandwidth))
+    return trace
+
+
+TRACES: Dict[str, Callable[[], Trace]] = {
+    "steady": lambda: [(60.0, 8_000_000)],
+    "drop": lambda: [(60.0, 8_000_000), (45.0, 800_000), (600.0, 8_000_000)],
+    "congested": lambda: [(10.0, 6_000_000), (10.0, 1_200_000)] * 30,
+    "mobile": random_walk_trace,
+}
+
+
+def load_trace(path: Path) -> Trace:
+    trace = []
+    for line in path.read_text().splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        seconds, kbps = line.split()
+        trace.append((float(seconds), float(kbps) * 1000))
+    return trace
+
+
+class Link:
+    """
+    A network link replaying a trace. (Looped, if the session outlasts it.)
+    """
+
+    def __init__(self, trace: Trace, rtt: float) -> None:
+        self.trace = trace
+        self.rtt = rtt
+        self.length = sum(seconds for seconds, _ in trace)
+
+    def bandwidth_at(self, now: float) -> Tuple[float, float]:
+        """
+        Get the bandwidth at a time, and how long until it changes.
+        """
+        now %= self.length
+        for seconds, bandwidth in self.trace:
+            if now < seconds:
+                return bandwidth, seconds - now
+            now -= seconds
+        return self.trace[-1][1], self.trace[-1][0]
+
+    def download(self, now: float, size: int) -> float:
+        """
+        Get how long downloading size bytes takes, starting at now.
+        """
+        elapsed = self.rtt
+        bits = size * 8.0
+        while bits > 0:
+            bandwidth, remaining = self.bandwidth_at(now + elapsed)
+            sent = min(bits, bandwidth * remaining)
+            elapsed += sent / bandwidth
+            bits -= sent
+        return elapsed
+
+
+def simulate(
+    trace: Trace,
+    choose: Callable[[float], int],
+    record: Callable[[int, float], None],
+    segments: int,
+    rtt: float,
+    max_buffer: float,
+    seed: int,
+) -> dict:
+    """
+    Play a video over a link, with choose picking each segment's quality (from the buffer level), and record
+    being told how each download went.
+    """
+    link = Link(trace, rtt)
+    rng = random.Random(seed)
+    now = 0.0
+    buffer = 0.0
+    started = False
+    startup = 0.0
+    stalled = 0.0
+    stalls = 0
+    qualities = []
+    for _ in range(segments):
+        if buffer > max_buffer - SEGMENT_DURATION:
+            # (the player only looks so far ahead, wait for room)
+            wait = buffer - (max_buffer - SEGMENT_DURATION)
+            now += wait
+            buffer -= wait
+        quality = choose(buffer)
+        # real segments are only roughly their nominal bitrate
+        size = int(get_bitrate(quality) * SEGMENT_DURATION / 8 * rng.uniform(0.7, 1.3))
+        took = link.download(now, size)
+        record(size, took)
+        now += took
+        if started:
+            if took > buffer:
+                stalled += took - buffer
+                stalls += 1
+            buffer = max(0.0, buffer - took)
+        else:
+            started = True
+            startup = now
+        buffer += SEGMENT_DURATION
+        qualities.append(quality)
+
+    played = segments * SEGMENT_DURATION
+    switches = sum(1 for a, b in zip(qualities, qualities[1:]) if a != b)
+    return {
+        "startup": startup,
+        "stalled": stalled,
+        "stalls": stalls,
+        "rebuffer_ratio": stalled / (played + stalled),
+        "average_bitrate": sum(map(get_bitrate, qualities)) / len(qualities),
+        "switches": switches,
+        "qualities": qualities,
+    }
+
+
+def report(name: str, result: dict) -> None:
+    counts = {
+        str(VideoQuality(quality)): result["qualities"].count(quality)
+        for quality in sorted(set(result["qualities"]), reverse=True)
+    }
+    print(
+        f"  {name:>8}: rebuffer {result['rebuffer_ratio'] * 100:5.1f}%"
+        f" ({result['stalls']} stalls, {result['stalled']:.1f}s),"
+        f" avg {result['average_bitrate'] / 1000:6.0f} kbit/s,"
+        f" {result['switches']} switches, startup {result['startup']:.2f}s"
+    )
+    print(f"            {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--trace",
+        default="all",
+        choices=["all", *TRACES],
+        help="which built in trace to replay",
+    )
+    parser.add_argument(
+        "--trace-file", type=Path, help='a trace of "<seconds> <kbit/s>" lines instead'
+    )
+    parser.add_argument("--segments", type=int, default=100)
+    parser.add_argument(
+        "--max-quality",
+        type=int,
+        default=int(VideoQuality.FOUR_K),
+        help="the highest quality the video has (as a VideoQuality number)",
+    )
+    parser.add_argument("--rtt", type=float, default=0.05, help="seconds per request")
+    parser.add_argument(
+        "--max-buffer",
+        type=float,
+        default=60,
+        help="how many seconds the player downloads ahead, at most",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.trace_file is not None:
+        traces = {args.trace_file.name: load_trace(args.trace_file)}
+    elif args.trace == "all":
+        traces = {name: make() for name, make in TRACES.items()}
+    else:
+        traces = {args.trace: TRACES[args.trace]()}
+
+    ladder = list(range(args.max_quality + 1))
+    for name, trace in traces.items():
+        print(f"== {name} ==")
+        abr = AbrController(ladder)
+        report(
+            "abr",
+            simulate(
+                trace,
+                abr.choose,
+                abr.record_download,
+                args.segments,
+                args.rtt,
+                args.max_buffer,
+                args.seed,
+            ),
+        )
+        report(
+            "max",
+            simulate(
+                trace,
+                lambda buffer: args.max_quality,
+                lambda size, took: None,
+                args.segments,
+                args.rtt,
+                args.max_buffer,
+                args.seed,
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Benchmarks how many idle and active connections the server holds with each connection engine.
+
+Starts a fresh server (in a temporary directory) for each engine, opens a bunch of idle connections,
+and then has some of them hammer the server with USERS requests, reporting the server's thread count,
+memory usage and request throughput. (Linux only, since it reads /proc.)
+
+$ uv run python -m csc317_final_project.misc.bench_connections --idle 2000 --active 50
+"""
+
+import argparse
+import json
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+
+from csc317_final_project.server.migrations import migrate
+
+
+def create_database(server_path: Path) -> None:
+    """
+    Creates a fresh database from the migrations.
+    """
+    migrate(server_path)
+
+
+def process_stats(pid: int) -> Dict[str, int]:
+    """
+    Reads the thread count and resident memory (in KiB) of a process.
+    """
+    stats = {}
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key in ("Threads", "VmRSS"):
+            stats[key] = int(value.split()[0])
+    return stats
+
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server never started listening on port {port}")
+
+
+def request(conn: socket.socket, obj: dict) -> dict:
+    conn.sendall(json.dumps(obj).encode("utf-8"))
+    buffer = b""
+    while True:
+        buffer += conn.recv(65536)
+        try:
+            return json.loads(buffer)
+        except json.JSONDecodeError:
+            continue
+
+
+def bench_engine(engine: str, port: int, idle: int, active: int, duration: float):
+    with TemporaryDirectory() as tmp:
+        server_path = Path(tmp)
+        create_database(server_path)
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "csc317_final_project.server",
+                "--engine",
+                engine,
+                "--port",
+                str(port),
+                "--data-dir",
+                str(server_path),
+                "--log-level",
+                "WARNING",
+            ]
+        )
+        try:
+            wait_for_port(port)
+            baseline = process_stats(server.pid)
+
+            conns: List[socket.socket] = []
+            failed = 0
+            for _ in range(idle):
+                try:
+                    conns.append(socket.create_connection(("127.0.0.1", port)))
+                except OSError:
+                    failed += 1
+            time.sleep(1)  # let the server accept everything
+            idle_stats = process_stats(server.pid)
+
+            completed = [0] * active
+            stop = threading.Event()
+
+            def hammer(i: int) -> None:
+                while not stop.is_set():
+                    request(conns[i], {"type": "USERS", "page_num": 0})
+                    completed[i] += 1
+
+            threads = [
+                threading.Thread(target=hammer, args=(i,), daemon=True)
+                for i in range(min(active, len(conns)))
+            ]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            active_stats = process_stats(server.pid)
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            for conn in conns:
+                conn.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"== {engine} ==")
+    print(
+        f"  baseline:         {baseline['Threads']:>6} threads, {baseline['VmRSS'] / 1024:8.1f} MiB"
+    )
+    print(
+        f"  {len(conns):>6} idle:      {idle_stats['Threads']:>6} threads, {idle_stats['VmRSS'] / 1024:8.1f} MiB"
+        f" ({failed} connections refused)"
+    )
+    print(
+        f"  {len(threads):>6} active:    {active_stats['Threads']:>6} threads, {active_stats['VmRSS'] / 1024:8.1f} MiB,"
+        f" {sum(completed) / duration:10.1f} req/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--engine", choices=["threads", "selectors", "both"], default="both"
+    )
+    parser.add_argument("--port", type=int, default=2199)
+    parser.add_argument("--idle", type=int, default=1000)
+    parser.add_argument("--active", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    # every connection is a file descriptor, on both ends
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    engines = ["threads", "selectors"] if args.engine == "both" else [args.engine]
+    for engine in engines:
+        bench_engine(engine, args.port, args.idle, args.active, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Benchmarks the database under concurrent load, with per-thread connections (what the server does) against
+one connection shared behind a lock (what it used to do).
+
+Seeds a fresh database (in a temporary directory) with users and videos, then has a number of threads run a mix of
+get_users_page, get_video_page and start_upload_video calls as fast as they can, reporting the throughput and the
+latency of each kind of call.
+
+$ uv run python -m csc317_final_project.misc.bench_db --threads 1,4,16 --duration 5
+"""
+
+import argparse
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List, Optional
+
+from csc317_final_project.misc.bench_connections import create_database
+from csc317_final_project.server.db import Database
+
+
+class SharedConnectionDatabase(Database):
+    """
+    The old setup: every thread shares one connection (and cursor), and takes turns with a lock.
+    """
+
+    def __init__(self, server_path: Path):
+        self.path = server_path / "db.sqlite3"
+        self.shared = sqlite3.connect(self.path, check_same_thread=False)
+        self.shared.row_factory = sqlite3.Row
+        self.shared_cursor = self.shared.cursor()
+        self.lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return self.shared
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        return self.shared_cursor
+
+
+def seed(server_path: Path, users: int, videos_per_user: int) -> None:
+    """
+    Fills the database with users and (processed) videos.
+    """
+    connection = sqlite3.connect(server_path / "db.sqlite3")
+    connection.executemany(
+        "INSERT INTO users (username, password) VALUES (?, ?)",
+        ((f"user{i}", "not a real hash") for i in range(users)),
+    )
+    connection.executemany(
+        "INSERT INTO videos (author, title, length, num_segments, max_quality) VALUES (?, ?, ?, ?, ?)",
+        (
+            (f"user{i}", f"video {j}", 60.0, 20, 4)
+            for i in range(users)
+            for j in range(videos_per_user)
+        ),
+    )
+    connection.commit()
+    connection.close()
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def bench(
+    name: str,
+    db: Database,
+    lock: Optional[threading.RLock],
+    threads: int,
+    duration: float,
+    mix: Dict[str, int],
+    users: int,
+    videos_per_user: int,
+) -> None:
+    operations: Dict[str, Callable[[random.Random], object]] = {
+        "users": lambda rng: db.get_users_page(
+            rng.randrange(max(1, users // db.MAX_ITEMS_PER_PAGE))
+        ),
+        "videos": lambda rng: db.get_video_page(
+            rng.randrange(max(1, videos_per_user // db.MAX_ITEMS_PER_PAGE)),
+            f"user{rng.randrange(users)}",
+        ),
+        "uploads": lambda rng: db.start_upload_video(
+            "benchmark", f"user{rng.randrange(users)}"
+        ),
+    }
+    names = [op for op in mix if mix[op] > 0]
+    weights = [mix[op] for op in names]
+    latencies: Dict[str, List[float]] = {op: [] for op in names}
+    stop = threading.Event()
+
+    def hammer(seed: int) -> None:
+        rng = random.Random(seed)
+        own: Dict[str, List[float]] = {op: [] for op in names}
+        while not stop.is_set():
+            op = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            if lock is not None:
+                with lock:
+                    operations[op](rng)
+            else:
+                operations[op](rng)
+            own[op].append(time.perf_counter() - start)
+        # (list.extend is atomic enough under the GIL)
+        for op in names:
+            latencies[op].extend(own[op])
+
+    workers = [
+        threading.Thread(target=hammer, args=(i,), daemon=True) for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    total = sum(len(op_latencies) for op_latencies in latencies.values())
+    print(f"== {name}, {threads} threads: {total / duration:10.1f} calls/s ==")
+    for op in names:
+        print(
+            f"  {op:>8}: {len(latencies[op]) / duration:10.1f}/s,"
+            f" p50 {percentile(latencies[op], 0.5) * 1000:7.2f} ms,"
+            f" p99 {percentile(latencies[op], 0.99) * 1000:7.2f} ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--threads",
+        default="1,4,16",
+        help="comma separated thread counts to try",
+    )
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--videos-per-user", type=int, default=50)
+    parser.add_argument(
+        "--mix",
+        default="users=45,videos=45,uploads=10",
+        help="relative weights of each kind of call",
+    )
+    parser.add_argument(
+        "--mode", choices=["per-thread", "shared", "both"], default="both"
+    )
+    args = parser.parse_args()
+
+    mix = {}
+    for part in args.mix.split(","):
+        op, _, weight = part.partition("=")
+        mix[op.strip()] = int(weight)
+
+    modes = ["shared", "per-thread"] if args.mode == "both" else [args.mode]
+    for threads in map(int, args.threads.split(",")):
+        for mode in modes:
+            with TemporaryDirectory() as tmp:
+                server_path = Path(tmp)
+                create_database(server_path)
+                seed(server_path, args.users, args.videos_per_user)
+                lock: Optional[threading.RLock] = None
+                if mode == "shared":
+                    shared = SharedConnectionDatabase(server_path)
+                    db: Database = shared
+                    lock = shared.lock
+                else:
+                    db = Database(server_path)  # (switches the database to WAL)
+                bench(
+                    mode,
+                    db,
+                    lock,
+                    threads,
+                    args.duration,
+                    mix,
+                    args.users,
+                    args.videos_per_user,
+                )
+
+
+if __name__ == "__main__":
+    main()
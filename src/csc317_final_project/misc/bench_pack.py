@@ -0,0 +1,158 @@
+"""
+Benchmarks serving segments from loose files against serving them from a pack.
+
+Takes a quality directory of loose segments (say, server_data/videos/1/720p), packs a copy of it, and then
+sends every segment over a local socket a few times, through the server's own download_segment, reporting
+the latency per request and the filesystem calls (stats and opens) each request makes. Loose segments are
+served both with the segment cache off and with it on.
+
+$ uv run python -m csc317_final_project.misc.bench_pack server_data/videos/1/720p
+"""
+
+import argparse
+import builtins
+import io
+import os
+import pathlib
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Iterator, List
+from unittest import mock
+
+from csc317_final_project.protocol import PROTOCOL_VERSION, MessageStream
+from csc317_final_project.server.__main__ import download_segment
+from csc317_final_project.server.cache import SegmentCache
+from csc317_final_project.server.pack import (
+    PackStore,
+    get_loose_segments,
+    pack_segments,
+)
+from csc317_final_project.server.quality import VideoQuality
+
+
+@contextmanager
+def count_filesystem_calls() -> Iterator[Dict[str, int]]:
+    """
+    Counts every stat and open made while inside. (Python-level calls, so an mmapped pack's page faults
+    don't show up - which is the point of it.)
+    """
+    counts = {"stat": 0, "open": 0}
+
+    def counted(name: str, function: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    patches = [
+        mock.patch("os.stat", counted("stat", os.stat)),
+        # (io.open and open are the same function, which Path.open goes through too)
+        mock.patch("io.open", counted("open", io.open)),
+        mock.patch("builtins.open", counted("open", builtins.open)),
+    ]
+    # before python 3.11, Path.stat goes through an accessor holding its own reference to os.stat
+    accessor = getattr(pathlib, "_NormalAccessor", None)
+    if accessor is not None and hasattr(accessor, "stat"):
+        patches.append(
+            mock.patch.object(accessor, "stat", staticmethod(counted("stat", os.stat)))
+        )
+    for patch in patches:
+        patch.start()
+    try:
+        yield counts
+    finally:
+        for patch in patches:
+            patch.stop()
+
+
+def drain(conn: socket.socket) -> None:
+    buffer = bytearray(1024 * 1024)
+    while conn.recv_into(buffer):
+        pass
+
+
+def bench(name: str, requests: int, serve: Callable[[int], None]) -> None:
+    with count_filesystem_calls() as counts:
+        start = time.perf_counter()
+        for i in range(requests):
+            serve(i)
+        elapsed = time.perf_counter() - start
+    print(
+        f"{name:>12}: {elapsed / requests * 1e6:8.1f} us/request, per request: "
+        f"{counts['stat'] / requests:.1f} stats, {counts['open'] / requests:.1f} opens"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("quality_dir", type=Path)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    segments: List[Path] = get_loose_segments(args.quality_dir)
+    if not segments:
+        raise SystemExit(f"No segments found in {args.quality_dir}")
+    video_id = segments[0].stem.split("_")[0]
+    quality = VideoQuality(int(segments[0].stem.split("_")[1]))
+    requests = len(segments) * args.rounds
+
+    with TemporaryDirectory() as loose_tmp, TemporaryDirectory() as packed_tmp:
+        # lay out fake server directories, so everything's where the server expects it
+        loose_root = Path(loose_tmp)
+        shutil.copytree(
+            args.quality_dir, loose_root / "videos" / video_id / str(quality)
+        )
+        packed_root = Path(packed_tmp)
+        packed_dir = packed_root / "videos" / video_id / str(quality)
+        shutil.copytree(args.quality_dir, packed_dir)
+        pack_segments(packed_dir)
+
+        # (download logs the client's address, so it has to be a real connection)
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            sender = socket.create_connection(listener.getsockname())
+            receiver, _ = listener.accept()
+        drainer = threading.Thread(target=drain, args=(receiver,), daemon=True)
+        drainer.start()
+        stream = MessageStream(sender, PROTOCOL_VERSION)
+
+        def server(root: Path, cache_bytes: int) -> Callable[[int], None]:
+            cache = SegmentCache(cache_bytes)
+            packs = PackStore(root)
+
+            def serve(i: int) -> None:
+                download_segment(
+                    stream, root, cache, packs, video_id, quality, i % len(segments)
+                )
+
+            return serve
+
+        serve_loose = server(loose_root, 0)
+        serve_cached = server(loose_root, 256 * 1024 * 1024)
+        serve_packed = server(packed_root, 0)
+
+        # warm up the page cache (and the segment cache, and the pack store), so everything's in memory
+        for i in range(len(segments)):
+            serve_loose(i)
+            serve_cached(i)
+            serve_packed(i)
+
+        print(
+            f"{len(segments)} segments of {os.path.getsize(segments[0])} bytes (first)"
+        )
+        bench("loose", requests, serve_loose)
+        bench("loose cached", requests, serve_cached)
+        bench("packed", requests, serve_packed)
+
+        sender.close()
+        drainer.join()
+        receiver.close()
+
+
+if __name__ == "__main__":
+    main()
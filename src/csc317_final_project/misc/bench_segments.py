@@ -0,0 +1,135 @@
+"""
+Benchmarks segment serving throughput: the old way (4 KB reads + sendall) against sendfile.
+
+Serves every segment in a directory (say, server_data/videos/1/720p) to N local clients, several times over,
+and reports the throughput and how much CPU the serving side burned per GB sent. (The clients run in a separate
+process, so their CPU time isn't counted.) If no directory is given, it makes up some 1 MB segments.
+
+$ uv run python -m csc317_final_project.misc.bench_segments server_data/videos/1/720p --clients 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import socket
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, List, Optional
+
+from csc317_final_project.server.__main__ import (
+    SEGMENT_SIZE,
+    buffered_send_file,
+    send_file,
+)
+
+
+def drain(port: int) -> None:
+    """
+    A client: reads everything the server sends until it closes the connection.
+    """
+    with socket.create_connection(("127.0.0.1", port)) as conn:
+        buffer = bytearray(1024 * 1024)
+        while conn.recv_into(buffer):
+            pass
+
+
+def serve(
+    conn: socket.socket,
+    segments: List[Path],
+    rounds: int,
+    sender: Callable[[socket.socket, Path], None],
+) -> None:
+    with conn:
+        for _ in range(rounds):
+            for segment in segments:
+                sender(conn, segment)
+
+
+def send_buffered(conn: socket.socket, segment: Path) -> None:
+    # what download() used to do
+    with open(segment, "rb") as file:
+        buffered_send_file(conn, file, segment.stat().st_size, SEGMENT_SIZE)
+
+
+def send_zero_copy(conn: socket.socket, segment: Path) -> None:
+    with open(segment, "rb") as file:
+        send_file(conn, file, segment.stat().st_size)
+
+
+def bench(
+    name: str,
+    sender: Callable[[socket.socket, Path], None],
+    segments: List[Path],
+    clients: int,
+    rounds: int,
+) -> None:
+    listener = socket.create_server(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    total_bytes = sum(s.stat().st_size for s in segments) * rounds * clients
+
+    processes = [
+        multiprocessing.Process(target=drain, args=(port,)) for _ in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    conns = [listener.accept()[0] for _ in range(clients)]
+    listener.close()
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=serve, args=(conn, segments, rounds, sender))
+        for conn in conns
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    gigabytes = total_bytes / 1024**3
+    print(
+        f"{name:>9}: {total_bytes / 1024**2 / elapsed:9.1f} MB/s, "
+        f"{cpu / gigabytes:6.2f} CPU s/GB ({gigabytes:.2f} GB in {elapsed:.2f}s)"
+    )
+
+
+def make_segments(directory: Path, count: int, size: int) -> List[Path]:
+    segments = []
+    for i in range(count):
+        segment = directory / f"0_4_{i}.mp4"
+        segment.write_bytes(os.urandom(size))
+        segments.append(segment)
+    return segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("segments", type=Path, nargs="?", default=None)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        segment_dir: Optional[Path] = args.segments
+        if segment_dir is None:
+            segments = make_segments(Path(tmp), 40, 1024 * 1024)
+        else:
+            segments = sorted(segment_dir.glob("*.mp4"))
+        if not segments:
+            raise SystemExit(f"No segments found in {segment_dir}")
+        print(f"{len(segments)} segments, {args.clients} clients, {args.rounds} rounds")
+
+        bench("buffered", send_buffered, segments, args.clients, args.rounds)
+        bench("sendfile", send_zero_copy, segments, args.clients, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
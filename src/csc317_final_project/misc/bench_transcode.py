@@ -0,0 +1,137 @@
+"""
+Benchmarks converting a video to every quality: an FFmpeg run per quality (in parallel, like process_video does)
+against a single FFmpeg run for all of them (convert_video_ladder), and against converting it in parallel chunks
+(convert_video_chunked).
+
+Reports the wall time, and the CPU time used by FFmpeg (user + system, summed over every FFmpeg process).
+Also checks every method split every quality into the same number of segments, ceil(duration / 3), since the client
+works out which segment to play from the time. (Exits with 1 if one didn't.)
+
+$ uv run python -m csc317_final_project.misc.bench_transcode sample.mp4
+"""
+
+import argparse
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict
+
+from csc317_final_project.server.ffmpeg import (
+    convert_video,
+    convert_video_chunked,
+    convert_video_ladder,
+    expected_segments,
+    get_quality_ladder,
+    get_video_info,
+)
+from csc317_final_project.server.pack import count_segments
+from csc317_final_project.server.quality import VideoQuality
+
+
+def bench(name: str, run: Callable[[Path], None]) -> Dict[str, int]:
+    """
+    Returns how many segments each quality came out as.
+    """
+    with TemporaryDirectory() as tmp:
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        run(Path(tmp))
+        elapsed = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        segments = {
+            quality_dir.name: count_segments(quality_dir)
+            for quality_dir in Path(tmp).iterdir()
+            if quality_dir.is_dir()
+        }
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    print(
+        f"{name:>13}: {elapsed:8.2f}s wall, {cpu:8.2f}s CPU ({sum(segments.values())} segments)"
+    )
+    return segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("video", type=Path)
+    parser.add_argument(
+        "--workers", type=int, default=8, help="size of the per-quality worker pool"
+    )
+    parser.add_argument(
+        "--chunk-length",
+        type=float,
+        default=30,
+        help="seconds per chunk, for the chunked run",
+    )
+    args = parser.parse_args()
+
+    video_info = get_video_info(args.video)
+    if not video_info:
+        raise SystemExit(f"Couldn't read {args.video}")
+    configs = get_quality_ladder(video_info["height"])
+    print(
+        f"{args.video}: {video_info['height']}p, {video_info['duration']:.1f}s, {len(configs)} qualities"
+    )
+
+    def per_quality(root: Path) -> None:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = []
+            for height, name, crf, preset, video_bitrate, audio_bitrate in configs:
+                output_path = root / str(VideoQuality(int(name)))
+                output_path.mkdir()
+                futures.append(
+                    pool.submit(
+                        convert_video,
+                        args.video,
+                        output_path,
+                        height,
+                        f"0_{name}",
+                        crf,
+                        preset,
+                        video_bitrate,
+                        audio_bitrate,
+                        3,
+                    )
+                )
+            for future in futures:
+                future.result()
+
+    def single_pass(root: Path) -> None:
+        convert_video_ladder(args.video, root, configs, 0, 3)
+
+    def chunked(root: Path) -> None:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            convert_video_chunked(
+                pool,
+                args.video,
+                root,
+                configs,
+                0,
+                3,
+                args.chunk_length,
+                video_info["duration"],
+            )
+
+    results = {
+        "per-quality": bench("per-quality", per_quality),
+        "single pass": bench("single pass", single_pass),
+        "chunked": bench("chunked", chunked),
+    }
+
+    expected = expected_segments(video_info["duration"], 3)
+    mismatched = [
+        f"{name} {quality}: {count}"
+        for name, segments in results.items()
+        for quality, count in segments.items()
+        if count != expected
+    ]
+    if mismatched:
+        print(f"Expected {expected} segments per quality, got " + ", ".join(mismatched))
+        sys.exit(1)
+    print(f"Every quality has {expected} segments")
+
+
+if __name__ == "__main__":
+    main()
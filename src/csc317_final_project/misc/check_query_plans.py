@@ -0,0 +1,54 @@
+"""
+Checks that none of the listing queries scan a whole table. (Exits with 1 if any do, so it can run in CI.)
+
+Applies the migrations to a fresh database (or an existing server directory, with --data-dir), then runs
+EXPLAIN QUERY PLAN on every query in INDEXED_QUERIES (see server/db.py). Add a query there when it needs an index,
+and this will catch the index going missing.
+
+$ uv run python -m csc317_final_project.misc.check_query_plans
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from csc317_final_project.server.db import INDEXED_QUERIES, Database
+from csc317_final_project.server.migrations import migrate
+
+
+def check(server_path: Path) -> int:
+    migrate(server_path)
+    db = Database(server_path)
+    for name, (query, params) in INDEXED_QUERIES.items():
+        plan = db.cursor.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        print(f"{name}:")
+        for step in plan:
+            print(f"    {step['detail']}")
+    problems = db.check_query_plans()
+    for problem in problems:
+        print(f"FULL SCAN - {problem}")
+    if not problems:
+        print("No full table scans.")
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=None,
+        help="check this server's database, instead of a fresh one",
+    )
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        sys.exit(check(args.data_dir))
+    with TemporaryDirectory() as tmp:
+        result = check(Path(tmp))
+    sys.exit(result)
+
+
+if __name__ == "__main__":
+    main()
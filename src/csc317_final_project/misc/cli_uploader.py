@@ -1,62 +1,239 @@
+"""
+Uploads a video from the command line, using chunked (resumable) uploads.
+
+If the upload gets interrupted, just run it again with the same file: it picks up from the chunks the server
+already has. (The upload's ID is kept next to the video, in <video>.upload.json, until the upload's done.)
+Chunks can also be sent over several connections at once, which helps on fast, high-latency links.
+
+$ uv run python -m csc317_final_project.misc.cli_uploader --connections 4
+"""
+
+import argparse
+import hashlib
 import json
+import os
+import queue
 import socket
+import threading
 from pathlib import Path
+from typing import List, Optional, Tuple
+
+from csc317_final_project.protocol import MessageStream, negotiate
+
+MAX_CHUNK_ATTEMPTS = 3
+
+
+def connect(
+    server_address: Tuple[str, int], username: str, password: str
+) -> Optional[MessageStream]:
+    """
+    Connect and log in. Returns None if the login failed.
+    """
+    s = socket.create_connection(server_address)
+    stream = MessageStream(s)
+    negotiate(stream)
+    stream.send_obj({"type": "LOGIN", "username": username, "password": password})
+    response_data = stream.recv_obj() or {}
+    if response_data.get("current_page") != 0:
+        s.close()
+        return None
+    return stream
+
+
+def get_state_path(video_path: Path) -> Path:
+    return video_path.with_name(video_path.name + ".upload.json")
+
+
+def load_state(video_path: Path) -> Optional[dict]:
+    """
+    Get the unfinished upload of this file, if there is one (and the file hasn't changed since).
+    """
+    try:
+        state = json.loads(get_state_path(video_path).read_text())
+    except (OSError, ValueError):
+        return None
+    stat = video_path.stat()
+    if state.get("file_size") != stat.st_size or state.get("mtime") != stat.st_mtime:
+        return None
+    return state
+
+
+def save_state(video_path: Path, upload_id: str, title: str) -> None:
+    stat = video_path.stat()
+    get_state_path(video_path).write_text(
+        json.dumps(
+            {
+                "upload_id": upload_id,
+                "title": title,
+                "file_size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+        )
+    )
 
 
-def send_obj(conn: socket.socket, obj: dict) -> None:
+def send_chunks(
+    stream: MessageStream,
+    video_path: Path,
+    upload_id: str,
+    chunk_size: int,
+    file_size: int,
+    chunks: "queue.Queue[int]",
+    failed: List[int],
+) -> None:
     """
-    Sends a JSON object to the client.
+    Send chunks from the queue until it's empty.
     """
+    with video_path.open("rb") as file:
+        while True:
+            try:
+                chunk = chunks.get_nowait()
+            except queue.Empty:
+                return
+            offset = chunk * chunk_size
+            file.seek(offset)
+            data = file.read(min(chunk_size, file_size - offset))
+            try:
+                uploaded = send_chunk(stream, upload_id, chunk, data)
+            except OSError as e:
+                print(f"Connection lost: {e}")
+                failed.append(chunk)
+                return
+            if not uploaded:
+                failed.append(chunk)
 
-    json_obj = json.dumps(obj)
-    conn.sendall(json_obj.encode("utf-8"))
+
+def send_chunk(stream: MessageStream, upload_id: str, chunk: int, data: bytes) -> bool:
+    """
+    Send one chunk, retrying if the server didn't take it. Returns whether it was uploaded.
+    """
+    for _ in range(MAX_CHUNK_ATTEMPTS):
+        stream.send_obj(
+            {
+                "type": "UPLOAD_CHUNK",
+                "upload_id": upload_id,
+                "chunk": chunk,
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+        )
+        stream.conn.sendall(data)
+        response = stream.recv_obj()
+        if response is None:
+            raise ConnectionError("Server closed the connection")
+        if response.get("success"):
+            print(f"Chunk {chunk} uploaded.")
+            return True
+        print(f"Chunk {chunk} failed: {response}")
+    return False
 
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=2121)
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1,
+        help="how many connections to send chunks over",
+    )
+    parser.add_argument(
+        "--chunk-mb", type=int, default=8, help="the size of each chunk, in MiB"
+    )
+    args = parser.parse_args()
+
     username = input("Enter your username: ")
     password = input("Enter your password: ")
-    video_path = input("Enter the path to the video file: ")
-    title = input("Enter the title of the video: ")
+    video_path = Path(input("Enter the path to the video file: "))
+    file_size = video_path.stat().st_size
 
     # Connect to the server
-    server_address = ("localhost", 2121)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect(server_address)
-        print(f"Connected to server at {server_address}")
-
-        # Send login credentials
-        login_data = {
-            "type": "LOGIN",
-            "username": username,
-            "password": password,
-        }
-        send_obj(s, login_data)
-
-        # Wait for server response
-        response = s.recv(1024)
-        response_data = json.loads(response)
-        if response_data.get("current_page") != 0:
-            print("Login failed. Please check your username and password.")
-            return
-        print("Login successful.")
-        # Send video upload request
-        upload_data = {
-            "type": "UPLOAD",
-            "target": video_path,
-            "file_size": Path(video_path).stat().st_size,
-            "title": title,
-        }
-        send_obj(s, upload_data)
-
-        response = s.recv(1024)
-        if response != b'{"type": "ACK"}':
-            print("Server did not acknowledge video upload request - What?")
-            print(response)
+    server_address = (args.host, args.port)
+    stream = connect(server_address, username, password)
+    if stream is None:
+        print("Login failed. Please check your username and password.")
+        return
+    print(f"Connected to server at {server_address}, login successful.")
+
+    status = None
+    state = load_state(video_path)
+    if state is not None:
+        stream.send_obj({"type": "UPLOAD_STATUS", "upload_id": state["upload_id"]})
+        status = stream.recv_obj() or {}
+        if status.get("type") == "UPLOAD_STATUS":
+            print(
+                f"Resuming upload of {state['title']!r} from {status['offset']} bytes "
+                f"({len(status['received'])}/{status['num_chunks']} chunks already uploaded)."
+            )
+        else:
+            print(
+                "The server doesn't have the unfinished upload anymore, starting over."
+            )
+            status = None
+    if status is None:
+        title = input("Enter the title of the video: ")
+        stream.send_obj(
+            {
+                "type": "UPLOAD_INIT",
+                "target": str(video_path),
+                "file_size": file_size,
+                "chunk_size": args.chunk_mb * 1024 * 1024,
+                "title": title,
+            }
+        )
+        status = stream.recv_obj() or {}
+        if status.get("type") != "UPLOAD_STATUS":
+            print(f"Upload failed: {status}")
             return
-        print("Video upload request acknowledged. Starting upload...")
-        with open(video_path, "rb") as file:
-            s.sendfile(file)
-        print("Video upload completed successfully.")
+        save_state(video_path, status["upload_id"], title)
+
+    upload_id = status["upload_id"]
+    chunks: "queue.Queue[int]" = queue.Queue()
+    received = set(status["received"])
+    for chunk in range(status["num_chunks"]):
+        if chunk not in received:
+            chunks.put(chunk)
+    failed: List[int] = []
+    streams = [stream]
+    for _ in range(args.connections - 1):
+        extra = connect(server_address, username, password)
+        if extra is not None:
+            streams.append(extra)
+
+    threads = [
+        threading.Thread(
+            target=send_chunks,
+            args=(
+                s,
+                video_path,
+                upload_id,
+                status["chunk_size"],
+                file_size,
+                chunks,
+                failed,
+            ),
+        )
+        for s in streams
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for extra in streams[1:]:
+        extra.conn.close()
+    if failed or not chunks.empty():
+        print("Some chunks didn't make it. Run this again to resume the upload.")
+        return
+
+    stream.send_obj({"type": "UPLOAD_COMMIT", "upload_id": upload_id})
+    response = stream.recv_obj() or {}
+    stream.conn.close()
+    if not response.get("success"):
+        print(f"Upload failed: {response}")
+        return
+    os.remove(get_state_path(video_path))
+    print(f"Video upload completed successfully. (Video ID: {response['video_id']})")
 
 
 if __name__ == "__main__":
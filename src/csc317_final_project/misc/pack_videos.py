@@ -0,0 +1,42 @@
+"""
+Packs the segments of existing videos (server_data/videos/*/<quality>/*.mp4) into one pack file per quality.
+(See server/pack.py.) Qualities that are already packed are left alone.
+
+Best run while the server is stopped, since the loose segments are removed once they're packed
+(unless --keep-loose is given).
+
+$ uv run python -m csc317_final_project.misc.pack_videos server_data
+"""
+
+import argparse
+from pathlib import Path
+
+from csc317_final_project.server.fs import PACK_FILE_NAME
+from csc317_final_project.server.pack import pack_segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "server_path", type=Path, nargs="?", default=Path("server_data")
+    )
+    parser.add_argument(
+        "--keep-loose",
+        action="store_true",
+        help="keep the loose segment files after packing them",
+    )
+    args = parser.parse_args()
+
+    packed = 0
+    for video_root in sorted((args.server_path / "videos").iterdir()):
+        for quality_dir in sorted(video_root.iterdir()):
+            if not quality_dir.is_dir() or (quality_dir / PACK_FILE_NAME).exists():
+                continue
+            if pack_segments(quality_dir, remove_loose=not args.keep_loose):
+                print(f"Packed {quality_dir}")
+                packed += 1
+    print(f"Packed {packed} qualities.")
+
+
+if __name__ == "__main__":
+    main()
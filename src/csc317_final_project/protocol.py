@@ -0,0 +1,210 @@
+"""
+Message framing for the client <-> server protocol. (Shared by both sides.)
+
+Version 1 (legacy) sends bare JSON objects back to back, and relies on the JSON itself to tell where
+one message stops and the next begins. Version 2 prefixes every message with its length (a 4-byte
+big-endian unsigned int), so messages can be any size and several can be in flight on one socket.
+Version 3 drops the ACK from downloads: the file's bytes follow the DOWNLOAD header straight away.
+
+Connections always start on version 1. A client that wants framing sends a HELLO with the version it
+wants, and the server answers (still in version 1) with the version they'll both use from then on.
+Old servers answer with an ERROR, in which case the client should stay on version 1.
+"""
+
+import json
+import socket
+import struct
+from typing import Optional
+
+LEGACY_VERSION = 1
+FRAMED_VERSION = 2
+STREAMING_VERSION = 3
+PROTOCOL_VERSION = STREAMING_VERSION  # the newest version we speak
+
+HEADER = struct.Struct("!I")
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # nothing legitimate is anywhere near this big
+RECV_SIZE = 65536
+
+JSON_DECODER = json.JSONDecoder()
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the other side sends something that isn't a valid message.
+    """
+
+
+class MessageStream:
+    """
+    Reads and writes protocol messages on a socket.
+
+    Incoming bytes are buffered, since a single recv can hold half a message, or several of them.
+    Raw file data (uploads and downloads) should also be read through here (with recv_raw), so any
+    bytes that were already buffered aren't lost.
+    """
+
+    def __init__(self, conn: socket.socket, version: int = LEGACY_VERSION) -> None:
+        self.conn = conn
+        self.version = version
+        self.buffer = bytearray()
+
+    @property
+    def framed(self) -> bool:
+        return self.version >= FRAMED_VERSION
+
+    @property
+    def download_needs_ack(self) -> bool:
+        return self.version < STREAMING_VERSION
+
+    def feed(self, data: bytes) -> None:
+        """
+        Adds freshly recieved bytes to the receive buffer.
+        """
+        self.buffer += data
+
+    def next_message(self) -> Optional[dict]:
+        """
+        Pops the next complete message out of the receive buffer.
+
+        Returns:
+            Optional[dict]: The message, or None if the buffer doesn't hold a complete one yet.
+
+        Raises:
+            ProtocolError: If the message isn't a JSON object. (It's dropped from the buffer either way.)
+        """
+        end = self._message_end()
+        if end is None:
+            return None
+        if self.framed:
+            payload = bytes(self.buffer[HEADER.size : end])
+        else:
+            payload = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        try:
+            message = json.loads(payload)
+        except ValueError as e:  # (bad json, or bad utf-8)
+            raise ProtocolError(f"Message is not valid JSON: {e}") from e
+        if not isinstance(message, dict):
+            raise ProtocolError("Message is not a JSON object")
+        return message
+
+    def has_message(self) -> bool:
+        """
+        Checks if the receive buffer holds a complete message, without popping it.
+        """
+        return self._message_end() is not None
+
+    def _message_end(self) -> Optional[int]:
+        """
+        Finds where the first buffered message ends (in bytes), if there's a complete one.
+        """
+        if self.framed:
+            if len(self.buffer) < HEADER.size:
+                return None
+            (length,) = HEADER.unpack_from(self.buffer)
+            if length > MAX_MESSAGE_SIZE:
+                raise ProtocolError(f"Message of {length} bytes is too large")
+            end = HEADER.size + length
+            return end if len(self.buffer) >= end else None
+
+        # legacy: no length, so we have to find the end of the json object ourselves
+        stripped = self.buffer.lstrip()
+        if not stripped:
+            del self.buffer[:]
+            return None
+        del self.buffer[: len(self.buffer) - len(stripped)]
+        try:
+            text = self.buffer.decode("utf-8")
+        except UnicodeDecodeError as e:
+            if e.end != len(self.buffer):
+                raise ProtocolError("Message is not valid utf-8") from e
+            # a character got split between recvs, the complete part might still hold a message
+            text = self.buffer[: e.start].decode("utf-8")
+        try:
+            _, end = JSON_DECODER.raw_decode(text)
+        except json.JSONDecodeError:
+            if len(self.buffer) > MAX_MESSAGE_SIZE:
+                raise ProtocolError("Message is too large") from None
+            return None  # (probably) incomplete - wait for more data
+        return len(text[:end].encode("utf-8"))
+
+    def recv_obj(self) -> Optional[dict]:
+        """
+        Blocks until a complete message is recieved.
+
+        Returns:
+            Optional[dict]: The message, or None if the other side closed the connection.
+        """
+        while True:
+            obj = self.next_message()
+            if obj is not None:
+                return obj
+            data = self.conn.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.feed(data)
+
+    def recv_raw(self, max_size: int) -> bytes:
+        """
+        Recieves up to max_size bytes of raw (unframed) data, such as file contents.
+        Returns an empty bytes object if the other side closed the connection.
+        """
+        if self.buffer:
+            data = bytes(self.buffer[:max_size])
+            del self.buffer[:max_size]
+            return data
+        return self.conn.recv(max_size)
+
+    def send_obj(self, obj: dict) -> None:
+        """
+        Sends a JSON object to the other side.
+        """
+        self.conn.sendall(encode_message(obj, self.framed))
+
+    def send_payload(self, payload: bytes) -> None:
+        """
+        Sends a JSON object that's already been encoded (with encode_payload) to the other side.
+        """
+        self.conn.sendall(frame_payload(payload, self.framed))
+
+
+def encode_payload(obj: dict) -> bytes:
+    """
+    Encodes a message's JSON, without any framing. (See frame_payload)
+    """
+    return json.dumps(obj).encode("utf-8")
+
+
+def frame_payload(payload: bytes, framed: bool) -> bytes:
+    """
+    Adds the length header to an encoded message, if framed.
+    """
+    if framed:
+        return HEADER.pack(len(payload)) + payload
+    return payload
+
+
+def encode_message(obj: dict, framed: bool) -> bytes:
+    """
+    Encodes a message for sending. (With a length header, if framed.)
+    """
+    return frame_payload(encode_payload(obj), framed)
+
+
+def negotiate(stream: MessageStream, version: int = PROTOCOL_VERSION) -> int:
+    """
+    Asks the server to switch to (at most) the given protocol version. Only call this right after
+    connecting, before any other requests are sent.
+
+    Returns:
+        int: The version that was agreed on. (Also set on the stream.)
+    """
+    stream.send_obj({"type": "HELLO", "version": version})
+    reply = stream.recv_obj()
+    if reply is None:
+        raise ConnectionError("Server closed the connection during the handshake")
+    if reply.get("type") == "HELLO":
+        stream.version = int(reply["version"])
+    else:
+        stream.version = LEGACY_VERSION  # an old server that doesn't know HELLO
+    return stream.version
@@ -1,23 +1,43 @@
-import json
+import hashlib
+import secrets
+import shutil
 import socket
 import threading
-import shutil
-from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from pathlib import Path
-from time import sleep
-from typing import Optional, Tuple
+from time import sleep, time
+from typing import BinaryIO, Callable, Hashable, List, Optional, Tuple, Union
 
+from csc317_final_project.protocol import (
+    LEGACY_VERSION,
+    PROTOCOL_VERSION,
+    MessageStream,
+    ProtocolError,
+)
+from csc317_final_project.server.cache import ResponseCache, SegmentCache
 from csc317_final_project.server.db import Database
-from csc317_final_project.server.ffmpeg import process_video
+from csc317_final_project.server.event_loop import ENGINES, EventLoop
 from csc317_final_project.server.fs import (
-    get_original_video_path,
+    get_partial_upload_path,
     get_segment_path,
     get_video_root_path,
 )
+from csc317_final_project.server.hashing import PasswordHasher
+from csc317_final_project.server.ingest import LIVE_QUALITY, LiveIngest
+from csc317_final_project.server.jobs import JobQueue, JobRunner, TranscodeJobs
+from csc317_final_project.server.migrations import migrate
+from csc317_final_project.server.pack import PackStore
 from csc317_final_project.server.quality import VideoQuality
+from csc317_final_project.server.scheduler import EncodeScheduler
 
 SEGMENT_SIZE = 4096
+MIN_CHUNK_SIZE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+MAX_RANGE_SEGMENTS = 64  # ~3 minutes of video per VIDEO_RANGE request
+UPLOAD_SWEEP_INTERVAL = (
+    60 * 60.0
+)  # seconds between looking for abandoned chunked uploads
 
 logger = getLogger(__name__)
 
@@ -31,19 +51,104 @@ class ClientState:
         self.conn = conn
         self.addr = addr
         self.username = None
+        # all messages (and raw file data) go through here, see protocol.py
+        self.stream = MessageStream(conn)
 
 
 class Server:
     def __init__(
-        self, server_path: Path, host: str = "0.0.0.0", port: int = 2121
+        self,
+        server_path: Path,
+        host: str = "0.0.0.0",
+        port: int = 2121,
+        engine: str = "threads",
+        segment_cache_size: int = 256 * 1024 * 1024,
+        pack_segments: bool = False,
+        single_pass: bool = False,
+        chunk_length: Optional[float] = None,
+        job_concurrency: Optional[int] = None,
+        external_workers: bool = False,
+        encode_cpus: Optional[int] = None,
+        threads_per_encode: int = 2,
+        live_encode: bool = False,
+        hash_workers: int = 2,
+        max_pending_hashes: int = 16,
+        response_cache_size: int = 16 * 1024 * 1024,
+        response_cache_ttl: float = 30,
+        upload_ttl: float = 24 * 60 * 60,
     ) -> None:
+        """
+        Args:
+            server_path (Path): The path to the server directory.
+            host (str): The host to listen on.
+            port (int): The port to listen on.
+            engine (str): How client connections are handled. "threads" spawns a thread per client,
+                "selectors" multiplexes every client on a single event loop. (See event_loop.py)
+            segment_cache_size (int): How many bytes of segments to keep in memory. 0 disables the cache.
+            pack_segments (bool): Whether to store newly processed videos as packs, instead of a file per segment. (See pack.py)
+            single_pass (bool): Whether to convert every quality of a video in a single FFmpeg run. (See ffmpeg.py)
+            chunk_length (Optional[float]): If set, long videos are split into chunks of this many seconds,
+                which are converted in parallel. (See ffmpeg.py)
+            job_concurrency (Optional[int]): How many transcoding jobs to run at once. (See jobs.py)
+                Defaults to the number of encode slots.
+            external_workers (bool): Whether to leave transcoding to separate worker processes (see worker.py),
+                instead of running the jobs in this process.
+            encode_cpus (Optional[int]): How many cores FFmpeg may use. (Defaults to all of them, see scheduler.py)
+            threads_per_encode (int): How many threads each FFmpeg run gets.
+            live_encode (bool): Whether to convert the lowest quality of streamable uploads while they're still
+                being uploaded. (See ingest.py)
+            hash_workers (int): How many processes hash passwords. (See hashing.py)
+            max_pending_hashes (int): How many password hashes may wait at once, before logins are turned away.
+            response_cache_size (int): How many bytes of USERS, VIDEO_PAGE and VIDEO_INFO responses to keep in memory.
+                0 disables the cache. (See cache.py)
+            response_cache_ttl (float): How many seconds a cached response is kept for, at most.
+            upload_ttl (float): How many seconds a chunked upload is kept for without a new chunk, before it's
+                thrown away as abandoned. (See sweep_uploads)
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {ENGINES}")
         self.host = host
         self.port = port
         self.path = server_path
-        self.db = Database(server_path)
-        self.worker_pool = ThreadPoolExecutor(
-            max_workers=8, thread_name_prefix="worker"
-        )
+        self.engine = engine
+        applied = migrate(server_path)
+        if applied:
+            logger.info(f"Applied {len(applied)} database migrations")
+        self.hasher = PasswordHasher(hash_workers, max_pending_hashes)
+        self.db = Database(server_path, self.hasher)
+        for problem in self.db.check_query_plans():
+            logger.warning(
+                f"Listing query scans a whole table, is an index missing? {problem}"
+            )
+        self.segment_cache = SegmentCache(segment_cache_size)
+        self.response_cache = ResponseCache(response_cache_size, response_cache_ttl)
+        self.db.on_change = self.response_cache.invalidate
+        self.packs = PackStore(server_path)
+        self.pack_segments = pack_segments
+        self.single_pass = single_pass
+        self.chunk_length = chunk_length
+        self.threads_per_encode = threads_per_encode
+        self.live_encode = live_encode
+        self.upload_ttl = upload_ttl
+        # transcoding goes through a queue in the database, so nothing's lost if we go down
+        self.jobs = JobQueue(server_path)
+        self.encoder: Optional[EncodeScheduler] = None
+        self.job_runner: Optional[JobRunner] = None
+        if not external_workers:
+            self.encoder = EncodeScheduler(encode_cpus, threads_per_encode)
+            self.job_runner = JobRunner(
+                self.jobs,
+                TranscodeJobs(
+                    self.jobs,
+                    self.db,
+                    server_path,
+                    self.encoder,
+                    pack_segments,
+                    single_pass,
+                    chunk_length,
+                ).handlers,
+                job_concurrency or self.encoder.slots,
+            )
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         while True:
             try:
@@ -59,60 +164,167 @@ class Server:
         """
         Start the server and listen for incoming connections.
 
-        This method will run indefinitely, accepting new connections and spawning a new thread for each client.
+        This method will run indefinitely, accepting new connections and either spawning a new thread for each client,
+        or handing them to the event loop (depending on the engine).
         """
         self.server.listen()
-        logger.info(f"Server is listening on HOST = {self.host}, PORT = {self.port}")
+        if self.job_runner is not None:
+            # (picks up anything that was left in the queue last time, too)
+            self.job_runner.start()
+        threading.Thread(
+            target=self.sweep_uploads_forever, name="upload-sweeper", daemon=True
+        ).start()
+        logger.info(
+            f"Server is listening on HOST = {self.host}, PORT = {self.port} (engine = {self.engine})"
+        )
         try:
-            while True:
-                conn, addr = self.server.accept()
-                logger.debug(f"Accepted connection from {addr}")
-                client_state = ClientState(conn, addr)
-                thread = threading.Thread(
-                    target=self.handle_client, args=(client_state,), daemon=True
-                )
-                thread.start()
+            if self.engine == "selectors":
+                EventLoop(self, ClientState).run()
+            else:
+                while True:
+                    conn, addr = self.server.accept()
+                    logger.debug(f"Accepted connection from {addr}")
+                    client_state = ClientState(conn, addr)
+                    thread = threading.Thread(
+                        target=self.handle_client, args=(client_state,), daemon=True
+                    )
+                    thread.start()
         except KeyboardInterrupt:
             logger.info("Server shutting down...")
         finally:
             self.server.close()
             logger.info("Server socket closed.")
-            logger.info("Shutting down worker pool...")
-            self.worker_pool.shutdown(wait=True)
-            logger.info("Worker pool shut down.")
+            self.hasher.shutdown(wait=False)
+            if self.job_runner is not None and self.encoder is not None:
+                logger.info("Waiting for running jobs...")
+                self.job_runner.stop()
+                self.encoder.shutdown(wait=True)
+                logger.info("Jobs stopped.")
 
-    def handle_client(self, client: ClientState) -> None:
+    def queue_video(self, video_id: int) -> None:
         """
-        Handle a client connection.
+        Queue a video to be processed. (By us, or by a worker process.)
+        """
+        self.jobs.enqueue_video(video_id)
+        if self.job_runner is not None:
+            self.job_runner.wake()
+
+    def sweep_uploads(self) -> None:
         """
+        Throw away chunked uploads that haven't had a new chunk in upload_ttl seconds, along with their files.
+        (Also any upload files the database has forgotten about, say from a commit that was interrupted.)
+        """
+        cutoff = time() - self.upload_ttl
+        for upload_id in self.db.get_old_chunked_uploads(self.upload_ttl):
+            partial_upload = get_partial_upload_path(self.path, upload_id)
+            try:
+                if partial_upload.stat().st_mtime > cutoff:
+                    continue  # old, but still going
+            except FileNotFoundError:
+                pass
+            logger.info(f"Throwing away abandoned upload {upload_id}")
+            self.db.finish_chunked_upload(upload_id)
+            partial_upload.unlink(missing_ok=True)
+        for partial_upload in (self.path / "uploads").glob("*.part"):
+            if (
+                partial_upload.stat().st_mtime < cutoff
+                and self.db.get_chunked_upload(partial_upload.stem) is None
+            ):
+                logger.info(f"Throwing away leftover upload file {partial_upload}")
+                partial_upload.unlink(missing_ok=True)
 
+    def sweep_uploads_forever(self) -> None:
+        """
+        Sweep abandoned uploads every UPLOAD_SWEEP_INTERVAL seconds, starting now. (Runs on its own thread.)
+        """
         while True:
-            packet = client.conn.recv(SEGMENT_SIZE).decode("utf-8")
-            if not packet:
-                break
-            recieved_obj = json.loads(packet)
-            logger.debug(f"Received message from {client.addr}: {recieved_obj}")
             try:
-                to_client = self.handle_command(client, recieved_obj)
-                if to_client:
-                    logger.debug(f"Sending message to {client.addr}: {to_client}")
-                    send_obj(client.conn, to_client)
+                self.sweep_uploads()
             except Exception as e:
-                logger.error(f"Error handling command for client {client.addr}: {e}")
-                send_obj(
-                    client.conn,
-                    {
-                        "type": "ERROR",
-                        "message": str(e),
-                    },
-                )
+                logger.error(f"Couldn't sweep abandoned uploads: {e}")
+            sleep(UPLOAD_SWEEP_INTERVAL)
+
+    def get_own_upload(self, client: ClientState, upload_id: str) -> dict:
+        """
+        Get one of the client's chunked uploads, raising if it doesn't exist (or isn't theirs).
+        """
+        if client.username is None:
+            raise Exception("Client not logged in")
+        upload_info = self.db.get_chunked_upload(str(upload_id))
+        if upload_info is None or upload_info["author"] != client.username:
+            raise FileNotFoundError(f"Upload {upload_id} not found")
+        return upload_info
+
+    def handle_client(self, client: ClientState) -> None:
+        """
+        Handle a client connection.
+        """
+
+        try:
+            while True:
+                recieved_obj = client.stream.recv_obj()
+                if recieved_obj is None:
+                    break
+                self.respond(client, recieved_obj)
+        except (OSError, ProtocolError) as e:
+            logger.debug(f"Connection to {client.addr} broke: {e}")
 
         client.conn.close()
 
-    def handle_command(self, client: ClientState, recieved_obj: dict) -> Optional[dict]:
+    def respond(self, client: ClientState, recieved_obj: dict) -> None:
+        """
+        Handle a single message from a client, sending back the response (or an error).
+        """
+        logger.debug(f"Received message from {client.addr}: {recieved_obj}")
+        try:
+            to_client = self.handle_command(client, recieved_obj)
+            if isinstance(to_client, bytes):
+                # (a cached response, already encoded)
+                logger.debug(f"Sending message to {client.addr}: {to_client!r}")
+                client.stream.send_payload(to_client)
+            elif to_client:
+                logger.debug(f"Sending message to {client.addr}: {to_client}")
+                client.stream.send_obj(to_client)
+        except Exception as e:
+            logger.error(f"Error handling command for client {client.addr}: {e}")
+            client.stream.send_obj(
+                {
+                    "type": "ERROR",
+                    "message": str(e),
+                },
+            )
+
+    def cached_response(
+        self,
+        recieved_obj: dict,
+        key: Hashable,
+        tags: List[str],
+        make_response: Callable[[], dict],
+    ) -> Union[dict, bytes]:
+        """
+        Get a response through the response cache (see ResponseCache.get). If the client already has this version of
+        it (they sent it as "if_version"), just tell them it's not changed.
+        """
+        response = self.response_cache.get(key, tags, make_response)
+        if recieved_obj.get("if_version") == response.version:
+            return {"type": "NOT_MODIFIED", "version": response.version}
+        return response.payload
+
+    def handle_command(
+        self, client: ClientState, recieved_obj: dict
+    ) -> Optional[Union[dict, bytes]]:
         # handling to upload, modify videos
         # data handling for clients gui and actions below
-        if recieved_obj["type"] == "LOGIN":
+        if recieved_obj["type"] == "HELLO":
+            # protocol negotiation - we answer in the old version, then both sides switch
+            version = max(
+                LEGACY_VERSION, min(int(recieved_obj["version"]), PROTOCOL_VERSION)
+            )
+            client.stream.send_obj({"type": "HELLO", "version": version})
+            client.stream.version = version
+            return None
+
+        elif recieved_obj["type"] == "LOGIN":
             self.db.login(
                 recieved_obj["username"],
                 recieved_obj["password"],
@@ -152,20 +364,58 @@ class Server:
 
         elif recieved_obj["type"] == "USERS":
             # get the users from the database
+            # (listings get asked for far more often than they change, so they're cached, see ResponseCache)
+            if "cursor" in recieved_obj:
+                # (newer clients page with cursors, which stay fast however far in they go)
+                cursor = recieved_obj["cursor"]
+                return self.cached_response(
+                    recieved_obj,
+                    ("USERS", "cursor", cursor),
+                    ["users"],
+                    lambda: self.db.get_users_after(cursor),
+                )
             page_num = recieved_obj["page_num"]
-            users = self.db.get_users_page(page_num)
-            return users
+            return self.cached_response(
+                recieved_obj,
+                ("USERS", "page", page_num),
+                ["users"],
+                lambda: self.db.get_users_page(page_num),
+            )
 
         elif recieved_obj["type"] == "VIDEO":
             # segments - download!!
-            return download(
-                client.conn,
-                get_segment_path(
-                    self.path,
-                    recieved_obj["video_id"],
-                    VideoQuality(recieved_obj["quality"]),
-                    recieved_obj["segment_id"],
-                ),
+            return download_segment(
+                client.stream,
+                self.path,
+                self.segment_cache,
+                self.packs,
+                recieved_obj["video_id"],
+                VideoQuality(recieved_obj["quality"]),
+                recieved_obj["segment_id"],
+            )
+
+        elif recieved_obj["type"] == "VIDEO_RANGE":
+            # lots of segments at once - download!!!
+            if client.stream.download_needs_ack:
+                raise Exception("VIDEO_RANGE needs protocol version 3 or newer")
+            if "segment_ids" in recieved_obj:
+                segment_ids = [int(i) for i in recieved_obj["segment_ids"]]
+            else:
+                segment_ids = list(
+                    range(recieved_obj["start_segment"], recieved_obj["end_segment"])
+                )
+            if len(segment_ids) > MAX_RANGE_SEGMENTS:
+                raise Exception(
+                    f"Too many segments requested at once (max {MAX_RANGE_SEGMENTS})"
+                )
+            return download_range(
+                client.stream,
+                self.path,
+                self.segment_cache,
+                self.packs,
+                recieved_obj["video_id"],
+                VideoQuality(recieved_obj["quality"]),
+                segment_ids,
             )
 
         elif recieved_obj["type"] == "UPLOAD":
@@ -179,23 +429,158 @@ class Server:
             video_root = get_video_root_path(self.path, str(video_id))
             video_root.mkdir(parents=True, exist_ok=True)
             original_video = video_root / f"original{file_ext}"
-            upload(client.conn, original_video, file_size)
-            self.worker_pool.submit(
-                process_video, self.worker_pool, self.db, original_video, video_id
+            live = None
+            if self.live_encode:
+                live = LiveIngest(
+                    file_ext,
+                    video_root / str(LIVE_QUALITY),
+                    video_id,
+                    self.threads_per_encode,
+                    self.encoder,
+                )
+            try:
+                content_hash = upload(
+                    client.stream,
+                    original_video,
+                    file_size,
+                    live.feed if live is not None else None,
+                )
+            except BaseException:
+                if live is not None:
+                    live.abort()
+                # don't leave half a video lying around
+                self.db.delete(str(video_id))
+                shutil.rmtree(video_root, ignore_errors=True)
+                raise
+            if live is not None and live.finish():
+                try:
+                    live.publish(self.db, original_video, self.pack_segments)
+                except Exception as e:
+                    # no harm done, the job will convert it again
+                    logger.error(
+                        f"Couldn't publish live encode of video {video_id}: {e}"
+                    )
+            self.db.set_content_hash(video_id, content_hash)
+            self.queue_video(video_id)
+            return {"success": True, "video_id": video_id}
+
+        elif recieved_obj["type"] == "UPLOAD_INIT":
+            # chunked (resumable) upload - step 1, see the README
+            if client.username is None:
+                raise Exception("Client not logged in")
+            file_size = int(recieved_obj["file_size"])
+            if file_size <= 0:
+                raise ValueError("Can't upload an empty file")
+            chunk_size = min(
+                max(
+                    int(recieved_obj.get("chunk_size", DEFAULT_CHUNK_SIZE)),
+                    MIN_CHUNK_SIZE,
+                ),
+                MAX_CHUNK_SIZE,
             )
+            upload_id = secrets.token_hex(16)
+            partial_upload = get_partial_upload_path(self.path, upload_id)
+            partial_upload.parent.mkdir(parents=True, exist_ok=True)
+            with partial_upload.open("wb") as f:
+                # chunks can arrive in any order, so the file's full size from the start (sparse, if possible)
+                f.truncate(file_size)
+            self.db.start_chunked_upload(
+                upload_id,
+                client.username,
+                recieved_obj["title"],
+                Path(recieved_obj["target"]).suffix,
+                file_size,
+                chunk_size,
+            )
+            return get_upload_status(self.get_own_upload(client, upload_id))
+
+        elif recieved_obj["type"] == "UPLOAD_STATUS":
+            return get_upload_status(
+                self.get_own_upload(client, recieved_obj["upload_id"])
+            )
+
+        elif recieved_obj["type"] == "UPLOAD_CHUNK":
+            # the chunk's bytes follow straight away, so whatever happens, they have to be read
+            size = int(recieved_obj["size"])
+            try:
+                upload_info = self.get_own_upload(client, recieved_obj["upload_id"])
+                if upload_info["committing"]:
+                    raise ValueError("Upload is already being committed")
+                chunk = int(recieved_obj["chunk"])
+                offset = chunk * upload_info["chunk_size"]
+                if not 0 <= offset < upload_info["file_size"]:
+                    raise ValueError(f"Chunk {chunk} is out of range")
+                expected_size = min(
+                    upload_info["chunk_size"], upload_info["file_size"] - offset
+                )
+                if size != expected_size:
+                    raise ValueError(
+                        f"Chunk {chunk} should be {expected_size} bytes, not {size}"
+                    )
+            except Exception:
+                discard(client.stream, size)
+                raise
+            digest = receive_chunk(
+                client.stream,
+                get_partial_upload_path(self.path, upload_info["id"]),
+                offset,
+                size,
+            )
+            if digest != str(recieved_obj["sha256"]).lower():
+                raise ValueError(f"Chunk {chunk} failed its checksum, send it again")
+            self.db.mark_chunk_received(upload_info["id"], chunk, digest)
+            return {
+                "type": "UPLOAD_CHUNK",
+                "upload_id": upload_info["id"],
+                "chunk": chunk,
+                "success": True,
+            }
+
+        elif recieved_obj["type"] == "UPLOAD_COMMIT":
+            upload_info = self.get_own_upload(client, recieved_obj["upload_id"])
+            status = get_upload_status(upload_info)
+            missing = status["num_chunks"] - len(status["received"])
+            if missing:
+                raise Exception(f"Upload is still missing {missing} chunks")
+            # a client retrying a commit it thinks was lost can send it twice at once, only one of them gets past here
+            if not self.db.claim_chunked_upload(upload_info["id"]):
+                raise Exception("Upload is already being committed")
+            partial_upload = get_partial_upload_path(self.path, upload_info["id"])
+            video_id = None
+            try:
+                video_id = self.db.start_upload_video(
+                    upload_info["title"], upload_info["author"]
+                )
+                video_root = get_video_root_path(self.path, str(video_id))
+                video_root.mkdir(parents=True, exist_ok=True)
+                original_video = video_root / f"original{upload_info['extension']}"
+                partial_upload.replace(original_video)
+                try:
+                    self.db.finish_chunked_upload(upload_info["id"])
+                except Exception:
+                    original_video.replace(partial_upload)
+                    raise
+            except Exception:
+                # put everything back, so the commit can be tried again (and no half made video is left behind)
+                if video_id is not None:
+                    self.db.delete(video_id)
+                    shutil.rmtree(
+                        get_video_root_path(self.path, str(video_id)),
+                        ignore_errors=True,
+                    )
+                self.db.release_chunked_upload(upload_info["id"])
+                raise
+            # (the video's job hashes it, see TranscodeJobs.run_video)
+            self.queue_video(video_id)
             return {"success": True, "video_id": video_id}
 
         elif recieved_obj["type"] == "DBG_REPROCESS_VIDEO":
             # debug - reprocess video
             video_id = recieved_obj["video_id"]
             video_root = get_video_root_path(self.path, str(video_id))
-            # hide the video
-            self.db.update_video_info(
-                video_id,
-                -1,
-                -1,
-                -1,
-            )
+            self.jobs.cancel_video(video_id)
+            # hide the video (until its lowest quality is ready again)
+            self.db.clear_renditions(video_id)
             # remove all files except the original video
             for file in video_root.glob("*"):
                 if "original" not in file.name:
@@ -205,39 +590,109 @@ class Server:
                         file.rmdir()
                     else:
                         file.unlink()
-            original_video = get_original_video_path(self.path, str(video_id))
-            self.worker_pool.submit(
-                process_video, self.worker_pool, self.db, original_video, video_id
-            )
+            self.segment_cache.invalidate_video(video_id)
+            self.packs.invalidate_video(video_id)
+            self.queue_video(video_id)
             return {"success": True}
 
         elif recieved_obj["type"] == "VIDEO_INFO":
             # get the video info from the database
             video_id = recieved_obj["video_id"]
-            video_info = self.db.get_video_info(video_id)
-            return video_info
+
+            def get_video_info() -> dict:
+                video_info = self.db.get_video_info(video_id)
+                if video_info is None:
+                    # every request needs a response, or pipelined requests get out of step
+                    # (and raising here means it's not cached, so the video can still show up)
+                    raise FileNotFoundError(f"Video {video_id} not found")
+                return video_info
+
+            return self.cached_response(
+                recieved_obj,
+                ("VIDEO_INFO", str(video_id)),
+                [f"video/{video_id}"],
+                get_video_info,
+            )
 
         elif recieved_obj["type"] == "VIDEO_PAGE":
             # get the videos from the database
-            page_num = recieved_obj["page_num"]
             author = recieved_obj.get("author", None)
-            videos = self.db.get_video_page(page_num, author)
-            return videos
+            # (include_info adds each video's length, segments and qualities, saving a VIDEO_INFO per video)
+            include_info = bool(recieved_obj.get("include_info", False))
+            tags = [f"videos/{author}"]
+
+            def get_videos(videos: dict) -> dict:
+                return self.db.add_video_infos(videos) if include_info else videos
+
+            if "cursor" in recieved_obj:
+                cursor = recieved_obj["cursor"]
+                return self.cached_response(
+                    recieved_obj,
+                    ("VIDEO_PAGE", author, include_info, "cursor", cursor),
+                    tags,
+                    lambda: get_videos(self.db.get_videos_after(cursor, author)),
+                )
+            page_num = recieved_obj["page_num"]
+            return self.cached_response(
+                recieved_obj,
+                ("VIDEO_PAGE", author, include_info, "page", page_num),
+                tags,
+                lambda: get_videos(self.db.get_video_page(page_num, author)),
+            )
+
+        elif recieved_obj["type"] == "VIDEO_INFO_MULTI":
+            # get the info of several videos at once
+            video_ids = [int(video_id) for video_id in recieved_obj["video_ids"]]
+
+            def get_video_infos() -> dict:
+                infos = self.db.get_video_infos(video_ids)
+                found = {info["id"] for info in infos}
+                return {
+                    "type": "VIDEO_INFOS",
+                    "result": infos,
+                    "missing": [
+                        video_id for video_id in video_ids if video_id not in found
+                    ],
+                }
+
+            return self.cached_response(
+                recieved_obj,
+                ("VIDEO_INFO_MULTI", tuple(video_ids)),
+                # (a missing video's tag still gets invalidated once it's processed)
+                [f"video/{video_id}" for video_id in video_ids],
+                get_video_infos,
+            )
 
         elif recieved_obj["type"] == "DELETE":
             # remove video from database and remove folder
             video_id = recieved_obj["video_id"]
-            video_path = get_video_root_path(self.path, video_id)
+            video_path = get_video_root_path(self.path, str(video_id))
 
             try:
                 if video_path.exists():
+                    self.jobs.cancel_video(video_id)
                     self.db.delete(video_id)
                     shutil.rmtree(video_path)
+                    self.segment_cache.invalidate_video(video_id)
+                    self.packs.invalidate_video(video_id)
                     return {"success": True}
                 else:
                     raise FileNotFoundError(f"Video path {video_path} not found")
             except Exception as e:
                 logger.error(f"Error deleting video {video_id}, {e}")
+                raise
+
+        elif recieved_obj["type"] == "DBG_STATS":
+            # debug - server counters
+            return {
+                "type": "STATS",
+                "segment_cache": self.segment_cache.stats(),
+                "jobs": self.jobs.stats(),
+                "running_jobs": self.jobs.running_jobs(),
+                "encoder": self.encoder.stats() if self.encoder is not None else None,
+                "passwords": self.hasher.stats(),
+                "response_cache": self.response_cache.stats(),
+            }
 
         else:
             raise NotImplementedError(
@@ -245,85 +700,400 @@ class Server:
             )
 
 
-def upload(conn: socket.socket, file_path: Path, file_size: int) -> None:
+def upload(
+    stream: MessageStream,
+    file_path: Path,
+    file_size: int,
+    on_data: Optional[Callable[[bytes], None]] = None,
+) -> str:
     """
-    Handle file upload from client.
+    Handle file upload from client. The file's hashed as it's received. (See dedup.py)
+
+    Args:
+        stream (MessageStream): The client's stream.
+        file_path (Path): Where to save the file.
+        file_size (int): The size of the file in bytes.
+        on_data (Optional[Callable]): Also called with every chunk of the file as it's received. (See ingest.py)
+
+    Returns:
+        str: The file's SHA-256 hash (as hex).
     """
 
-    send_obj(conn, {"type": "ACK"})
+    stream.send_obj({"type": "ACK"})
+    digest = hashlib.sha256()
     completed = 0
     with file_path.open("wb") as f:
         while completed < file_size:
-            data = conn.recv(SEGMENT_SIZE)
+            data = stream.recv_raw(min(SEGMENT_SIZE, file_size - completed))
+            if not data:
+                raise ConnectionError("Client disconnected during upload")
             f.write(data)
+            digest.update(data)
+            if on_data is not None:
+                on_data(data)
             completed += len(data)
     logger.debug(
-        f"File with name {file_path.name} by the user {conn.getpeername()[0]} uploaded to the server."
+        f"File with name {file_path.name} by the user {stream.conn.getpeername()[0]} uploaded to the server."
     )
+    return digest.hexdigest()
 
 
-def download(conn: socket.socket, file_path: Path) -> None:
+def get_upload_status(upload_info: dict) -> dict:
+    """
+    Get the status of a chunked upload, as sent to the client. The offset is how much of the file (from the start)
+    has been received, so the client can resume from there. (Later chunks may have arrived already, too.)
+    """
+    num_chunks = -(-upload_info["file_size"] // upload_info["chunk_size"])
+    received = upload_info["received"]
+    contiguous = 0
+    while contiguous < len(received) and received[contiguous] == contiguous:
+        contiguous += 1
+    return {
+        "type": "UPLOAD_STATUS",
+        "upload_id": upload_info["id"],
+        "file_size": upload_info["file_size"],
+        "chunk_size": upload_info["chunk_size"],
+        "num_chunks": num_chunks,
+        "received": received,
+        "offset": min(contiguous * upload_info["chunk_size"], upload_info["file_size"]),
+    }
+
+
+def receive_chunk(
+    stream: MessageStream, file_path: Path, offset: int, size: int
+) -> str:
+    """
+    Receive one chunk of a chunked upload, writing it into place.
+
+    Args:
+        stream (MessageStream): The client's stream.
+        file_path (Path): The partially uploaded file.
+        offset (int): Where the chunk goes in the file.
+        size (int): The size of the chunk in bytes.
+
+    Returns:
+        str: The chunk's SHA-256 hash (as hex).
+    """
+    digest = hashlib.sha256()
+    # every chunk gets its own handle, so chunks coming in on other connections can be written at the same time
+    with file_path.open("r+b") as f:
+        f.seek(offset)
+        remaining = size
+        while remaining > 0:
+            data = stream.recv_raw(min(65536, remaining))
+            if not data:
+                raise ConnectionError("Client disconnected during upload")
+            f.write(data)
+            digest.update(data)
+            remaining -= len(data)
+    return digest.hexdigest()
+
+
+def discard(stream: MessageStream, size: int) -> None:
+    """
+    Read (and throw away) raw data the client sent, so the next message lines up.
+    """
+    while size > 0:
+        data = stream.recv_raw(min(65536, size))
+        if not data:
+            raise ConnectionError("Client disconnected")
+        size -= len(data)
+
+
+def download(
+    stream: MessageStream,
+    file_path: Path,
+    extra_header: Optional[dict] = None,
+    contents: Optional[memoryview] = None,
+) -> None:
     """
     Handle file download to client.
+
+    Args:
+        stream (MessageStream): The client's stream.
+        file_path (Path): The file to send.
+        extra_header (Optional[dict]): Any extra fields to send in the DOWNLOAD header.
+        contents (Optional[memoryview]): The file's contents, if they're already in memory. (Skips the disk entirely.)
     """
 
-    # personally, i love the pathlib api
-    # so im using it because there's enough to worry about already
-    if not file_path.is_file():  # also checks if it exists
-        # we can't send!!!
-        raise FileNotFoundError(f"File not found at target path {file_path}")
+    if contents is not None:
+        file_size = len(contents)
+    else:
+        # personally, i love the pathlib api
+        # so im using it because there's enough to worry about already
+        if not file_path.is_file():  # also checks if it exists
+            # we can't send!!!
+            raise FileNotFoundError(f"File not found at target path {file_path}")
 
-    # we can send! first lets get the file size
-    file_size = file_path.stat().st_size
+        # we can send! first lets get the file size
+        file_size = file_path.stat().st_size
     # and we're gonna be sending the file :>
     # since the client's a bit weird, we'll be sending a json object
     # (which the client will hopefully pick up on)
     # and then the file itself once the client's ready.
-    send_obj(
-        conn,
+    # (newer clients are always ready, so they don't get to wait for the round trip)
+    stream.send_obj(
         {
             "type": "DOWNLOAD",
             "target": file_path.name,
             "file_size": file_size,
+            **(extra_header or {}),
         },
     )
 
-    ack = json.loads(conn.recv(SEGMENT_SIZE))  # check for ACK from client
-    if ack != {"type": "ACK"}:
-        raise RuntimeError(f"Client did not acknowledge file transfer. Received: {ack}")
+    if stream.download_needs_ack:
+        ack = stream.recv_obj()  # check for ACK from client
+        if ack != {"type": "ACK"}:
+            raise RuntimeError(
+                f"Client did not acknowledge file transfer. Received: {ack}"
+            )
 
     # now we can send the file
-    with open(file_path, "rb") as file:
-        while True:
-            data = file.read(SEGMENT_SIZE)
-            if not data:
-                break
-            conn.sendall(data)
+    if contents is not None:
+        stream.conn.sendall(contents)
+    else:
+        with open(file_path, "rb") as file:
+            send_file(stream.conn, file, file_size)
 
     # and we're done, the client will know when we're done (because of the file_size we sent earlier)
     logger.debug(
-        f"File {file_path} sent to client @ {conn.getpeername()[0]}"
+        f"File {file_path} sent to client @ {stream.conn.getpeername()[0]}"
     )  # this is the ip of the client, not the server
 
 
-def send_obj(conn: socket.socket, obj: dict) -> None:
+def download_segment(
+    stream: MessageStream,
+    server_path: Path,
+    cache: SegmentCache,
+    packs: PackStore,
+    video_id: int,
+    quality: VideoQuality,
+    segment_id: int,
+    extra_header: Optional[dict] = None,
+) -> None:
     """
-    Sends a JSON object to the client.
+    Handle downloading a segment to the client.
+    Packed segments are sent straight out of the pack, anything else goes through the segment cache.
     """
+    segment_path = get_segment_path(server_path, video_id, quality, segment_id)
+    pack = packs.get(str(video_id), quality)
+    if pack is None:
+        contents = cache.load(
+            (str(video_id), int(quality), int(segment_id)), segment_path
+        )
+        try:
+            download(stream, segment_path, extra_header, contents)
+            return
+        except FileNotFoundError:
+            # the quality might have been packed since we last looked (which removes the loose segments)
+            pack = packs.get(str(video_id), quality, recheck=True)
+            if pack is None:
+                raise
+    download(stream, segment_path, extra_header, pack.view(int(segment_id)))
+
+
+def download_range(
+    stream: MessageStream,
+    server_path: Path,
+    cache: SegmentCache,
+    packs: PackStore,
+    video_id: int,
+    quality: VideoQuality,
+    segment_ids: List[int],
+) -> dict:
+    """
+    Handle downloading several segments to the client in one go.
+
+    Each segment gets its own DOWNLOAD header (with its segment_id) followed by its bytes, with no ACKs.
+    Stops early at the first segment that doesn't exist. Since everything's sent with blocking sends,
+    we only go as fast as the client reads.
+
+    Returns:
+        dict: The VIDEO_RANGE_END message, to send after the last segment.
+    """
+    sent = 0
+    for segment_id in segment_ids:
+        try:
+            download_segment(
+                stream,
+                server_path,
+                cache,
+                packs,
+                video_id,
+                quality,
+                segment_id,
+                {"segment_id": segment_id},
+            )
+        except FileNotFoundError:
+            # (nothing gets sent for a missing segment, so the client's still in step)
+            return {
+                "type": "VIDEO_RANGE_END",
+                "segments_sent": sent,
+                "message": f"Segment {segment_id} not found",
+            }
+        except ConnectionError:
+            logger.debug(
+                f"Client went away after {sent} of {len(segment_ids)} segments of video {video_id}"
+            )
+            raise
+        sent += 1
+    return {"type": "VIDEO_RANGE_END", "segments_sent": sent}
+
+
+def send_file(conn: socket.socket, file: BinaryIO, count: int, offset: int = 0) -> None:
+    """
+    Sends count bytes of an open file (starting at offset) over a socket.
+
+    Uses sendfile, so the data goes straight from the page cache to the socket without being copied
+    through python. Falls back to reading and sending it ourselves if the socket can't do that.
+    """
+    try:
+        # socket.sendfile already falls back on its own if os.sendfile isn't there,
+        # or if the file isn't a regular file (which we don't need to worry about)
+        conn.sendfile(file, offset, count)
+    except ValueError:
+        # non-blocking sockets can't sendfile
+        file.seek(offset)
+        buffered_send_file(conn, file, count)
+
 
-    json_obj = json.dumps(obj)
-    conn.sendall(json_obj.encode("utf-8"))
+def buffered_send_file(
+    conn: socket.socket, file: BinaryIO, count: int, chunk_size: int = 65536
+) -> None:
+    """
+    Sends count bytes of an open file (from its current position) over a socket, a chunk at a time.
+    """
+    remaining = count
+    while remaining > 0:
+        data = file.read(min(chunk_size, remaining))
+        if not data:
+            raise EOFError(f"File ended {remaining} bytes early")
+        conn.sendall(data)
+        remaining -= len(data)
 
 
 def main():
+    import argparse
     import logging
 
+    parser = argparse.ArgumentParser(description="Run the video server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=2121)
+    parser.add_argument("--data-dir", type=Path, default=Path("server_data"))
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="threads",
+        help="threads: one thread per client, selectors: one event loop for every client",
+    )
+    parser.add_argument(
+        "--segment-cache-mb",
+        type=int,
+        default=256,
+        help="memory budget for cached segments (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--pack-segments",
+        action="store_true",
+        help="store newly processed videos as one pack file per quality",
+    )
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="decode each upload once and encode every quality but the lowest from that, instead of a run per quality (the higher qualities then all show up together, once the slowest is done)",
+    )
+    parser.add_argument(
+        "--chunk-length",
+        type=float,
+        default=None,
+        help="split long uploads into chunks of this many seconds (rounded up to a whole number of segments) and convert them in parallel",
+    )
+    parser.add_argument(
+        "--job-concurrency",
+        type=int,
+        default=None,
+        help="how many transcoding jobs to run at once (defaults to the number of encode slots)",
+    )
+    parser.add_argument(
+        "--encode-cpus",
+        type=int,
+        default=None,
+        help="how many cores FFmpeg may use (defaults to all of them)",
+    )
+    parser.add_argument(
+        "--threads-per-encode",
+        type=int,
+        default=2,
+        help="how many threads each FFmpeg run gets (the cores are split into slots of this size)",
+    )
+    parser.add_argument(
+        "--external-workers",
+        action="store_true",
+        help="don't transcode in the server process, leave the job queue to final_worker processes",
+    )
+    parser.add_argument(
+        "--live-encode",
+        action="store_true",
+        help="convert the lowest quality of streamable uploads (mkv, ts, fragmented mp4...) while they upload",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=2,
+        help="how many processes hash passwords (for LOGIN and REGISTER)",
+    )
+    parser.add_argument(
+        "--max-pending-hashes",
+        type=int,
+        default=16,
+        help="how many logins may wait for a password hash at once, before more are turned away",
+    )
+    parser.add_argument(
+        "--response-cache-mb",
+        type=int,
+        default=16,
+        help="how many MiB of USERS, VIDEO_PAGE and VIDEO_INFO responses to keep in memory (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=30,
+        help="how many seconds a cached response is kept for, at most (bounds how stale final_worker's updates can get)",
+    )
+    parser.add_argument(
+        "--upload-ttl-hours",
+        type=float,
+        default=24,
+        help="how many hours a chunked upload is kept for without a new chunk, before it's thrown away",
+    )
+    parser.add_argument("--log-level", default="DEBUG")
+    args = parser.parse_args()
+
     logging.basicConfig(
         format="%(asctime)s - %(name)s (%(threadName)s) - %(levelname)s - %(message)s",
-        level=logging.DEBUG,
+        level=args.log_level.upper(),
     )
 
-    s = Server(Path("server_data"))
+    s = Server(
+        args.data_dir,
+        args.host,
+        args.port,
+        args.engine,
+        args.segment_cache_mb * 1024 * 1024,
+        args.pack_segments,
+        args.single_pass,
+        args.chunk_length,
+        args.job_concurrency,
+        args.external_workers,
+        args.encode_cpus,
+        args.threads_per_encode,
+        args.live_encode,
+        args.hash_workers,
+        args.max_pending_hashes,
+        args.response_cache_mb * 1024 * 1024,
+        args.response_cache_ttl,
+        args.upload_ttl_hours * 60 * 60,
+    )
     s.start()
 
 
@@ -0,0 +1,253 @@
+"""
+In-memory caches for the server.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
+
+from csc317_final_project.protocol import encode_payload
+
+logger = getLogger(__name__)
+
+SegmentKey = Tuple[str, int, int]  # (video_id, quality, segment_id)
+
+
+class SegmentCache:
+    """
+    A least-recently-used cache of segment contents, bounded by the total size of the cached segments.
+
+    Popular videos get requested by everyone at once (and always from the start), so keeping their segments in
+    memory saves a trip to the disk for nearly every viewer. Cached segments are handed out as memoryviews of the
+    cached bytes, so sending them doesn't copy anything.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: Optional[int] = None) -> None:
+        """
+        Args:
+            max_bytes (int): The memory budget for the cache. 0 disables caching.
+            max_entry_bytes (Optional[int]): Segments bigger than this are never cached. (Defaults to 1/8th of the budget.)
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = (
+            max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        )
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[SegmentKey, bytes]" = OrderedDict()
+        self.size = 0
+        # bumped whenever a video is invalidated, so a read that was already in progress doesn't put stale data back
+        self.generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self, key: SegmentKey, path: Path) -> Optional[memoryview]:
+        """
+        Get a segment from the cache, reading it from the disk (and caching it) on a miss.
+
+        Args:
+            key (SegmentKey): The (video_id, quality, segment_id) of the segment.
+            path (Path): Where the segment lives on the disk.
+
+        Returns:
+            Optional[memoryview]: The segment's contents, or None if it doesn't exist or shouldn't be cached.
+                (In which case, just send it from the disk.)
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return memoryview(data)
+            self.misses += 1
+            generation = self.generations.get(key[0], 0)
+
+        if self.max_bytes <= 0:
+            return None
+        try:
+            if path.stat().st_size > self.max_entry_bytes:
+                return None
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            if (
+                self.generations.get(key[0], 0) == generation
+                and key not in self.entries
+            ):
+                self.entries[key] = data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+                    self.evictions += 1
+        return memoryview(data)
+
+    def invalidate_video(self, video_id: str) -> None:
+        """
+        Drop every cached segment of a video. (Call this whenever the video's segments change or are deleted.)
+        """
+        video_id = str(video_id)
+        with self.lock:
+            self.generations[video_id] = self.generations.get(video_id, 0) + 1
+            for key in [key for key in self.entries if key[0] == video_id]:
+                self.size -= len(self.entries.pop(key))
+        logger.debug(f"Invalidated cached segments for video {video_id}")
+
+    def stats(self) -> dict:
+        """
+        Get the cache's counters.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_bytes,
+            }
+
+
+class CachedResponse(NamedTuple):
+    payload: bytes
+    version: str
+    expires_at: float
+    tags: List[str]
+
+
+def make_version(response: dict) -> str:
+    """
+    Get a response's version: a hash of its contents, so it only changes when they do. (Unlike a counter, it survives
+    restarts, and notices changes made by other processes.)
+    """
+    return hashlib.sha256(encode_payload(response)).hexdigest()[:16]
+
+
+class ResponseCache:
+    """
+    A least-recently-used cache of responses (USERS, VIDEO_PAGE, VIDEO_INFO), bounded by their total size, and
+    already encoded as JSON, so a hit skips both the database and json.dumps. Each response carries a "version"
+    (see make_version), which clients can send back as "if_version" to be told it's not changed instead.
+
+    Every response is tagged with what it was made from (say, "users", "videos/luna" or "video/12"), and the database
+    invalidates tags as it changes them (see Database.on_change). Changes made by other processes (like final_worker
+    finishing a quality) can't reach us, so responses also expire after a while.
+    """
+
+    def __init__(
+        self, max_bytes: int, ttl: float = 30, max_entry_bytes: Optional[int] = None
+    ) -> None:
+        """
+        Args:
+            max_bytes (int): The memory budget for the cache. 0 disables caching.
+            ttl (float): How many seconds a response is kept for, at most.
+            max_entry_bytes (Optional[int]): Responses bigger than this are never cached. (Defaults to 1/8th of the budget.)
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = (
+            max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        )
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self.keys_by_tag: Dict[str, Set[Hashable]] = {}
+        self.size = 0
+        # bumped whenever a tag is invalidated, so a query that was already running doesn't put stale data back
+        self.generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(
+        self, key: Hashable, tags: List[str], make_response: Callable[[], dict]
+    ) -> CachedResponse:
+        """
+        Get a response from the cache, making it (and caching it) on a miss.
+
+        Args:
+            key (Hashable): What identifies the response. (The command and its parameters.)
+            tags (List[str]): What the response was made from. (See invalidate)
+            make_response (Callable): Makes the response, on a miss.
+
+        Returns:
+            CachedResponse: The response (with its version added), encoded with encode_payload.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            generations = [self.generations.get(tag, 0) for tag in tags]
+
+        response = make_response()
+        response["version"] = make_version(response)
+        payload = encode_payload(response)
+        entry = CachedResponse(payload, response["version"], now + self.ttl, tags)
+        if self.max_bytes <= 0 or len(payload) > self.max_entry_bytes:
+            return entry
+
+        with self.lock:
+            if [
+                self.generations.get(tag, 0) for tag in tags
+            ] == generations and key not in self.entries:
+                self.entries[key] = entry
+                self.size += len(payload)
+                for tag in tags:
+                    self.keys_by_tag.setdefault(tag, set()).add(key)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+                    self.evictions += 1
+        return entry
+
+    def invalidate(self, *tags: str) -> None:
+        """
+        Drop every cached response made from any of these tags. (Call this whenever they change.)
+        """
+        with self.lock:
+            for tag in tags:
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+                for key in list(self.keys_by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+        logger.debug(f"Invalidated cached responses for {tags}")
+
+    def _remove(self, key: Hashable) -> None:
+        # (only call this with the lock held)
+        entry = self.entries.pop(key)
+        self.size -= len(entry.payload)
+        for tag in entry.tags:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+    def stats(self) -> dict:
+        """
+        Get the cache's counters.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_bytes,
+            }
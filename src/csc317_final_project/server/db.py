@@ -1,9 +1,48 @@
+import base64
 import sqlite3
+import threading
 from pathlib import Path
-from threading import RLock
-from typing import Optional
-
-import bcrypt
+from typing import Callable, Dict, List, Optional, Tuple
+
+from csc317_final_project.server.hashing import (
+    PasswordHasher,
+    check_password,
+    hash_password,
+)
+
+BUSY_TIMEOUT = 30  # seconds a write waits for another one to finish
+PRAGMAS = [
+    "synchronous = NORMAL",  # with WAL, only a power cut (not a crash) can lose the last few commits
+    "mmap_size = 268435456",  # read pages straight out of a 256 MiB mapping, shared by every connection
+    "cache_size = -16384",  # 16 MiB of page cache per connection
+    "temp_store = MEMORY",
+]
+
+# the queries behind the listings (USERS, VIDEO_PAGE), which get run constantly
+USERS_PAGE_QUERY = (
+    "SELECT username, joined_at, last_login FROM users ORDER BY id LIMIT ? OFFSET ?"
+)
+USERS_AFTER_QUERY = "SELECT id, username, joined_at, last_login FROM users WHERE id > ? ORDER BY id LIMIT ?"
+VIDEO_PAGE_QUERY = "SELECT title, id, author FROM videos WHERE author = ? AND length > 0 ORDER BY id LIMIT ? OFFSET ?"
+VIDEOS_AFTER_QUERY = "SELECT title, id, author FROM videos WHERE author = ? AND length > 0 AND id > ? ORDER BY id LIMIT ?"
+USER_COUNT_QUERY = "SELECT value FROM counters WHERE name = 'users'"
+VIDEO_COUNT_QUERY = "SELECT video_count FROM users WHERE username = ?"
+# (for VIDEO_INFO_MULTI, and VIDEO_PAGE's include_info, with a ? in {ids} for each video)
+VIDEO_INFOS_QUERY = "SELECT * FROM videos WHERE id IN ({ids})"
+RENDITIONS_QUERY = "SELECT video_id, quality FROM video_renditions WHERE video_id IN ({ids}) ORDER BY video_id, quality"
+# ...which should never scan a whole table. (See Database.check_query_plans)
+# (USERS_PAGE_QUERY isn't here: skipping OFFSET rows means walking past them, whatever the index. Cursors don't.)
+INDEXED_QUERIES = {
+    "USERS_AFTER_QUERY": (USERS_AFTER_QUERY, (0, 26)),
+    "VIDEO_PAGE_QUERY": (VIDEO_PAGE_QUERY, ("someone", 25, 0)),
+    "VIDEOS_AFTER_QUERY": (VIDEOS_AFTER_QUERY, ("someone", 0, 26)),
+    "USER_COUNT_QUERY": (USER_COUNT_QUERY, ()),
+    "VIDEO_COUNT_QUERY": (VIDEO_COUNT_QUERY, ("someone",)),
+    "VIDEO_INFOS_QUERY": (VIDEO_INFOS_QUERY.format(ids="?, ?"), (1, 2)),
+    "RENDITIONS_QUERY": (RENDITIONS_QUERY.format(ids="?, ?"), (1, 2)),
+}
+# what VIDEO_PAGE's include_info adds to each video
+INLINE_INFO_FIELDS = ["length", "num_segments", "max_quality", "available_qualities"]
 
 
 def row_to_dict(row: sqlite3.Row) -> dict:
@@ -19,23 +58,152 @@ def row_to_dict(row: sqlite3.Row) -> dict:
     return {key: row[key] for key in row.keys()}
 
 
+def make_video_info(video: sqlite3.Row, qualities: List[int]) -> dict:
+    """
+    Make a video's info (what VIDEO_INFO returns) from its row and its ready qualities.
+    """
+    video_info = row_to_dict(video)
+    if qualities:
+        video_info["available_qualities"] = qualities
+    else:
+        # processed before qualities were tracked, back when every quality up to the max was done at once
+        video_info["available_qualities"] = list(range(video["max_quality"] + 1))
+    return video_info
+
+
+def encode_cursor(kind: str, last_id: int) -> str:
+    """
+    Make a cursor pointing just past a row. The cursor's opaque to clients, who only ever hand it back to us.
+
+    Args:
+        kind (str): What the cursor pages through. (A cursor only works for the listing it came from.)
+        last_id (int): The ID of the last row on the page.
+
+    Returns:
+        str: The cursor.
+    """
+    return base64.urlsafe_b64encode(f"{kind}:{last_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(kind: str, cursor: Optional[str]) -> int:
+    """
+    Get the ID of the row a cursor points just past. (See encode_cursor)
+
+    Args:
+        kind (str): What the cursor should page through.
+        cursor (Optional[str]): The cursor. None (or empty) means the start of the listing.
+
+    Returns:
+        int: The ID to continue after.
+    """
+    if not cursor:
+        return 0
+    try:
+        cursor_kind, _, last_id = (
+            base64.urlsafe_b64decode(str(cursor).encode("ascii"))
+            .decode("utf-8")
+            .rpartition(":")
+        )
+        if cursor_kind != kind:
+            raise ValueError
+        return int(last_id)
+    except ValueError:  # (includes bad base64 and bad UTF-8)
+        raise ValueError("Invalid cursor")
+
+
+def get_next_cursor(
+    kind: str, rows: List[sqlite3.Row], page_size: int
+) -> Optional[str]:
+    """
+    Get the cursor for the page after this one, or None if this is the last page.
+    (The rows should be fetched with a limit of page_size + 1, so we know whether there's another page.)
+    """
+    if len(rows) <= page_size:
+        return None
+    return encode_cursor(kind, rows[page_size - 1]["id"])
+
+
 class Database:
     MAX_ITEMS_PER_PAGE = 25  # client doesn't actually use this (and they don't want control over it), but needs it.
+    MAX_VIDEO_INFO_IDS = (
+        100  # per VIDEO_INFO_MULTI (and well under SQLite's limit on ?s)
+    )
 
-    def __init__(self, server_path: Path):
+    def __init__(self, server_path: Path, hasher: Optional[PasswordHasher] = None):
         """
         Initialize the database connection.
 
         Args:
             server_path (Optional[Path]): The path to the server directory. If None, uses the current directory. (The database is stored in server/db.sqlite3)
+            hasher (Optional[PasswordHasher]): Where passwords get hashed. If None, they're hashed on the calling thread.
         """
-        self.connection = sqlite3.connect(
-            server_path / "db.sqlite3",
-            check_same_thread=False,
-        )
-        self.connection.row_factory = sqlite3.Row
-        self.lock = RLock()  # in case we need to use shenanigans :>
-        self.cursor = self.connection.cursor()
+        self.path = server_path / "db.sqlite3"
+        self.hasher = hasher
+        # every thread gets its own connection, so readers never wait on each other (or on a writer, with WAL)
+        self.local = threading.local()
+        # (WAL sticks to the database file, so this only really does anything the first time)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # called with what changed (see changed), so cached responses can be dropped (see ResponseCache)
+        self.on_change: Optional[Callable[..., None]] = None
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection to the database, with our pragmas set.
+        """
+        connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        connection.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            connection.execute(f"PRAGMA {pragma}")
+        return connection
+
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        Get the current thread's connection. (Opened, along with its cursor, the first time it's needed, and closed
+        when the thread ends.)
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+            self.local.cursor = connection.cursor()
+        return connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        The current thread's connection. (See get_connection)
+        """
+        return self.get_connection()
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        The current thread's cursor.
+        """
+        self.get_connection()  # (opens the cursor too, if this thread doesn't have one yet)
+        return self.local.cursor
+
+    def changed(self, *tags: str) -> None:
+        """
+        Let on_change know something changed. Tags are "users" (the list of users), "videos/<author>" (an author's
+        list of videos) and "video/<id>" (a video's info).
+        """
+        if self.on_change is not None:
+            self.on_change(*tags)
+
+    def video_changed(self, video_id, author: Optional[str] = None) -> None:
+        """
+        Let on_change know a video changed. (Which also changes its author's list of videos.)
+        """
+        if self.on_change is None:
+            return
+        if author is None:
+            video = self.cursor.execute(
+                "SELECT author FROM videos WHERE id = ?", (video_id,)
+            ).fetchone()
+            if video is None:
+                return
+            author = video["author"]
+        self.changed(f"video/{video_id}", f"videos/{author}")
 
     def get_users_page(self, page_num: int):
         """
@@ -44,15 +212,12 @@ class Database:
         Args:
             page_num (int): The page number to retrieve.
         """
-        with self.lock:
-            users = self.cursor.execute(
-                "SELECT username, joined_at, last_login FROM users LIMIT ? OFFSET ?",
-                (self.MAX_ITEMS_PER_PAGE, page_num * self.MAX_ITEMS_PER_PAGE),
-            ).fetchall()
+        users = self.cursor.execute(
+            USERS_PAGE_QUERY,
+            (self.MAX_ITEMS_PER_PAGE, page_num * self.MAX_ITEMS_PER_PAGE),
+        ).fetchall()
 
-            user_count = self.cursor.execute(
-                "SELECT COUNT(*) FROM users",
-            ).fetchone()[0]
+        user_count = self.count_users()
 
         result = {
             "type": "USERS",
@@ -65,6 +230,35 @@ class Database:
 
         return result
 
+    def get_users_after(self, cursor: Optional[str]):
+        """
+        Get a page of users from the database, starting from a cursor. Unlike get_users_page, this stays just as
+        fast however deep into the list it is.
+
+        Args:
+            cursor (Optional[str]): The next_cursor of the previous page, or None for the first page.
+        """
+        users = self.cursor.execute(
+            USERS_AFTER_QUERY,
+            (decode_cursor("users", cursor), self.MAX_ITEMS_PER_PAGE + 1),
+        ).fetchall()
+
+        user_count = self.count_users()
+
+        result = {
+            "type": "USERS",
+            "result": [
+                {key: user[key] for key in ("username", "joined_at", "last_login")}
+                for user in users[: self.MAX_ITEMS_PER_PAGE]
+            ],
+            "next_cursor": get_next_cursor("users", users, self.MAX_ITEMS_PER_PAGE),
+            "max_page": user_count // self.MAX_ITEMS_PER_PAGE,
+            "items_per_page": self.MAX_ITEMS_PER_PAGE,
+            "number_of_items": user_count,
+        }
+
+        return result
+
     def get_video_page(self, page_num: int, author_name: Optional[str] = None):
         """
         Get a page of videos from the database.
@@ -73,20 +267,16 @@ class Database:
             page_num (int): The page number to retrieve.
             author_name (Optional[str]): The name of the author to filter by. If None, retrieves all videos.
         """
-        with self.lock:
-            videos = self.cursor.execute(
-                "SELECT title, id, author FROM videos WHERE author = ? AND length > 0 LIMIT ? OFFSET ?",
-                (
-                    author_name,
-                    self.MAX_ITEMS_PER_PAGE,
-                    page_num * self.MAX_ITEMS_PER_PAGE,
-                ),
-            ).fetchall()
+        videos = self.cursor.execute(
+            VIDEO_PAGE_QUERY,
+            (
+                author_name,
+                self.MAX_ITEMS_PER_PAGE,
+                page_num * self.MAX_ITEMS_PER_PAGE,
+            ),
+        ).fetchall()
 
-            video_count = self.cursor.execute(
-                "SELECT COUNT(*) FROM videos WHERE author = ? AND length > 0",
-                (author_name,),
-            ).fetchone()[0]
+        video_count = self.count_videos(author_name)
 
         result = {
             "type": "VIDEOS",
@@ -99,6 +289,69 @@ class Database:
 
         return result
 
+    def get_videos_after(self, cursor: Optional[str], author_name: Optional[str]):
+        """
+        Get a page of videos from the database, starting from a cursor. (See get_users_after)
+
+        Args:
+            cursor (Optional[str]): The next_cursor of the previous page, or None for the first page.
+            author_name (Optional[str]): The name of the author to filter by.
+        """
+        kind = f"videos/{author_name}"  # so a cursor can't be used for someone else's videos
+        videos = self.cursor.execute(
+            VIDEOS_AFTER_QUERY,
+            (
+                author_name,
+                decode_cursor(kind, cursor),
+                self.MAX_ITEMS_PER_PAGE + 1,
+            ),
+        ).fetchall()
+
+        video_count = self.count_videos(author_name)
+
+        result = {
+            "type": "VIDEOS",
+            "result": list(map(row_to_dict, videos[: self.MAX_ITEMS_PER_PAGE])),
+            "next_cursor": get_next_cursor(kind, videos, self.MAX_ITEMS_PER_PAGE),
+            "max_page": video_count // self.MAX_ITEMS_PER_PAGE,
+            "items_per_page": self.MAX_ITEMS_PER_PAGE,
+            "number_of_items": video_count,
+        }
+
+        return result
+
+    def count_users(self) -> int:
+        """
+        Get the number of users. (Kept up to date by a trigger, so there's no need to count them.)
+        """
+        row = self.cursor.execute(USER_COUNT_QUERY).fetchone()
+        return row["value"] if row is not None else 0
+
+    def count_videos(self, author_name: Optional[str]) -> int:
+        """
+        Get the number of (visible) videos a user has. (Kept up to date by triggers, see count_users)
+        """
+        row = self.cursor.execute(VIDEO_COUNT_QUERY, (author_name,)).fetchone()
+        return row["video_count"] if row is not None else 0
+
+    def check_query_plans(self) -> List[str]:
+        """
+        Check that none of the listing queries (INDEXED_QUERIES) scan a whole table, say, because an index is missing.
+
+        Returns:
+            List[str]: A description of each query that does, if any.
+        """
+        problems = []
+        for name, (query, params) in INDEXED_QUERIES.items():
+            plan = self.cursor.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+            for step in plan:
+                detail = step["detail"]
+                # a full scan looks like "SCAN videos" ("SCAN TABLE videos" on older SQLite), where an index
+                # would make it "SEARCH videos USING ..." (or at least "SCAN videos USING COVERING INDEX ...")
+                if detail.startswith("SCAN") and "USING" not in detail:
+                    problems.append(f"{name}: {detail}")
+        return problems
+
     def get_video_info(self, video_id: str):
         """
         Get information about a video from the database.
@@ -106,12 +359,68 @@ class Database:
         Args:
             video_id (str): The ID of the video to retrieve.
         """
-        with self.lock:
-            video = self.cursor.execute(
-                "SELECT * FROM videos WHERE id = ?", (video_id,)
-            ).fetchone()
+        video = self.cursor.execute(
+            "SELECT * FROM videos WHERE id = ?", (video_id,)
+        ).fetchone()
+        if not video:
+            return None
+        qualities = self.cursor.execute(
+            "SELECT quality FROM video_renditions WHERE video_id = ? ORDER BY quality",
+            (video_id,),
+        ).fetchall()
+        return make_video_info(video, [row["quality"] for row in qualities])
+
+    def get_video_infos(self, video_ids: List[int]) -> List[dict]:
+        """
+        Get information about several videos at once, in two queries (however many videos there are).
 
-            return row_to_dict(video) if video else None
+        Args:
+            video_ids (List[int]): The IDs of the videos to retrieve. (At most MAX_VIDEO_INFO_IDS of them.)
+
+        Returns:
+            List[dict]: The info of each video that exists (like get_video_info), in the order they were asked for.
+        """
+        if len(video_ids) > self.MAX_VIDEO_INFO_IDS:
+            raise ValueError(
+                f"Can't get more than {self.MAX_VIDEO_INFO_IDS} videos at once"
+            )
+        if not video_ids:
+            return []
+        ids = ", ".join("?" * len(video_ids))
+        videos = {
+            row["id"]: row
+            for row in self.cursor.execute(
+                VIDEO_INFOS_QUERY.format(ids=ids), video_ids
+            ).fetchall()
+        }
+        qualities: Dict[int, List[int]] = {}
+        for row in self.cursor.execute(
+            RENDITIONS_QUERY.format(ids=ids), video_ids
+        ).fetchall():
+            qualities.setdefault(row["video_id"], []).append(row["quality"])
+        return [
+            make_video_info(videos[video_id], qualities.get(video_id, []))
+            for video_id in dict.fromkeys(
+                video_ids
+            )  # (once each, even if asked for twice)
+            if video_id in videos
+        ]
+
+    def add_video_infos(self, result: dict) -> dict:
+        """
+        Add the INLINE_INFO_FIELDS to every video in a page of videos (from get_video_page or get_videos_after).
+        """
+        infos = {
+            info["id"]: info
+            for info in self.get_video_infos(
+                [video["id"] for video in result["result"]]
+            )
+        }
+        for video in result["result"]:
+            info = infos.get(video["id"])
+            if info is not None:
+                video.update((field, info[field]) for field in INLINE_INFO_FIELDS)
+        return result
 
     def login(self, username: str, password: str) -> None:
         """
@@ -121,13 +430,13 @@ class Database:
             username (str): The username to check.
             password (str): The password to check.
         """
-        with self.lock:
-            user = self.cursor.execute(
-                "SELECT * FROM users WHERE username = ?", (username,)
-            ).fetchone()
+        user = self.cursor.execute(
+            "SELECT * FROM users WHERE username = ?", (username,)
+        ).fetchone()
 
-        if user is not None and bcrypt.checkpw(
-            password.encode("utf-8"), user["password"].encode("utf-8")
+        check = self.hasher.check if self.hasher is not None else check_password
+        if user is not None and check(
+            password, user["password"]
         ):  # TODO: hash | checking hash using bcrypt
             return
         raise Exception("Invalid username or password")
@@ -140,25 +449,33 @@ class Database:
             username (str): The username to register.
             password (str): The password to register.
         """
-        with self.lock:
-            user = self.cursor.execute(
-                "SELECT * FROM users WHERE username = ?", (username,)
-            ).fetchone()
+        user = self.cursor.execute(
+            "SELECT * FROM users WHERE username = ?", (username,)
+        ).fetchone()
+
+        if user is not None:
+            raise Exception("Username already exists")
+
+        # (hashed before the transaction starts, so nobody waits on it)
+        hashpw = (
+            self.hasher.hash(password)
+            if self.hasher is not None
+            else hash_password(password)
+        )
 
-            if user is not None:
+        with self.connection:
+            try:
+                self.cursor.execute(
+                    "INSERT INTO users (username, password) VALUES (?, ?)",
+                    (
+                        username,
+                        hashpw,
+                    ),  # TODO: hash! | added hashing here, decodes at end to save in db as string
+                )
+            except sqlite3.IntegrityError:
+                # nothing stops someone else registering the same name (on another connection) in the meantime
                 raise Exception("Username already exists")
-
-            salt = bcrypt.gensalt()
-            hashpw = bcrypt.hashpw(password.encode("utf-8"), salt)
-
-            self.cursor.execute(
-                "INSERT INTO users (username, password) VALUES (?, ?)",
-                (
-                    username,
-                    hashpw.decode("utf-8"),
-                ),  # TODO: hash! | added hashing here, decodes at end to save in db as string
-            )
-            self.connection.commit()
+        self.changed("users")
 
     def start_upload_video(self, title: str, author: str) -> int:
         """
@@ -171,14 +488,184 @@ class Database:
         Returns:
             int: The ID of the video.
         """
-        with self.lock:
+        with self.connection:
             self.cursor.execute(
                 "INSERT INTO videos (author, title, length, num_segments, max_quality) VALUES (?, ?, ?, ?, ?)",
                 (author, title, -1.0, -1, -1),
             )
-            self.connection.commit()
             return self.cursor.lastrowid or -1
 
+    def start_chunked_upload(
+        self,
+        upload_id: str,
+        author: str,
+        title: str,
+        extension: str,
+        file_size: int,
+        chunk_size: int,
+    ) -> None:
+        """
+        Start a chunked (resumable) upload. The video itself isn't created until the upload's committed.
+
+        Args:
+            upload_id (str): The ID of the upload.
+            author (str): The author of the video.
+            title (str): The title of the video.
+            extension (str): The extension of the uploaded file (with the dot).
+            file_size (int): The size of the file in bytes.
+            chunk_size (int): The size of every chunk (but the last) in bytes.
+        """
+        with self.connection:
+            self.cursor.execute(
+                "INSERT INTO uploads (id, author, title, extension, file_size, chunk_size) VALUES (?, ?, ?, ?, ?, ?)",
+                (upload_id, author, title, extension, file_size, chunk_size),
+            )
+
+    def get_chunked_upload(self, upload_id: str) -> Optional[dict]:
+        """
+        Get a chunked upload, along with the chunks received so far.
+
+        Args:
+            upload_id (str): The ID of the upload.
+
+        Returns:
+            Optional[dict]: The upload (with a sorted list of "received" chunk numbers), or None if it doesn't exist.
+        """
+        upload = self.cursor.execute(
+            "SELECT * FROM uploads WHERE id = ?", (upload_id,)
+        ).fetchone()
+        if upload is None:
+            return None
+        chunks = self.cursor.execute(
+            "SELECT chunk FROM upload_chunks WHERE upload_id = ? ORDER BY chunk",
+            (upload_id,),
+        ).fetchall()
+        upload_info = row_to_dict(upload)
+        upload_info["received"] = [row["chunk"] for row in chunks]
+        return upload_info
+
+    def mark_chunk_received(self, upload_id: str, chunk: int, sha256: str) -> None:
+        """
+        Record that a chunk of an upload was received (and checked).
+
+        Args:
+            upload_id (str): The ID of the upload.
+            chunk (int): The number of the chunk.
+            sha256 (str): The chunk's SHA-256 hash (as hex).
+        """
+        with self.connection:
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO upload_chunks (upload_id, chunk, sha256) VALUES (?, ?, ?)",
+                (upload_id, chunk, sha256),
+            )
+
+    def claim_chunked_upload(self, upload_id: str) -> bool:
+        """
+        Start committing a chunked upload. Only one commit of an upload can be going at once.
+
+        Args:
+            upload_id (str): The ID of the upload.
+
+        Returns:
+            bool: Whether it's ours to commit. (False if it's already being committed, or doesn't exist.)
+        """
+        with self.connection:
+            self.cursor.execute(
+                "UPDATE uploads SET committing = 1 WHERE id = ? AND committing = 0",
+                (upload_id,),
+            )
+            return self.cursor.rowcount == 1
+
+    def release_chunked_upload(self, upload_id: str) -> None:
+        """
+        Give up committing a chunked upload, so the commit can be tried again. (See claim_chunked_upload)
+
+        Args:
+            upload_id (str): The ID of the upload.
+        """
+        with self.connection:
+            self.cursor.execute(
+                "UPDATE uploads SET committing = 0 WHERE id = ?", (upload_id,)
+            )
+
+    def get_old_chunked_uploads(self, max_age: float) -> List[str]:
+        """
+        Get the chunked uploads started more than max_age seconds ago. (Which may well be abandoned.)
+
+        Args:
+            max_age (float): How old an upload has to be, in seconds.
+
+        Returns:
+            List[str]: The IDs of the uploads.
+        """
+        uploads = self.cursor.execute(
+            "SELECT id FROM uploads WHERE created_at < datetime('now', ?)",
+            (f"-{int(max_age)} seconds",),
+        ).fetchall()
+        return [row["id"] for row in uploads]
+
+    def finish_chunked_upload(self, upload_id: str) -> None:
+        """
+        Forget a chunked upload. (Once it's committed, or abandoned.)
+
+        Args:
+            upload_id (str): The ID of the upload.
+        """
+        with self.connection:
+            self.cursor.execute(
+                "DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,)
+            )
+            self.cursor.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+
+    def set_content_hash(self, video_id: int, content_hash: str) -> None:
+        """
+        Record the hash of a video's original upload, so later uploads of the same file can reuse its renditions.
+
+        Args:
+            video_id (int): The ID of the video.
+            content_hash (str): The SHA-256 hash of the original upload (as hex).
+        """
+        with self.connection:
+            self.cursor.execute(
+                "UPDATE videos SET content_hash = ? WHERE id = ?",
+                (content_hash, video_id),
+            )
+        self.video_changed(video_id)
+
+    def get_content_hash(self, video_id: int) -> Optional[str]:
+        """
+        Get the hash of a video's original upload. (See set_content_hash)
+
+        Args:
+            video_id (int): The ID of the video.
+
+        Returns:
+            Optional[str]: The SHA-256 hash (as hex), or None if it hasn't been hashed (or doesn't exist).
+        """
+        video = self.cursor.execute(
+            "SELECT content_hash FROM videos WHERE id = ?", (video_id,)
+        ).fetchone()
+        return video["content_hash"] if video is not None else None
+
+    def find_duplicate_video(self, video_id: int) -> Optional[int]:
+        """
+        Find another (already processed) video that was uploaded from the exact same file.
+
+        Args:
+            video_id (int): The ID of the video.
+
+        Returns:
+            Optional[int]: The ID of the video with the most qualities ready, or None if there isn't one.
+        """
+        duplicate = self.cursor.execute(
+            """SELECT other.id FROM videos AS this
+            JOIN videos AS other ON other.content_hash = this.content_hash AND other.id != this.id
+            WHERE this.id = ? AND other.max_quality >= 0
+            ORDER BY other.max_quality DESC, other.id LIMIT 1""",
+            (video_id,),
+        ).fetchone()
+        return duplicate["id"] if duplicate is not None else None
+
     def update_video_info(
         self, video_id: int, length: float, num_segments: int, max_quality: int
     ) -> None:
@@ -191,13 +678,95 @@ class Database:
             num_segments (int): The number of segments in the video.
             max_quality (int): The maximum quality of the video.
         """
-        with self.lock:
+        with self.connection:
             # print(f"Updating video info: {video_id}, {length}, {num_segments}, {max_quality}")
             self.cursor.execute(
                 "UPDATE videos SET length = ?, num_segments = ?, max_quality = ? WHERE id = ?",
                 (length, num_segments, max_quality, video_id),
             )
-            self.connection.commit()
+        self.video_changed(video_id)
+
+    def mark_rendition_ready(
+        self,
+        video_id: int,
+        quality: int,
+        num_segments: int,
+        length: float,
+        job: Optional[Tuple[int, str]] = None,
+    ) -> bool:
+        """
+        Mark a quality of a video as ready to be watched. The video becomes visible as soon as its first quality is
+        ready, and its max quality goes up as the higher qualities finish.
+
+        Does nothing if the video's been deleted, or (if job is given) if the job converting it isn't running on
+        that worker anymore - a conversion that finishes after its video was deleted or reprocessed mustn't bring
+        back the old rendition. (Both are checked in the same statement as the insert, so there's no gap.)
+
+        Args:
+            video_id (int): The ID of the video.
+            quality (int): The quality that's ready.
+            num_segments (int): The number of segments in that quality.
+            length (float): The length of the video.
+            job (Optional[Tuple[int, str]]): The ID of the job that converted it, and the worker running it.
+
+        Returns:
+            bool: Whether the quality was marked as ready.
+        """
+        query = (
+            "INSERT OR REPLACE INTO video_renditions (video_id, quality, num_segments) "
+            "SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM videos WHERE id = ?)"
+        )
+        params: tuple = (video_id, quality, num_segments, video_id)
+        if job is not None:
+            # (the job states are in jobs.py, which imports us)
+            query += " AND EXISTS (SELECT 1 FROM jobs WHERE id = ? AND worker = ? AND state = 'running')"
+            params += job
+        with self.connection:
+            if self.cursor.execute(query, params).rowcount == 0:
+                return False
+            best = self.cursor.execute(
+                "SELECT quality, num_segments FROM video_renditions WHERE video_id = ? ORDER BY quality DESC LIMIT 1",
+                (video_id,),
+            ).fetchone()
+            self.cursor.execute(
+                "UPDATE videos SET length = ?, num_segments = ?, max_quality = ? WHERE id = ?",
+                (length, best["num_segments"], best["quality"], video_id),
+            )
+        self.video_changed(video_id)
+        return True
+
+    def get_ready_qualities(self, video_id: int) -> List[int]:
+        """
+        Get the qualities of a video that are ready to be watched. (See mark_rendition_ready)
+
+        Args:
+            video_id (int): The ID of the video.
+
+        Returns:
+            List[int]: The ready qualities, lowest first.
+        """
+        self.cursor.execute(
+            "SELECT quality FROM video_renditions WHERE video_id = ? ORDER BY quality",
+            (video_id,),
+        )
+        return [row["quality"] for row in self.cursor.fetchall()]
+
+    def clear_renditions(self, video_id: int) -> None:
+        """
+        Forget which qualities of a video are ready (and hide it). Used when a video gets reprocessed.
+
+        Args:
+            video_id (int): The ID of the video.
+        """
+        with self.connection:
+            self.cursor.execute(
+                "DELETE FROM video_renditions WHERE video_id = ?", (video_id,)
+            )
+            self.cursor.execute(
+                "UPDATE videos SET length = -1, num_segments = -1, max_quality = -1 WHERE id = ?",
+                (video_id,),
+            )
+        self.video_changed(video_id)
 
     def delete(self, video_id: str) -> None:
         """
@@ -206,6 +775,13 @@ class Database:
         Args:
             video_id (str): The ID of the video.
         """
-        with self.lock:
-            self.cursor.execute("DELETE FROM videos WHERE id = ?", (video_id))
-            self.connection.commit()
+        video = self.cursor.execute(
+            "SELECT author FROM videos WHERE id = ?", (video_id,)
+        ).fetchone()
+        with self.connection:
+            self.cursor.execute(
+                "DELETE FROM video_renditions WHERE video_id = ?", (video_id,)
+            )
+            self.cursor.execute("DELETE FROM videos WHERE id = ?", (video_id,))
+        if video is not None:
+            self.video_changed(video_id, video["author"])
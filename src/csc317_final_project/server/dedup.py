@@ -0,0 +1,153 @@
+"""
+Deduplication of uploads.
+
+The same file tends to get uploaded more than once, and every copy used to go through the whole quality ladder
+again. Originals are hashed (SHA-256) as they're received, and when a new upload's hash matches a video that's
+already been processed, its renditions are hard-linked into the new video instead of being converted again.
+
+Hard links are their own reference count: each video's tree holds a name for the same data, and the data's only
+freed once the last name is gone. So DELETE (or DBG_REPROCESS_VIDEO) can remove one video's tree without touching
+any other video using the same files. Nothing ever writes into a segment or pack in place (conversions write new
+files, see convert_rendition), so sharing them is safe. Filesystems without hard links get copies instead.
+"""
+
+import hashlib
+import os
+import shutil
+from logging import getLogger
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from csc317_final_project.server.db import Database
+from csc317_final_project.server.fs import (
+    get_original_video_path,
+    get_thumbnail_path,
+    get_video_root_path,
+)
+from csc317_final_project.server.pack import count_segments
+from csc317_final_project.server.quality import VideoQuality
+
+logger = getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path: Path) -> str:
+    """
+    Get the SHA-256 hash (as hex) of a file.
+    """
+    digest = hashlib.sha256()
+    with file_path.open("rb") as f:
+        while True:
+            data = f.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def link_file(source: Path, target: Path) -> None:
+    """
+    Hard-link a file (or copy it, if that's not possible), replacing the target if it exists.
+    """
+    # link to a temporary name first, so the target's never missing (or half written)
+    temporary = target.with_name(f".{target.name}.link")
+    try:
+        os.link(source, temporary)
+    except OSError:
+        shutil.copy2(source, temporary)
+    os.replace(temporary, target)
+
+
+def link_rendition(source_dir: Path, target_dir: Path, video_id: int) -> None:
+    """
+    Link every segment (or the pack) of a quality into another video's quality directory.
+    Loose segments are renamed as they're linked, as their names start with the video's ID.
+
+    Args:
+        source_dir (Path): The quality directory to link from.
+        target_dir (Path): The quality directory to link into (which is replaced).
+        video_id (int): The ID of the video being linked into.
+    """
+    shutil.rmtree(target_dir, ignore_errors=True)
+    target_dir.mkdir(parents=True)
+    for file in source_dir.iterdir():
+        if file.name.startswith("."):
+            continue  # (another link in progress)
+        if file.suffix == ".mp4":
+            # {video_id}_{quality}_{segment_id}.mp4
+            name = f"{video_id}_{file.name.split('_', 1)[1]}"
+        else:
+            name = file.name
+        link_file(file, target_dir / name)
+
+
+def reuse_renditions(
+    db: Database,
+    server_path: Path,
+    video_id: int,
+    source_id: int,
+    skip_qualities: Optional[List[int]] = None,
+    job: Optional[Tuple[int, str]] = None,
+) -> List[int]:
+    """
+    Reuse the renditions (and thumbnail) of a video uploaded from the same file, instead of converting them again.
+    The new video's original is swapped for a link to the source's, too.
+
+    Any quality that can't be linked (say, the source got deleted halfway) is just left to be converted.
+
+    Args:
+        db (Database): The database object to update video information.
+        server_path (Path): The path to the server directory.
+        video_id (int): The ID of the new video.
+        source_id (int): The ID of the video with the same content.
+        skip_qualities (Optional[List[int]]): Qualities the new video already has.
+        job (Optional[Tuple[int, str]]): The job doing this, and its worker. (See convert_rendition)
+
+    Returns:
+        List[int]: The qualities that were reused.
+    """
+    source_info = db.get_video_info(str(source_id))
+    if source_info is None:
+        return []
+    source_root = get_video_root_path(server_path, str(source_id))
+    video_root = get_video_root_path(server_path, str(video_id))
+
+    reused = []
+    for quality in map(VideoQuality, source_info["available_qualities"]):
+        if int(quality) in (skip_qualities or []):
+            continue
+        target_dir = video_root / str(quality)
+        try:
+            link_rendition(source_root / str(quality), target_dir, video_id)
+            num_segments = count_segments(target_dir)
+        except OSError as e:
+            logger.warning(
+                f"Couldn't reuse {quality} of video {source_id} for video {video_id}: {e}"
+            )
+            shutil.rmtree(target_dir, ignore_errors=True)
+            continue
+        if num_segments == 0:
+            shutil.rmtree(target_dir, ignore_errors=True)
+            continue
+        if not db.mark_rendition_ready(
+            video_id, int(quality), num_segments, source_info["length"], job
+        ):
+            break  # (the video's been deleted or reprocessed)
+        reused.append(int(quality))
+
+    try:
+        link_file(
+            get_thumbnail_path(server_path, str(source_id)),
+            get_thumbnail_path(server_path, str(video_id)),
+        )
+        original = get_original_video_path(server_path, str(video_id))
+        link_file(get_original_video_path(server_path, str(source_id)), original)
+    except OSError:
+        pass  # the thumbnail gets generated as usual, and the original just isn't shared
+
+    if reused:
+        logger.info(
+            f"Video {video_id} is a duplicate of video {source_id}, reused {len(reused)} qualities"
+        )
+    return reused
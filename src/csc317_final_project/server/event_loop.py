@@ -0,0 +1,165 @@
+"""
+A non-blocking connection engine for the server.
+
+Instead of a thread per client (which sits in recv() for as long as the client is idle), every client socket is
+multiplexed on one selector. Once a client has sent a complete message, it's taken off the loop and the message is
+run through the usual Server.respond() on a small bounded pool, since handling a command can block (bcrypt, sqlite,
+reading segments off the disk, or even reading an upload). When it's done, the client goes back on the loop.
+"""
+
+import selectors
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import TYPE_CHECKING, Callable, List, Tuple
+
+from csc317_final_project.protocol import ProtocolError
+
+if TYPE_CHECKING:
+    from csc317_final_project.server.__main__ import ClientState, Server
+
+ENGINES = ("threads", "selectors")
+RECV_SIZE = 4096
+
+logger = getLogger(__name__)
+
+
+class EventLoop:
+    def __init__(
+        self,
+        server: "Server",
+        client_factory: Callable[[socket.socket, Tuple[str, int]], "ClientState"],
+        max_handlers: int = 32,
+    ) -> None:
+        """
+        Args:
+            server (Server): The server to run. (Its listening socket should already be listening.)
+            client_factory (Callable): Creates the state for a newly accepted client. (Usually ClientState.)
+            max_handlers (int): The maximum number of commands being handled at once.
+        """
+        self.server = server
+        self.client_factory = client_factory
+        self.selector = selectors.DefaultSelector()
+        self.handler_pool = ThreadPoolExecutor(
+            max_workers=max_handlers, thread_name_prefix="handler"
+        )
+        # handler threads can't touch the selector, so they hand clients back through here
+        # (and poke the wakeup socket so the loop notices)
+        self.ready_lock = threading.Lock()
+        self.ready: List["ClientState"] = []
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+
+    def run(self) -> None:
+        """
+        Run the event loop. Runs indefinitely (or until interrupted).
+        """
+        listener = self.server.server
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, "accept")
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, "wakeup")
+        try:
+            while True:
+                for key, _ in self.selector.select():
+                    if key.data == "accept":
+                        self.accept()
+                    elif key.data == "wakeup":
+                        self.requeue()
+                    else:
+                        self.read(key.data)
+        finally:
+            self.handler_pool.shutdown(wait=False)
+            for key in list(self.selector.get_map().values()):
+                if key.data not in ("accept", "wakeup"):
+                    key.fileobj.close()  # type: ignore # it's a socket
+            self.selector.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
+
+    def accept(self) -> None:
+        """
+        Accept every pending connection and put them on the loop.
+        """
+        while True:
+            try:
+                conn, addr = self.server.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            logger.debug(f"Accepted connection from {addr}")
+            conn.setblocking(False)
+            self.selector.register(
+                conn, selectors.EVENT_READ, self.client_factory(conn, addr)
+            )
+
+    def read(self, client: "ClientState") -> None:
+        """
+        Read whatever the client has sent, and hand it off if there's a complete message.
+        """
+        try:
+            data = client.conn.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.debug(f"Error reading from {client.addr}: {e}")
+            data = b""
+        if not data:
+            self.close(client)
+            return
+        client.stream.feed(data)
+        try:
+            complete = client.stream.has_message()
+        except ProtocolError as e:
+            logger.warning(f"Dropping {client.addr}: {e}")
+            self.close(client)
+            return
+        if complete:
+            # the handler does blocking io on the socket, so it has to come off the loop until it's done
+            self.selector.unregister(client.conn)
+            client.conn.setblocking(True)
+            self.handler_pool.submit(self.handle, client)
+
+    def handle(self, client: "ClientState") -> None:
+        """
+        Handle every buffered message from a client. (Runs on the handler pool, not the loop.)
+        """
+        try:
+            while True:
+                recieved_obj = client.stream.next_message()
+                if recieved_obj is None:
+                    break
+                self.server.respond(client, recieved_obj)
+            client.conn.setblocking(False)
+        except (OSError, ProtocolError) as e:
+            logger.debug(f"Connection to {client.addr} broke: {e}")
+            client.conn.close()
+            return
+        with self.ready_lock:
+            self.ready.append(client)
+        try:
+            self.wakeup_send.send(b"\0")
+        except BlockingIOError:
+            pass  # the loop already has plenty of wakeups to get through
+
+    def requeue(self) -> None:
+        """
+        Put clients that have finished being handled back on the loop.
+        """
+        try:
+            while self.wakeup_recv.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        with self.ready_lock:
+            ready, self.ready = self.ready, []
+        for client in ready:
+            self.selector.register(client.conn, selectors.EVENT_READ, client)
+
+    def close(self, client: "ClientState") -> None:
+        """
+        Take a client off the loop and close their socket.
+        """
+        logger.debug(f"Client {client.addr} disconnected")
+        self.selector.unregister(client.conn)
+        client.conn.close()
@@ -5,15 +5,24 @@ Abandon all hope, all ye who enter here. ~Luna
 """
 
 import json
+import math
+import shutil
 import subprocess
-from concurrent.futures import Executor, wait
+import tempfile
+from concurrent.futures import Executor, Future, as_completed, wait
 from logging import getLogger
 from pathlib import Path
 from platform import processor, system
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Tuple
 
 from csc317_final_project.server.db import Database
+from csc317_final_project.server.pack import (
+    count_segments,
+    get_loose_segments,
+    pack_segments,
+)
 from csc317_final_project.server.quality import VideoQuality
+from csc317_final_project.server.scheduler import EncodeScheduler
 
 logger = getLogger(__name__)
 
@@ -104,6 +113,198 @@ def get_video_info(video_path: Path) -> Dict:
         return {}
 
 
+def get_video_encoder() -> str:
+    """
+    Pick the FFmpeg video encoder to use on this system.
+
+    Returns:
+        str: The name of the encoder.
+    """
+    if system() == "Darwin" and processor() == "arm":
+        # we're running on the m serires: use the hardware acceleration
+        logger.debug("Using Apple silicon hardware acceleration.")
+        return "h264_videotoolbox"
+    # unknown! use the software encoder
+    # there's more hardware acceleration stuff, but... i'm the one running this,
+    # so i really only care about my system.
+    logger.debug("Using software encoding - good luck.")
+    return "libx264"
+
+
+def get_quality_ladder(source_height: int) -> List[Tuple]:
+    """
+    Get the resolution configs (see VideoQuality.get_resolution_config) of every quality a video should be
+    converted to, from highest to lowest. (All qualities lower or equal to the source, or just 144p if there are none.)
+
+    Args:
+        source_height (int): The height of the original video.
+
+    Returns:
+        List[Tuple]: The resolution configs.
+    """
+    valid_configs = [
+        quality.get_resolution_config()
+        for quality in VideoQuality
+        if quality.get_video_height() <= source_height
+        and quality.get_video_height() > 0
+    ]
+    if not valid_configs:
+        logger.error(
+            "No valid resolution configurations found. Falling back to ONLY 144p."
+        )
+        valid_configs = [
+            VideoQuality.ONE_FORTY_FOUR_P.get_resolution_config(),
+        ]
+    return valid_configs  # type: ignore # get_resolution_config only returns None for unknown qualities
+
+
+def get_thread_args(threads: int) -> List[str]:
+    """
+    Get the FFmpeg arguments limiting an output's encoder to a number of threads. (None if threads is 0.)
+    """
+    return ["-threads", str(threads)] if threads > 0 else []
+
+
+def get_keyframe_args(segment_length: float) -> List[str]:
+    """
+    Get the FFmpeg arguments forcing a keyframe every segment_length seconds. The segment muxer can only cut on a
+    keyframe, so without these, segments end wherever the encoder happened to put one, and segment n stops starting
+    at n * segment_length. (Which the client counts on when seeking.)
+    """
+    return ["-force_key_frames", f"expr:gte(t,n_forced*{segment_length})"]
+
+
+def get_range_args(start: float = 0, length: float = 0) -> List[str]:
+    """
+    Get the FFmpeg input arguments (they go before -i) for only converting part of a video, from start, for length
+    seconds. (0 means from the beginning, and to the end.) The seek is exact, since the video's decoded anyway.
+    """
+    args = []
+    if start > 0:
+        args += ["-ss", str(start)]
+    if length > 0:
+        args += ["-t", str(length)]
+    return args
+
+
+def expected_segments(duration: float, segment_length: float) -> int:
+    """
+    Get how many segments a video of duration seconds gets split into. (Every one but the last is exactly
+    segment_length long, see get_keyframe_args. A tail of under a hundredth of a segment doesn't count - that's
+    just the audio running a frame longer than the video.)
+    """
+    return max(1, math.ceil(duration / segment_length - 0.01))
+
+
+def submit_wide(executor: Executor, width: int, fn, *args) -> Future:
+    """
+    Submit an FFmpeg run that encodes width outputs at once, so it takes a slot per output. (Other executors
+    don't have slots, so it's just submitted.) See EncodeScheduler.submit_wide
+    """
+    if isinstance(executor, EncodeScheduler):
+        return executor.submit_wide(width, fn, *args)
+    return executor.submit(fn, *args)
+
+
+def run_ffmpeg(
+    args: List[str],
+    duration: float = 0,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> None:
+    """
+    Run FFmpeg, raising if it fails.
+
+    Args:
+        args (List[str]): FFmpeg's arguments.
+        duration (float): The length of the input in seconds. (Needed to work out the progress.)
+        on_progress (Optional[Callable]): If given, called with how far along FFmpeg is (0 to 1) as it goes.
+    """
+    if on_progress is None or duration <= 0:
+        process = subprocess.run(
+            ["ffmpeg", *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        returncode, stderr = process.returncode, process.stderr
+    else:
+        # stderr goes to a file, so FFmpeg can't get stuck on a full pipe while we're reading stdout
+        with tempfile.TemporaryFile() as stderr_file:
+            # -progress writes key=value lines to stdout, a block every half a second or so
+            popen = subprocess.Popen(
+                ["ffmpeg", "-progress", "pipe:1", "-nostats", *args],
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+            )
+            assert popen.stdout is not None
+            for line in popen.stdout:
+                key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+                # (out_time_ms is in microseconds too, older versions only have that one)
+                if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                    on_progress(min(int(value) / 1_000_000 / duration, 1.0))
+            returncode = popen.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+    if returncode != 0:
+        logger.error(f"FFmpeg error: {stderr}")
+        raise RuntimeError(f"FFmpeg failed with error: {stderr.decode('utf-8')}")
+
+
+def get_convert_args(
+    input_file: str,
+    output_path: Path,
+    target_height: int,
+    prefix: str,
+    crf: int,
+    preset: str,
+    video_bitrate: str,
+    audio_bitrate: str,
+    segment_length: float,
+    threads: int = 0,
+    start: float = 0,
+    length: float = 0,
+) -> List[str]:
+    """
+    Get the FFmpeg arguments for converting a video to a single quality. (See convert_video for what they all mean.)
+    The input can be anything FFmpeg can read from, including "pipe:0" for stdin. (See ingest.py)
+    """
+    hw_accel = get_video_encoder()
+    # Alright this command's a bit of a mess, but:
+    # It takes the input file, re-encodes it (video with libx264 w/preset and crf; audio with aac),
+    # with the max bitrate set to the video_bitrate, and the audio bitrate set to audio_bitrate.
+    # Also: rescales the video to the target height (adjusting width to maintain aspect ratio)
+    # and splits the video into segments of segment_length seconds (with the segment number appended to the filename).
+    return [
+        *get_range_args(start, length),
+        "-i",
+        input_file,
+        "-c:v",
+        hw_accel,
+        "-preset",
+        preset,
+        "-crf",
+        str(crf),
+        "-maxrate",
+        video_bitrate,
+        "-vf",
+        f"scale=-1:{target_height}",
+        "-c:a",
+        "aac",
+        "-b:a",
+        audio_bitrate,
+        "-movflags",
+        "+faststart",
+        *get_thread_args(threads),
+        *get_keyframe_args(segment_length),
+        "-f",
+        "segment",
+        "-segment_time",
+        str(segment_length),
+        "-reset_timestamps",
+        "1",
+        str(output_path / f"{prefix}_%d.mp4"),
+    ]
+
+
 def convert_video(
     input_file: Path,
     output_path: Path,
@@ -114,6 +315,11 @@ def convert_video(
     video_bitrate: str,
     audio_bitrate: str,
     segment_length: float,
+    duration: float = 0,
+    on_progress: Optional[Callable[[float], None]] = None,
+    threads: int = 0,
+    start: float = 0,
+    length: float = 0,
 ) -> None:
     """
     Convert a video file to a specified format and quality. Also splits the video into segments.
@@ -127,32 +333,101 @@ def convert_video(
         preset (str): The encoding preset for FFmpeg.
         video_bitrate (str): The video bitrate for the output file.
         audio_bitrate (str): The audio bitrate for the output file.
-        segment_length (float): The length of each segment in seconds. (Approximate - video may not split exactly at this length)
+        segment_length (float): The length of each segment in seconds. (Every segment but the last is exactly this
+            long, see get_keyframe_args.)
+        duration (float): The length of the video in seconds. (Only needed for on_progress.)
+        on_progress (Optional[Callable]): Called with how far along the conversion is (0 to 1). (See run_ffmpeg)
+        threads (int): How many threads FFmpeg may use. 0 lets FFmpeg decide. (See scheduler.py)
+        start (float): Where in the video to start converting from, in seconds. (See get_range_args)
+        length (float): How many seconds of the video to convert. 0 converts the rest of it.
     """
     logger.info(
         f"Converting video: {input_file} to {output_path} with target height {target_height}"
     )
 
-    if system() == "Darwin" and processor() == "arm":
-        # we're running on the m serires: use the hardware acceleration
-        logger.debug("Using Apple silicon hardware acceleration.")
-        hw_accel = "h264_videotoolbox"
-    else:
-        # unknown! use the software encoder
-        # there's more hardware acceleration stuff, but... i'm the one running this,
-        # so i really only care about my system.
-        logger.debug("Using software encoding - good luck.")
-        hw_accel = "libx264"
-    # Alright this command's a bit of a mess, but:
-    # It takes the input file, re-encodes it (video with libx264 w/preset and crf; audio with aac),
-    # with the max bitrate set to the video_bitrate, and the audio bitrate set to audio_bitrate.
-    # Also: rescales the video to the target height (adjusting width to maintain aspect ratio)
-    # and splits the video into segments of segment_length seconds (with the segment number appended to the filename).
-    process = subprocess.run(
-        [
-            "ffmpeg",
-            "-i",
+    run_ffmpeg(
+        get_convert_args(
             str(input_file),
+            output_path,
+            target_height,
+            prefix,
+            crf,
+            preset,
+            video_bitrate,
+            audio_bitrate,
+            segment_length,
+            threads,
+            start,
+            length,
+        ),
+        duration,
+        on_progress,
+    )
+    logger.info(f"Video {input_file} converted to {output_path}")
+
+
+def convert_video_ladder(
+    input_file: Path,
+    video_root: Path,
+    configs: List[Tuple],
+    video_id: int,
+    segment_length: float,
+    pack: bool = False,
+    threads: int = 0,
+    start: float = 0,
+    length: float = 0,
+) -> None:
+    """
+    Convert a video file to several qualities at once. (The same output as running convert_video for each config.)
+
+    The original only gets decoded once: a split filter fans the decoded frames out to a scaler and encoder
+    (and segment muxer) per quality, instead of every quality decoding the whole original again.
+
+    Args:
+        input_file (Path): The path to the input video file.
+        video_root (Path): The video's directory. (Each quality's segments go in a subdirectory, like process_video.)
+        configs (List[Tuple]): The resolution configs to convert to. (See VideoQuality.get_resolution_config)
+        video_id (int): The ID of the video. (Used to name the segments.)
+        segment_length (float): The length of each segment in seconds. (Exact, like convert_video.)
+        pack (bool): Whether to pack each quality's segments into a single file afterwards. (See pack.py)
+        threads (int): How many threads each quality's encoder may use. 0 lets FFmpeg decide. (So this takes as
+            much of the machine as a run per quality would, see submit_wide.)
+        start (float): Where in the video to start converting from, in seconds. (See get_range_args)
+        length (float): How many seconds of the video to convert. 0 converts the rest of it.
+    """
+    logger.info(
+        f"Converting video: {input_file} to {len(configs)} qualities in a single pass"
+    )
+    hw_accel = get_video_encoder()
+
+    # [0:v] split=3 [v0][v1][v2]; [v0] scale=-1:1080 [out0]; [v1] scale=-1:720 [out1]; ...
+    filter_graph = f"[0:v]split={len(configs)}" + "".join(
+        f"[v{i}]" for i in range(len(configs))
+    )
+    for i, (height, *_) in enumerate(configs):
+        filter_graph += f";[v{i}]scale=-1:{height}[out{i}]"
+
+    command = [
+        "ffmpeg",
+        *get_range_args(start, length),
+        "-i",
+        str(input_file),
+        "-filter_complex",
+        filter_graph,
+    ]
+    output_paths = []
+    for i, (height, name, crf, preset, video_bitrate, audio_bitrate) in enumerate(
+        configs
+    ):
+        output_path = video_root / str(VideoQuality(int(name)))
+        output_path.mkdir(parents=True, exist_ok=True)
+        output_paths.append(output_path)
+        # everything from here to the output file only applies to that output
+        command += [
+            "-map",
+            f"[out{i}]",
+            "-map",
+            "0:a:0?",  # audio is optional
             "-c:v",
             hw_accel,
             "-preset",
@@ -161,22 +436,25 @@ def convert_video(
             str(crf),
             "-maxrate",
             video_bitrate,
-            "-vf",
-            f"scale=-1:{target_height}",
             "-c:a",
             "aac",
             "-b:a",
             audio_bitrate,
             "-movflags",
             "+faststart",
+            *get_thread_args(threads),
+            *get_keyframe_args(segment_length),
             "-f",
             "segment",
             "-segment_time",
             str(segment_length),
             "-reset_timestamps",
             "1",
-            str(output_path / f"{prefix}_%d.mp4"),
-        ],
+            str(output_path / f"{video_id}_{name}_%d.mp4"),
+        ]
+
+    process = subprocess.run(
+        command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
@@ -185,7 +463,164 @@ def convert_video(
         raise RuntimeError(
             f"FFmpeg failed with error: {process.stderr.decode('utf-8')}"
         )
-    logger.info(f"Video {input_file} converted to {output_path}")
+    if pack:
+        for output_path in output_paths:
+            pack_segments(output_path)
+    logger.info(f"Video {input_file} converted to {len(configs)} qualities")
+
+
+def convert_video_chunked(
+    executor: Executor,
+    input_file: Path,
+    video_root: Path,
+    configs: List[Tuple],
+    video_id: int,
+    segment_length: float,
+    chunk_length: float,
+    duration: float,
+    single_pass: bool = False,
+    pack: bool = False,
+    on_quality_ready: Optional[Callable[[VideoQuality], None]] = None,
+    threads: int = 0,
+) -> None:
+    """
+    Convert a video file to several qualities, by splitting it into chunks and converting every chunk in parallel.
+    (The same output as running convert_video for each config, just spread over more cores.)
+
+    Each chunk is converted by its own FFmpeg process (reading just its part of the original), into its own
+    directory. Once every chunk of a quality is done, its segments are moved into place and renumbered, so they're
+    numbered continously across chunks. Chunks are cut at an exact multiple of segment_length (chunk_length is
+    rounded up to one), so every chunk but the last is a whole number of full segments, and segment n still starts
+    at n * segment_length, same as convert_video.
+
+    Args:
+        executor (Executor): The executor to convert the chunks on.
+        input_file (Path): The path to the input video file.
+        video_root (Path): The video's directory. (Each quality's segments go in a subdirectory, like process_video.)
+        configs (List[Tuple]): The resolution configs to convert to. (See VideoQuality.get_resolution_config)
+        video_id (int): The ID of the video. (Used to name the segments.)
+        segment_length (float): The length of each segment in seconds.
+        chunk_length (float): The length of each chunk in seconds. (Rounded up to a multiple of segment_length.)
+        duration (float): The length of the video in seconds.
+        single_pass (bool): Whether to convert each chunk to every quality but the lowest in a single pass. (See
+            convert_video_ladder and process_video)
+        pack (bool): Whether to pack each quality's segments into a single file afterwards. (See pack.py)
+        on_quality_ready (Optional[Callable]): Called with each quality once its segments are in place.
+        threads (int): How many threads each FFmpeg run may use. 0 lets FFmpeg decide. (See scheduler.py)
+    """
+    segments_per_chunk = expected_segments(chunk_length, segment_length)
+    chunk_length = segments_per_chunk * segment_length
+    num_chunks = expected_segments(duration, chunk_length)
+    # (the last chunk runs to the end, whatever's left of it)
+    chunks = [
+        (i * chunk_length, chunk_length if i < num_chunks - 1 else 0)
+        for i in range(num_chunks)
+    ]
+    chunk_root = video_root / "chunks"
+    logger.info(f"Converting {num_chunks} chunks of {input_file} in parallel")
+
+    # lowest quality first, so it's the first one done
+    qualities = [VideoQuality(int(config[1])) for config in reversed(configs)]
+    separate_configs, ladder_configs = configs, []
+    if single_pass:
+        # the lowest quality still gets runs of its own, so it isn't waiting on the whole ladder. (See process_video)
+        *ladder_configs, lowest_config = configs
+        separate_configs = [lowest_config]
+
+    futures: Dict[VideoQuality, List[Future]] = {}
+    for height, name, crf, preset, video_bitrate, audio_bitrate in reversed(
+        separate_configs
+    ):
+        quality = VideoQuality(int(name))
+        futures[quality] = []
+        for i, (start, length) in enumerate(chunks):
+            output_path = chunk_root / str(i) / str(quality)
+            output_path.mkdir(parents=True, exist_ok=True)
+            futures[quality].append(
+                executor.submit(
+                    convert_video,
+                    input_file,
+                    output_path,
+                    height,
+                    f"{video_id}_{name}",
+                    crf,
+                    preset,
+                    video_bitrate,
+                    audio_bitrate,
+                    segment_length,
+                    threads=threads,
+                    start=start,
+                    length=length,
+                )
+            )
+
+    if ladder_configs:
+        ladder = [
+            submit_wide(
+                executor,
+                len(ladder_configs),
+                convert_video_ladder,
+                input_file,
+                chunk_root / str(i),
+                ladder_configs,
+                video_id,
+                segment_length,
+                False,
+                threads,
+                start,
+                length,
+            )
+            for i, (start, length) in enumerate(chunks)
+        ]
+        for _, name, *_ in ladder_configs:
+            futures[VideoQuality(int(name))] = ladder
+
+    try:
+        for quality in qualities:
+            for future in futures[quality]:
+                future.result()  # (re-raises if any chunk failed)
+
+            chunk_segments = [
+                get_loose_segments(chunk_root / str(i) / str(quality))
+                for i in range(num_chunks)
+            ]
+            for i, segments in enumerate(chunk_segments[:-1]):
+                if len(segments) != segments_per_chunk:
+                    # (everything after it would be numbered off by the difference)
+                    raise RuntimeError(
+                        f"Chunk {i} of {input_file} came out as {len(segments)} {quality} segments, "
+                        f"not {segments_per_chunk}"
+                    )
+
+            # stitch the chunks back together
+            output_path = video_root / str(quality)
+            output_path.mkdir(parents=True, exist_ok=True)
+            segment_id = 0
+            for segments in chunk_segments:
+                for segment in segments:
+                    segment.replace(
+                        output_path / f"{video_id}_{quality.value}_{segment_id}.mp4"
+                    )
+                    segment_id += 1
+            if segment_id != expected_segments(duration, segment_length):
+                logger.warning(
+                    f"{input_file} came out as {segment_id} {quality} segments, "
+                    f"expected {expected_segments(duration, segment_length)}"
+                )
+            if pack:
+                pack_segments(output_path)
+            if on_quality_ready is not None:
+                on_quality_ready(quality)
+    finally:
+        wait(
+            [
+                future
+                for quality_futures in futures.values()
+                for future in quality_futures
+            ]
+        )
+        shutil.rmtree(chunk_root, ignore_errors=True)
+    logger.info(f"Video {input_file} converted from {num_chunks} chunks")
 
 
 def generate_thumbnail(
@@ -237,8 +672,101 @@ def generate_thumbnail(
     logger.info(f"Thumbnail generated: {output_file}")
 
 
+def convert_and_pack_video(
+    pack: bool, input_file: Path, output_path: Path, *args
+) -> None:
+    """
+    Convert a video (see convert_video), then pack its segments into a single file if asked to. (See pack.py)
+
+    Args:
+        pack (bool): Whether to pack the segments.
+        input_file (Path): The path to the input video file.
+        output_path (Path): The path to where the output video files will be saved.
+        *args: The rest of convert_video's arguments.
+    """
+    convert_video(input_file, output_path, *args)
+    if pack:
+        pack_segments(output_path)
+
+
+def convert_rendition(
+    db: Database,
+    uploaded_video: Path,
+    video_id: int,
+    quality: VideoQuality,
+    pack: bool = False,
+    on_progress: Optional[Callable[[float], None]] = None,
+    threads: int = 0,
+    job: Optional[Tuple[int, str]] = None,
+) -> None:
+    """
+    Convert an uploaded video to a single quality, and mark that quality as ready once it's done.
+    Anything left over in the quality's directory (from a conversion that never finished) is thrown away first.
+
+    Args:
+        db (Database): The database object to update video information.
+        uploaded_video (Path): The path to the uploaded video file.
+        video_id (int): The ID of the video in the database.
+        quality (VideoQuality): The quality to convert to.
+        pack (bool): Whether to pack the segments into a single file. (See pack.py)
+        on_progress (Optional[Callable]): Called with how far along the conversion is (0 to 1). (See run_ffmpeg)
+        threads (int): How many threads FFmpeg may use. 0 lets FFmpeg decide. (See scheduler.py)
+        job (Optional[Tuple[int, str]]): The job doing the conversion, and its worker. If the job's been cancelled
+            by the time it's done, the quality isn't marked as ready. (See Database.mark_rendition_ready)
+    """
+    video_info = get_video_info(uploaded_video)
+    if not video_info:
+        raise RuntimeError("Failed to get video info.")
+    for height, name, crf, preset, video_bitrate, audio_bitrate in get_quality_ladder(
+        video_info.get("height", 0)
+    ):
+        if int(name) == int(quality):
+            break
+    else:
+        raise ValueError(f"Video {video_id} can't be converted to {quality}")
+
+    output_path = uploaded_video.parent / str(quality)
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    output_path.mkdir(parents=True)
+    convert_and_pack_video(
+        pack,
+        uploaded_video,
+        output_path,
+        height,
+        f"{video_id}_{name}",
+        crf,
+        preset,
+        video_bitrate,
+        audio_bitrate,
+        3,  # segment length in seconds
+        video_info["duration"],
+        on_progress,
+        threads,
+    )
+    if not db.mark_rendition_ready(
+        video_id,
+        int(quality),
+        count_segments(output_path),
+        video_info["duration"],
+        job,
+    ):
+        logger.info(
+            f"Video {video_id} was deleted or reprocessed, not publishing {quality}"
+        )
+
+
 def process_video(
-    executor: Executor, db: Database, uploaded_video: Path, video_id: int
+    executor: Executor,
+    db: Database,
+    uploaded_video: Path,
+    video_id: int,
+    pack: bool = False,
+    single_pass: bool = False,
+    chunk_length: Optional[float] = None,
+    skip_qualities: Optional[List[int]] = None,
+    threads: int = 0,
+    job: Optional[Tuple[int, str]] = None,
 ) -> None:
     """
     Process an uploaded video file, converting it to a more compatible format and splitting into segments.
@@ -249,6 +777,15 @@ def process_video(
         db (Database): The database object to update video information.
         uploaded_video (Path): The path to the video file to be processed.
         video_id (int): The ID of the video in the database.
+        pack (bool): Whether to pack each quality's segments into a single file. (See pack.py)
+        single_pass (bool): Whether to convert every quality but the lowest in a single FFmpeg run. (See
+            convert_video_ladder. The lowest one is still converted on its own, so the video shows up just as soon,
+            but the rest only show up once the slowest of them is done.)
+        chunk_length (Optional[float]): If set, videos longer than two chunks are split into chunks of this
+            many seconds, which are converted in parallel. (See convert_video_chunked)
+        skip_qualities (Optional[List[int]]): Qualities that are already done, and shouldn't be converted again.
+        threads (int): How many threads each FFmpeg run may use. 0 lets FFmpeg decide. (See scheduler.py)
+        job (Optional[Tuple[int, str]]): The job doing the conversion, and its worker. (See convert_rendition)
     """
     logger.info(f"Processing video: {uploaded_video}")
     if not does_ffmpeg_exist():
@@ -262,29 +799,62 @@ def process_video(
     source_height = video_info.get("height", 0)
 
     valid_configs = [
-        quality.get_resolution_config()
-        for quality in VideoQuality
-        if quality.get_video_height() <= source_height
-        and quality.get_video_height() > 0
+        config
+        for config in get_quality_ladder(source_height)
+        if int(config[1]) not in (skip_qualities or [])
     ]
-    if not valid_configs:
-        logger.error(
-            "No valid resolution configurations found. Falling back to ONLY 144p."
-        )
-        valid_configs = [
-            VideoQuality.ONE_FORTY_FOUR_P.get_resolution_config(),
-        ]
 
-    # note that, for scalability, we should really be using a separate worker process
-    # and we'll submit the videos to a queue that will then be processed by the worker.
-    # for now, though, this is fine.
+    # note that this only waits on the executor, and never runs on it - if it did, it could end up holding the
+    # slot its own conversions are waiting for. (see scheduler.py)
     # generate the thumbnail first
 
     thumbnail_output_file = uploaded_video.parent / "thumbnail.jpg"
     executor.submit(generate_thumbnail, uploaded_video, thumbnail_output_file)
+    if not valid_configs:
+        return
+
+    def publish(quality: VideoQuality) -> None:
+        # called as each quality finishes, so the video shows up as soon as the lowest quality's done,
+        # and the max quality goes up from there
+        if not db.mark_rendition_ready(
+            video_id,
+            int(quality),
+            count_segments(uploaded_video.parent / str(quality)),
+            video_info["duration"],
+            job,
+        ):
+            logger.info(
+                f"Video {video_id} was deleted or reprocessed, not publishing {quality}"
+            )
+
+    if chunk_length and video_info["duration"] > chunk_length * 2:
+        convert_video_chunked(
+            executor,
+            uploaded_video,
+            uploaded_video.parent,
+            valid_configs,
+            video_id,
+            3,  # segment length in seconds
+            chunk_length,
+            video_info["duration"],
+            single_pass,
+            pack,
+            publish,
+            threads,
+        )
+        return
 
+    separate_configs, ladder_configs = valid_configs, []
+    if single_pass:
+        # the lowest quality still gets a run of its own (submitted first, so it gets a slot first), so the video
+        # shows up without waiting for the whole ladder (4K and all), and a ladder that fails doesn't take it down
+        # too. everything above it is published together, once the ladder's done.
+        *ladder_configs, lowest_config = valid_configs
+        separate_configs = [lowest_config]
+
+    futures: Dict[Future, List[VideoQuality]] = {}
     for height, name, crf, preset, video_bitrate, audio_bitrate in reversed(  # type: ignore # we're fine
-        valid_configs
+        separate_configs
     ):
         # start from lowest quality and go up
         output_path = uploaded_video.parent / str(
@@ -292,7 +862,8 @@ def process_video(
         )  # ...thanks justin
         output_path.mkdir(parents=True, exist_ok=True)
         future = executor.submit(
-            convert_video,
+            convert_and_pack_video,
+            pack,
             uploaded_video,
             output_path,
             height,
@@ -302,23 +873,37 @@ def process_video(
             video_bitrate,
             audio_bitrate,
             3,  # segment length in seconds
+            video_info["duration"],
+            None,
+            threads,
         )
-        if name == valid_configs[0][1]:  # type: ignore # we're fine
-            # this is the last one (highest quality), so we should update the database with the video info
-            # and set the max quality to this one.
-            wait([future])
-            db.update_video_info(
-                video_id,
-                video_info["duration"],
-                len(
-                    list(
-                        (uploaded_video.parent / str(VideoQuality(int(name)))).glob(
-                            "*.mp4"
-                        )
-                    )
-                ),
-                int(name),  # hate hate hate
+        futures[future] = [VideoQuality(int(name))]
+
+    if ladder_configs:
+        future = submit_wide(
+            executor,
+            len(ladder_configs),
+            convert_video_ladder,
+            uploaded_video,
+            uploaded_video.parent,
+            ladder_configs,
+            video_id,
+            3,  # segment length in seconds
+            pack,
+            threads,
+        )
+        futures[future] = [
+            VideoQuality(int(name)) for _, name, *_ in reversed(ladder_configs)
+        ]
+
+    for future in as_completed(futures):
+        if future.exception() is not None:
+            logger.error(
+                f"Failed to convert video {video_id} to {', '.join(map(str, futures[future]))}: {future.exception()}"
             )
+            continue
+        for quality in futures[future]:
+            publish(quality)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@ from pathlib import Path
 
 from csc317_final_project.server.quality import VideoQuality
 
+PACK_FILE_NAME = "segments.pack"
+
 
 def get_segment_path(
     server_path: Path,
@@ -32,6 +34,21 @@ def get_segment_path(
     )
 
 
+def get_pack_path(server_path: Path, video_id: str, quality: VideoQuality) -> Path:
+    """
+    Get the path to the pack holding every segment of a video's quality. (See pack.py)
+
+    Args:
+        server_path (Path): The path to the server directory.
+        video_id (str): The ID of the video.
+        quality (VideoQuality): The quality of the video.
+
+    Returns:
+        Path: The path to the pack.
+    """
+    return get_video_root_path(server_path, video_id) / str(quality) / PACK_FILE_NAME
+
+
 def get_thumbnail_path(server_path: Path, video_id: str) -> Path:
     """
     Get the path to a video thumbnail.
@@ -64,6 +81,20 @@ def get_original_video_path(server_path: Path, video_id: str) -> Path:
     return video_dir / "original.mp4"  # fallback to mp4 if not found
 
 
+def get_partial_upload_path(server_path: Path, upload_id: str) -> Path:
+    """
+    Get the path to a chunked upload that hasn't been committed yet.
+
+    Args:
+        server_path (Path): The path to the server directory.
+        upload_id (str): The ID of the upload.
+
+    Returns:
+        Path: The path to the partially uploaded file.
+    """
+    return server_path / "uploads" / f"{upload_id}.part"
+
+
 def get_video_root_path(server_path: Path, video_id: str) -> Path:
     """
     Get the path to a video.
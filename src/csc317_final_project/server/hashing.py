@@ -0,0 +1,147 @@
+"""
+Password hashing, off the request threads.
+
+bcrypt is slow on purpose (a few hundred milliseconds a hash), and LOGIN and REGISTER used to run it right on the
+thread handling the client. A burst of logins could then tie up every handler thread (with the selectors engine, see
+event_loop.py) and leave nothing to serve segments with. Hashing goes to a small process pool instead, and only so
+many hashes may be waiting at once: past that, logins are turned away straight away, instead of piling up.
+"""
+
+import collections
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from logging import getLogger
+from typing import Callable, Deque
+
+import bcrypt
+
+logger = getLogger(__name__)
+
+LATENCY_WINDOW = 1000  # how many recent hashes the percentiles are worked out from
+
+
+def hash_password(password: str) -> str:
+    """
+    Hash a password with bcrypt (with a new salt).
+    """
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+
+
+def check_password(password: str, hashed: str) -> bool:
+    """
+    Check a password against a bcrypt hash.
+    """
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+def watch_parent(parent_pid: int) -> None:
+    """
+    Exit once the server's gone. (Runs in each hashing process, since they'd otherwise outlive a killed server.)
+    """
+
+    def watch() -> None:
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class ServerBusyError(Exception):
+    """
+    Raised when too many hashes are waiting already.
+    """
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a bounded process pool. Keeps track of how deep its queue is, and how long hashes take.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 16) -> None:
+        """
+        Args:
+            workers (int): How many processes hash at once.
+            max_pending (int): How many hashes may be queued (or running) at once. Any more are turned away.
+        """
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending)
+        # (spawn, not fork, as forking a process full of threads can copy locks someone else was holding)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=watch_parent,
+            initargs=(os.getpid(),),
+        )
+        self.pool.submit(int)  # starts the processes now, instead of on the first login
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.latencies: Deque[float] = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def hash(self, password: str) -> str:
+        """
+        Hash a password. Raises ServerBusyError if too many hashes are waiting already.
+        """
+        return self.run(hash_password, password)
+
+    def check(self, password: str, hashed: str) -> bool:
+        """
+        Check a password against its hash. Raises ServerBusyError if too many hashes are waiting already.
+        """
+        return self.run(check_password, password, hashed)
+
+    def run(self, fn: Callable, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            logger.debug(
+                f"Turned away a {fn.__name__}, {self.max_pending} already waiting"
+            )
+            raise ServerBusyError("Server is busy, try again in a moment")
+        with self.lock:
+            self.pending += 1
+        submitted = time.monotonic()
+        try:
+            future: Future = self.pool.submit(fn, *args)
+            return future.result()
+        finally:
+            latency = time.monotonic() - submitted
+            self.slots.release()
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.latencies.append(latency)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.pool.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        """
+        Get the hasher's counters. (Latencies are in seconds, from being queued to being done.)
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                "workers": self.workers,
+                "queue_depth": self.pending,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "mean_latency": self.total_latency / self.completed
+                if self.completed
+                else 0.0,
+                "p95_latency": latencies[int(len(latencies) * 0.95)]
+                if latencies
+                else 0.0,
+                "max_latency": self.max_latency,
+            }
@@ -0,0 +1,284 @@
+"""
+Encoding uploads while they're still arriving.
+
+Normally, an upload has to finish before any converting starts, so a video takes (upload time + conversion time)
+to show up. Some containers can be decoded front to back, straight out of a pipe (Matroska/WebM, MPEG-TS, and MP4s
+with their index up front, which includes fragmented MP4s). For those, the server can pipe the upload into FFmpeg
+as it's received, converting the lowest quality at the same time, so the video's watchable almost as soon as the
+upload's done. Anything else (or any failure along the way) just falls back to the normal path. (See jobs.py)
+"""
+
+import queue
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+from logging import getLogger
+from pathlib import Path
+from typing import IO, Optional
+
+from csc317_final_project.server.db import Database
+from csc317_final_project.server.ffmpeg import get_convert_args, get_video_info
+from csc317_final_project.server.pack import count_segments, pack_segments
+from csc317_final_project.server.quality import VideoQuality
+from csc317_final_project.server.scheduler import EncodeScheduler
+
+logger = getLogger(__name__)
+
+STREAMABLE_EXTENSIONS = {".mkv", ".webm", ".ts", ".mts"}
+ISO_BMFF_EXTENSIONS = {
+    ".mp4",
+    ".m4v",
+    ".mov",
+}  # streamable only if the moov box comes before the mdat box
+LIVE_QUALITY = (
+    VideoQuality.ONE_FORTY_FOUR_P
+)  # every video has this one (see get_quality_ladder)
+MAX_BACKLOG = 4096  # chunks (of up to 4 KiB) that FFmpeg can fall behind the upload by, before we give up on it
+
+
+def is_streamable(file_ext: str, head: bytes) -> bool:
+    """
+    Check if a video can be decoded straight out of a pipe, from its extension and its first few bytes.
+
+    Args:
+        file_ext (str): The video's extension (with the dot).
+        head (bytes): The start of the file.
+
+    Returns:
+        bool: Whether FFmpeg can read it from a pipe.
+    """
+    file_ext = file_ext.lower()
+    if file_ext in STREAMABLE_EXTENSIONS:
+        return True
+    if file_ext not in ISO_BMFF_EXTENSIONS:
+        return False
+    # walk the top level boxes: (size, type), where size 1 means a 64-bit size follows
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box_type = struct.unpack_from(">I4s", head, offset)
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False  # the index is at the end, FFmpeg would need to seek to it
+        if size == 1:
+            if offset + 16 > len(head):
+                return False
+            (size,) = struct.unpack_from(">Q", head, offset + 8)
+        if size < 8:
+            return False  # (0 means the box runs to the end of the file)
+        offset += size
+    return False
+
+
+class LiveIngest:
+    """
+    Pipes an upload into FFmpeg as it's received. Call feed with every chunk of the upload, then finish.
+
+    FFmpeg is fed from its own thread, so a slow FFmpeg never slows the upload down. If it falls too far behind
+    (or fails), it's stopped, and the upload carries on as normal.
+
+    FFmpeg only starts if the encoder has a slot free (it can't wait for one, the upload won't wait for it), and
+    holds the slot until it exits. (See scheduler.py)
+    """
+
+    def __init__(
+        self,
+        file_ext: str,
+        output_path: Path,
+        video_id: int,
+        threads: int = 0,
+        encoder: Optional[EncodeScheduler] = None,
+    ) -> None:
+        """
+        Args:
+            file_ext (str): The uploaded video's extension (with the dot).
+            output_path (Path): Where the segments go. (The LIVE_QUALITY directory of the video.)
+            video_id (int): The ID of the video. (Used to name the segments.)
+            threads (int): How many threads FFmpeg may use. 0 lets FFmpeg decide.
+            encoder (Optional[EncodeScheduler]): The encoder to take a slot from. If None, FFmpeg always starts.
+        """
+        self.file_ext = file_ext
+        self.output_path = output_path
+        self.video_id = video_id
+        self.threads = threads
+        self.encoder = encoder
+        self.has_slot = False
+        self.process: Optional[subprocess.Popen] = None
+        self.backlog: "queue.Queue[Optional[bytes]]" = queue.Queue(MAX_BACKLOG)
+        self.feeder: Optional[threading.Thread] = None
+        self.stderr: Optional[IO[bytes]] = (
+            None  # FFmpeg's output, for when it fails (opened in start)
+        )
+        self.started = False
+        self.failed = False
+
+    def feed(self, data: bytes) -> None:
+        """
+        Hands the next chunk of the upload to FFmpeg.
+        """
+        if not self.started:
+            self.started = True
+            if is_streamable(self.file_ext, data):
+                self.start()
+            else:
+                logger.debug(f"Video {self.video_id} can't be encoded live")
+                self.failed = True
+        if self.failed:
+            return
+        try:
+            self.backlog.put_nowait(data)
+        except queue.Full:
+            logger.warning(
+                f"FFmpeg fell behind the upload of video {self.video_id}, giving up on encoding it live"
+            )
+            self.abort()
+
+    def start(self) -> None:
+        height, name, crf, preset, video_bitrate, audio_bitrate = (
+            LIVE_QUALITY.get_resolution_config()  # type: ignore # always exists
+        )
+        if self.encoder is not None:
+            if not self.encoder.try_acquire():
+                logger.info(
+                    f"No encode slot free, not encoding video {self.video_id} live"
+                )
+                self.failed = True
+                return
+            self.has_slot = True
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        # (outlives this call, it's closed by finish or abort)
+        self.stderr = tempfile.TemporaryFile()  # noqa: SIM115
+        try:
+            self.process = subprocess.Popen(
+                [
+                    "ffmpeg",
+                    *get_convert_args(
+                        "pipe:0",
+                        self.output_path,
+                        height,
+                        f"{self.video_id}_{name}",
+                        crf,
+                        preset,
+                        video_bitrate,
+                        audio_bitrate,
+                        3,  # segment length in seconds
+                        self.threads,
+                    ),
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=self.stderr,
+            )
+        except OSError as e:
+            logger.error(f"Couldn't start FFmpeg: {e}")
+            self.failed = True
+            self.release_slot()
+            self.close_stderr()
+            return
+        self.feeder = threading.Thread(
+            target=self.run_feeder, name=f"ingest-{self.video_id}", daemon=True
+        )
+        self.feeder.start()
+        logger.info(f"Encoding video {self.video_id} to {LIVE_QUALITY} as it uploads")
+
+    def run_feeder(self) -> None:
+        assert self.process is not None and self.process.stdin is not None
+        try:
+            while True:
+                data = self.backlog.get()
+                if data is None:
+                    break
+                self.process.stdin.write(data)
+        except OSError:
+            self.failed = True  # FFmpeg quit (or was stopped) early
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def abort(self) -> None:
+        """
+        Stops FFmpeg, and throws away whatever it made. (The video will be converted the normal way.)
+        """
+        self.failed = True
+        if self.process is not None:
+            self.process.kill()
+            try:
+                self.backlog.put_nowait(None)
+            except queue.Full:
+                pass  # the feeder's stuck writing, and will fail now that FFmpeg's gone
+            self.process.wait()
+            self.release_slot()
+        if self.feeder is not None:
+            self.feeder.join()
+        self.close()
+
+    def finish(self) -> bool:
+        """
+        Waits for FFmpeg to finish, once the whole upload's been fed to it.
+
+        Returns:
+            bool: Whether LIVE_QUALITY was converted successfully. (If not, whatever was made is thrown away.)
+        """
+        if self.process is None or self.feeder is None or self.failed:
+            self.abort()
+            return False
+        while self.feeder.is_alive():
+            try:
+                self.backlog.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass  # (the feeder might've just died, in which case nobody's emptying the backlog)
+        self.feeder.join()
+        returncode = self.process.wait()
+        self.release_slot()
+        if self.failed or returncode != 0:
+            assert self.stderr is not None  # (opened along with the process)
+            self.stderr.seek(0)
+            logger.warning(
+                f"Live encode of video {self.video_id} failed, falling back: "
+                f"{self.stderr.read().decode('utf-8', 'replace')[-1000:]}"
+            )
+            self.abort()
+            return False
+        self.close_stderr()
+        return True
+
+    def release_slot(self) -> None:
+        if self.has_slot and self.encoder is not None:
+            self.has_slot = False
+            self.encoder.release()
+
+    def close_stderr(self) -> None:
+        if self.stderr is not None:
+            self.stderr.close()
+            self.stderr = None
+
+    def close(self) -> None:
+        self.close_stderr()
+        if self.process is not None:
+            shutil.rmtree(self.output_path, ignore_errors=True)
+
+    def publish(self, db: Database, uploaded_video: Path, pack: bool = False) -> None:
+        """
+        Marks LIVE_QUALITY as ready. (Call this after finish succeeds.)
+
+        Args:
+            db (Database): The database object to update video information.
+            uploaded_video (Path): The path to the (fully) uploaded video file.
+            pack (bool): Whether to pack the segments into a single file. (See pack.py)
+        """
+        video_info = get_video_info(uploaded_video)
+        if not video_info:
+            raise RuntimeError("Failed to get video info.")
+        if pack:
+            pack_segments(self.output_path)
+        db.mark_rendition_ready(
+            self.video_id,
+            int(LIVE_QUALITY),
+            count_segments(self.output_path),
+            video_info["duration"],
+        )
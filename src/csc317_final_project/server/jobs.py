@@ -0,0 +1,568 @@
+"""
+A persistent queue of transcoding jobs.
+
+Jobs live in the database (the jobs table), so they survive the server restarting or crashing. Every uploaded
+video gets a "video" job, which probes it, queues a "rendition" job for every quality it doesn't have yet, and
+makes its thumbnail. Each rendition job then converts the video to one quality.
+
+Workers claim jobs atomically (inside a BEGIN IMMEDIATE transaction), so any number of them, in any number of
+processes, can drain the same queue. A claimed job is leased to its worker, which has to keep renewing the lease
+while it works. If a worker dies, its lease runs out and the job goes back in the queue.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from csc317_final_project.server.db import Database, row_to_dict
+from csc317_final_project.server.dedup import hash_file, reuse_renditions
+from csc317_final_project.server.ffmpeg import (
+    convert_rendition,
+    generate_thumbnail,
+    get_quality_ladder,
+    get_video_info,
+    process_video,
+)
+from csc317_final_project.server.fs import (
+    get_original_video_path,
+    get_thumbnail_path,
+)
+from csc317_final_project.server.quality import VideoQuality
+from csc317_final_project.server.scheduler import EncodeScheduler
+
+logger = getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"  # out of attempts
+JOB_CANCELLED = "cancelled"  # the video was deleted or reprocessed
+
+KIND_VIDEO = "video"
+KIND_RENDITION = "rendition"
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30.0  # seconds, doubled after every failed attempt
+MAX_RETRY_DELAY = 60 * 60.0
+LEASE_SECONDS = 60.0
+PROGRESS_INTERVAL = 2.0  # seconds between progress updates, so we're not writing to the database constantly
+
+PRIORITY_VIDEO = -1  # probing is quick, and nothing else can start until it's done
+QUALITY_PRIORITY_STEP = 100000  # more seconds than any video we'd accept
+
+
+def job_priority(duration: float, quality: VideoQuality) -> int:
+    """
+    Get the priority of a rendition job. (Lower runs first.)
+
+    Every video's lowest quality comes before any video's higher qualities, so new uploads become watchable
+    quickly even while something big is being converted. Within a quality, shorter videos go first.
+
+    Args:
+        duration (float): The length of the video in seconds.
+        quality (VideoQuality): The quality being converted to.
+
+    Returns:
+        int: The priority.
+    """
+    return int(quality) * QUALITY_PRIORITY_STEP + min(
+        max(int(duration), 0), QUALITY_PRIORITY_STEP - 1
+    )
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    How long to wait before retrying a job that's failed this many times.
+    """
+    return min(RETRY_DELAY * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY)
+
+
+class JobQueue:
+    """
+    The jobs table. (Uses its own connection, so claiming jobs never waits on the server's database lock.)
+    """
+
+    def __init__(self, server_path: Path, lease_seconds: float = LEASE_SECONDS):
+        """
+        Args:
+            server_path (Path): The path to the server directory. (The queue lives in the server's database.)
+            lease_seconds (float): How long a worker can go without renewing a job's lease before the job is
+                given to someone else.
+        """
+        self.connection = sqlite3.connect(
+            server_path / "db.sqlite3",
+            timeout=30,  # other workers might be holding the write lock
+            isolation_level=None,  # we handle the transactions ourselves
+            check_same_thread=False,
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        self.lease_seconds = lease_seconds
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Runs a block as a single write transaction. (Takes the write lock up front, so nobody can claim the same
+        job in between us reading and updating it.)
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def enqueue(
+        self,
+        kind: str,
+        video_id: int,
+        quality: Optional[int] = None,
+        priority: int = 0,
+        max_attempts: int = MAX_ATTEMPTS,
+    ) -> int:
+        """
+        Add a job to the queue. If the same job is already queued (or running), nothing is added.
+
+        Args:
+            kind (str): What kind of job it is (KIND_VIDEO or KIND_RENDITION).
+            video_id (int): The ID of the video.
+            quality (Optional[int]): The quality to convert to. (Rendition jobs only.)
+            priority (int): Lower runs first. (See job_priority)
+            max_attempts (int): How many times to try the job before giving up on it.
+
+        Returns:
+            int: The ID of the job.
+        """
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND video_id = ? AND quality IS ? AND state IN (?, ?)",
+                (kind, video_id, quality, JOB_QUEUED, JOB_RUNNING),
+            ).fetchone()
+            if row is not None:
+                return row["id"]
+            cursor = connection.execute(
+                "INSERT INTO jobs (kind, video_id, quality, priority, max_attempts) VALUES (?, ?, ?, ?, ?)",
+                (kind, video_id, quality, priority, max_attempts),
+            )
+            job_id = cursor.lastrowid or -1
+        logger.debug(f"Queued {kind} job {job_id} for video {video_id}")
+        return job_id
+
+    def enqueue_video(self, video_id: int) -> int:
+        """
+        Queue a newly uploaded (or reprocessed) video for processing.
+        """
+        return self.enqueue(KIND_VIDEO, video_id, priority=PRIORITY_VIDEO)
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """
+        Claim the next job that's ready to run. Also puts jobs whose worker went away back in the queue.
+
+        Args:
+            worker (str): The name of the worker claiming the job.
+
+        Returns:
+            Optional[dict]: The job, or None if there's nothing to do right now.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            self._requeue_expired(connection, now)
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE state = ? AND run_after <= ? ORDER BY priority, id LIMIT 1",
+                (JOB_QUEUED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1, progress = NULL, "
+                "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (JOB_RUNNING, worker, now + self.lease_seconds, row["id"]),
+            )
+        job = row_to_dict(row)
+        job["attempts"] += 1
+        job["worker"] = worker
+        return job
+
+    def _requeue_expired(self, connection: sqlite3.Connection, now: float) -> None:
+        """
+        Puts running jobs whose lease ran out back in the queue. (Or fails them, if they're out of attempts.)
+        """
+        expired = connection.execute(
+            "SELECT id, attempts, max_attempts, worker FROM jobs WHERE state = ? AND lease_until < ?",
+            (JOB_RUNNING, now),
+        ).fetchall()
+        for row in expired:
+            logger.warning(
+                f"Job {row['id']} was abandoned by worker {row['worker']}, requeueing it"
+            )
+            self._retry_or_fail(
+                connection,
+                row["id"],
+                row["attempts"],
+                row["max_attempts"],
+                "Worker stopped responding",
+                now,
+            )
+
+    def _retry_or_fail(
+        self,
+        connection: sqlite3.Connection,
+        job_id: int,
+        attempts: int,
+        max_attempts: int,
+        error: str,
+        now: float,
+    ) -> None:
+        if attempts >= max_attempts:
+            connection.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, error = ?, "
+                "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (JOB_FAILED, error, job_id),
+            )
+            logger.error(f"Job {job_id} failed for good after {attempts} attempts")
+        else:
+            connection.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, error = ?, run_after = ?, "
+                "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (JOB_QUEUED, error, now + retry_delay(attempts), job_id),
+            )
+
+    def heartbeat(self, worker: str, job_ids: List[int]) -> None:
+        """
+        Renew the leases on a worker's running jobs.
+        """
+        if not job_ids:
+            return
+        with self.transaction() as connection:
+            connection.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = ? "
+                f"AND id IN ({', '.join('?' * len(job_ids))})",
+                (time.time() + self.lease_seconds, worker, JOB_RUNNING, *job_ids),
+            )
+
+    def report_progress(self, worker: str, job_id: int, progress: float) -> None:
+        """
+        Record how far along a running job is (0 to 1).
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ? AND worker = ? AND state = ?",
+                (progress, job_id, worker, JOB_RUNNING),
+            )
+
+    def complete(self, worker: str, job_id: int) -> None:
+        """
+        Mark a job as done. (Does nothing if the job was cancelled, or given to another worker, in the meantime.)
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, error = NULL, progress = 1, "
+                "updated_at = CURRENT_TIMESTAMP WHERE id = ? AND worker = ? AND state = ?",
+                (JOB_DONE, job_id, worker, JOB_RUNNING),
+            )
+
+    def fail(self, worker: str, job_id: int, error: str) -> None:
+        """
+        Mark a job as failed. It'll be retried (after a delay that doubles every time) until it's out of attempts.
+        """
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? AND state = ?",
+                (job_id, worker, JOB_RUNNING),
+            ).fetchone()
+            if row is None:
+                return
+            self._retry_or_fail(
+                connection,
+                job_id,
+                row["attempts"],
+                row["max_attempts"],
+                error,
+                time.time(),
+            )
+
+    def cancel_video(self, video_id: int) -> None:
+        """
+        Cancel every unfinished job of a video. (Call this when a video is deleted or reprocessed.)
+        Jobs that are already running will finish, but won't be marked as done, and won't mark their renditions as
+        ready either. (See Database.mark_rendition_ready)
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, updated_at = CURRENT_TIMESTAMP "
+                "WHERE video_id = ? AND state IN (?, ?)",
+                (JOB_CANCELLED, video_id, JOB_QUEUED, JOB_RUNNING),
+            )
+
+    def stats(self) -> dict:
+        """
+        Get the number of jobs in each state.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT state, COUNT(*) AS count FROM jobs GROUP BY state"
+            ).fetchall()
+        return {row["state"]: row["count"] for row in rows}
+
+    def running_jobs(self) -> List[dict]:
+        """
+        Get every running job, with who's running it and how far along it is.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, kind, video_id, quality, worker, attempts, progress FROM jobs WHERE state = ? ORDER BY id",
+                (JOB_RUNNING,),
+            ).fetchall()
+        return [row_to_dict(row) for row in rows]
+
+
+JobHandler = Callable[[dict, Callable[[float], None]], None]
+
+
+class JobRunner:
+    """
+    Claims jobs from a queue and runs them, a few at a time, on its own threads.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: Dict[str, JobHandler],
+        concurrency: int = 4,
+        name: Optional[str] = None,
+        poll_interval: float = 1.0,
+    ) -> None:
+        """
+        Args:
+            queue (JobQueue): The queue to take jobs from.
+            handlers (Dict[str, JobHandler]): The function that runs each kind of job. It's given the job, and a
+                function to report its progress with. (Raising fails the job.)
+            concurrency (int): How many jobs to run at once.
+            name (Optional[str]): The name of the worker, as stored on the jobs it claims. (Must be unique.)
+            poll_interval (float): How often to check for new jobs when there's nothing to do, in seconds.
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.pool = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="job"
+        )
+        self.lock = threading.Lock()
+        self.running: Dict[int, dict] = {}
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Start running jobs in the background.
+        """
+        self.thread = threading.Thread(target=self.run, name="job-runner", daemon=True)
+        self.thread.start()
+
+    def wake(self) -> None:
+        """
+        Check for new jobs right away. (Call this after queueing something.)
+        """
+        self.wakeup.set()
+
+    def stop(self) -> None:
+        """
+        Stop claiming jobs, and wait for the running ones to finish.
+        """
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.pool.shutdown(wait=True)
+
+    def run(self) -> None:
+        """
+        Claim and run jobs until stopped.
+        """
+        logger.info(f"Job runner {self.name} started ({self.concurrency} at a time)")
+        last_heartbeat = time.monotonic()
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                if time.monotonic() - last_heartbeat > self.queue.lease_seconds / 4:
+                    with self.lock:
+                        job_ids = list(self.running)
+                    self.queue.heartbeat(self.name, job_ids)
+                    last_heartbeat = time.monotonic()
+                while len(self.running) < self.concurrency:
+                    job = self.queue.claim(self.name)
+                    if job is None:
+                        break
+                    logger.info(
+                        f"Running {job['kind']} job {job['id']} for video {job['video_id']} (attempt {job['attempts']})"
+                    )
+                    with self.lock:
+                        self.running[job["id"]] = job
+                    self.pool.submit(self.run_job, job)
+            except sqlite3.Error as e:
+                logger.error(f"Job queue error: {e}")
+            self.wakeup.wait(self.poll_interval)
+        logger.info(f"Job runner {self.name} stopped")
+
+    def progress_reporter(self, job_id: int) -> Callable[[float], None]:
+        """
+        Makes a function that records a job's progress. (At most every PROGRESS_INTERVAL seconds.)
+        """
+        last_report = 0.0
+
+        def report(progress: float) -> None:
+            nonlocal last_report
+            if time.monotonic() - last_report < PROGRESS_INTERVAL:
+                return
+            last_report = time.monotonic()
+            try:
+                self.queue.report_progress(self.name, job_id, progress)
+            except sqlite3.Error as e:
+                # not worth failing the job over
+                logger.warning(f"Couldn't report progress of job {job_id}: {e}")
+
+        return report
+
+    def run_job(self, job: dict) -> None:
+        try:
+            handler = self.handlers.get(job["kind"])
+            if handler is None:
+                raise ValueError(f"Unknown job kind {job['kind']}")
+            handler(job, self.progress_reporter(job["id"]))
+        except Exception as e:
+            logger.exception(f"Job {job['id']} failed")
+            self.queue.fail(self.name, job["id"], f"{type(e).__name__}: {e}")
+        else:
+            self.queue.complete(self.name, job["id"])
+        finally:
+            with self.lock:
+                self.running.pop(job["id"], None)
+            self.wakeup.set()
+
+
+class TranscodeJobs:
+    """
+    Runs the transcoding jobs. (See process_video in ffmpeg.py for the rest of the details.)
+
+    The jobs themselves only orchestrate: every FFmpeg run is handed to the encoder, and waited on.
+    (See scheduler.py for why.)
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        db: Database,
+        server_path: Path,
+        encoder: EncodeScheduler,
+        pack: bool = False,
+        single_pass: bool = False,
+        chunk_length: Optional[float] = None,
+    ) -> None:
+        """
+        Args:
+            queue (JobQueue): The queue to add rendition jobs to.
+            db (Database): The database object to update video information.
+            server_path (Path): The path to the server directory.
+            encoder (EncodeScheduler): Runs the FFmpeg commands.
+            pack (bool): Whether to pack each quality's segments into a single file. (See pack.py)
+            single_pass (bool): Whether to convert every quality in a single FFmpeg run. (See convert_video_ladder)
+            chunk_length (Optional[float]): If set, long videos are split into chunks of this many seconds.
+        """
+        self.queue = queue
+        self.db = db
+        self.server_path = server_path
+        self.encoder = encoder
+        self.pack = pack
+        self.single_pass = single_pass
+        self.chunk_length = chunk_length
+
+    @property
+    def handlers(self) -> Dict[str, JobHandler]:
+        return {KIND_VIDEO: self.run_video, KIND_RENDITION: self.run_rendition}
+
+    def run_video(self, job: dict, progress: Callable[[float], None]) -> None:
+        video_id = job["video_id"]
+        if self.db.get_video_info(video_id) is None:
+            logger.info(f"Video {video_id} was deleted, skipping it")
+            return
+        original_video = get_original_video_path(self.server_path, str(video_id))
+        video_info = get_video_info(original_video)
+        if not video_info:
+            raise RuntimeError("Failed to get video info.")
+        if self.db.get_content_hash(video_id) is None:
+            # chunked uploads arrive out of order, so they can only be hashed once they're done. that's done here,
+            # rather than while committing, so a big upload doesn't hold up its connection
+            self.db.set_content_hash(video_id, hash_file(original_video))
+        # anything that's already done (from before a crash) doesn't need doing again
+        ready = self.db.get_ready_qualities(video_id)
+        source_id = self.db.find_duplicate_video(video_id)
+        if source_id is not None:
+            # the same file's been uploaded (and converted) before, so reuse what we can (see dedup.py)
+            ready += reuse_renditions(
+                self.db,
+                self.server_path,
+                video_id,
+                source_id,
+                ready,
+                (job["id"], job["worker"]),
+            )
+
+        if self.single_pass or (
+            self.chunk_length and video_info["duration"] > self.chunk_length * 2
+        ):
+            # these convert every quality together, so there's no point splitting them into jobs
+            process_video(
+                self.encoder,
+                self.db,
+                original_video,
+                video_id,
+                self.pack,
+                self.single_pass,
+                self.chunk_length,
+                ready,
+                self.encoder.threads_per_encode,
+                (job["id"], job["worker"]),
+            )
+            return
+
+        for config in get_quality_ladder(video_info.get("height", 0)):
+            quality = VideoQuality(int(config[1]))
+            if int(quality) not in ready:
+                self.queue.enqueue(
+                    KIND_RENDITION,
+                    video_id,
+                    int(quality),
+                    job_priority(video_info["duration"], quality),
+                )
+        thumbnail = get_thumbnail_path(self.server_path, str(video_id))
+        if not thumbnail.exists():
+            self.encoder.submit(generate_thumbnail, original_video, thumbnail).result()
+
+    def run_rendition(self, job: dict, progress: Callable[[float], None]) -> None:
+        video_id = job["video_id"]
+        if self.db.get_video_info(video_id) is None:
+            logger.info(f"Video {video_id} was deleted, skipping it")
+            return
+        self.encoder.submit(
+            convert_rendition,
+            self.db,
+            get_original_video_path(self.server_path, str(video_id)),
+            video_id,
+            VideoQuality(job["quality"]),
+            self.pack,
+            progress,
+            self.encoder.threads_per_encode,
+            (job["id"], job["worker"]),
+        ).result()
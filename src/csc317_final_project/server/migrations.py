@@ -0,0 +1,132 @@
+"""
+Applying the database migrations (in db/migrations) at startup.
+
+The migrations are written for dbmate (-- migrate:up / -- migrate:down sections, and a schema_migrations table
+listing the versions that have been applied), and this applies them the same way, so either can be used. Every
+pending migration is applied in one transaction, with the write lock held from the start, so a server and its
+workers starting at the same time can't both apply them.
+
+The migrations live in db/migrations at the top of the repository (where dbmate looks for them), and the wheel
+ships a copy of them inside the package (see pyproject.toml), so an installed server finds them too.
+"""
+
+import sqlite3
+from logging import getLogger
+from pathlib import Path
+from typing import Iterator, List
+
+logger = getLogger(__name__)
+
+PACKAGED_MIGRATIONS_DIR = Path(__file__).parents[1] / "db" / "migrations"  # installed
+CHECKOUT_MIGRATIONS_DIR = (
+    Path(__file__).parents[3] / "db" / "migrations"
+)  # running from the repository
+INITIAL_VERSION = "20250504151239"  # from before migrations were tracked by the server
+
+
+def find_migrations_dir() -> Path:
+    """
+    Get the directory the migrations are in. (The packaged copy if there is one, since a checkout's
+    directory wouldn't exist for an installed package.)
+    """
+    if PACKAGED_MIGRATIONS_DIR.is_dir():
+        return PACKAGED_MIGRATIONS_DIR
+    return CHECKOUT_MIGRATIONS_DIR
+
+
+MIGRATIONS_DIR = find_migrations_dir()
+
+
+def get_version(migration: Path) -> str:
+    """
+    Get the version of a migration. (The timestamp its name starts with.)
+    """
+    return migration.name.split("_", 1)[0]
+
+
+def get_up_statements(migration: Path) -> Iterator[str]:
+    """
+    Get the statements in the up section of a migration, one at a time.
+    """
+    up = migration.read_text().split("-- migrate:down")[0]
+    statement = ""
+    for line in up.splitlines(keepends=True):
+        statement += line
+        # (complete_statement knows a trigger's body doesn't end at the first semicolon)
+        if sqlite3.complete_statement(statement):
+            if statement.strip():
+                yield statement
+            statement = ""
+    if statement.strip() and not all(
+        line.strip().startswith("--") or not line.strip()
+        for line in statement.splitlines()
+    ):
+        raise ValueError(
+            f"Migration {migration.name} ends with an unfinished statement"
+        )
+
+
+def migrate(server_path: Path, migrations_dir: Path = MIGRATIONS_DIR) -> List[str]:
+    """
+    Apply any migrations the database doesn't have yet. (Creates the database, if it doesn't exist.)
+
+    Args:
+        server_path (Path): The path to the server directory.
+        migrations_dir (Path): Where the migrations are.
+
+    Returns:
+        List[str]: The versions that were applied.
+    """
+    migrations = sorted(migrations_dir.glob("*.sql"))
+    if not migrations:
+        raise FileNotFoundError(f"No migrations found in {migrations_dir}")
+    server_path.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(
+        server_path / "db.sqlite3",
+        timeout=30,  # someone else might be migrating right now
+        isolation_level=None,  # we handle the transaction ourselves
+    )
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            tracked = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_migrations'"
+            ).fetchone()
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR(128) PRIMARY KEY)"
+            )
+            if (
+                not tracked
+                and connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+                ).fetchone()
+            ):
+                # made by hand from the first migration, before anything kept track
+                connection.execute(
+                    "INSERT INTO schema_migrations (version) VALUES (?)",
+                    (INITIAL_VERSION,),
+                )
+            applied = {
+                row[0]
+                for row in connection.execute("SELECT version FROM schema_migrations")
+            }
+            pending = [
+                migration
+                for migration in migrations
+                if get_version(migration) not in applied
+            ]
+            for migration in pending:
+                logger.info(f"Applying migration {migration.name}")
+                for statement in get_up_statements(migration):
+                    connection.execute(statement)
+                connection.execute(
+                    "INSERT INTO schema_migrations (version) VALUES (?)",
+                    (get_version(migration),),
+                )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+    return [get_version(migration) for migration in pending]
@@ -0,0 +1,189 @@
+"""
+Packed segment storage.
+
+convert_video writes one small file per segment, which adds up fast (a 1 hour video at every quality is
+around 9600 files), and every request for one costs a few filesystem calls before any data moves.
+A pack holds every segment of one quality in a single file, with an index up front:
+
+    magic (8 bytes) | segment count (uint32) | reserved (uint32)
+    (offset, length) of each segment (2x uint64, in segment order)
+    segment data...
+
+Packs are mmapped once and then served straight out of the mapping.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from csc317_final_project.server.fs import PACK_FILE_NAME, get_pack_path
+from csc317_final_project.server.quality import VideoQuality
+
+logger = getLogger(__name__)
+
+PACK_MAGIC = b"SEGPACK1"
+PACK_HEADER = struct.Struct("<8sII")
+PACK_INDEX_ENTRY = struct.Struct("<QQ")
+
+
+def get_loose_segments(quality_dir: Path) -> List[Path]:
+    """
+    Get the loose segment files in a quality's directory, in segment order.
+    (Segments are named {video_id}_{quality}_{segment_id}.mp4.)
+    """
+    return sorted(
+        quality_dir.glob("*_*_*.mp4"),
+        key=lambda segment: int(segment.stem.rsplit("_", 1)[1]),
+    )
+
+
+def count_segments(quality_dir: Path) -> int:
+    """
+    Count the segments of a quality, whether they're packed or not.
+    """
+    pack_path = quality_dir / PACK_FILE_NAME
+    if pack_path.is_file():
+        with pack_path.open("rb") as pack:
+            _, count, _ = PACK_HEADER.unpack(pack.read(PACK_HEADER.size))
+        return count
+    return len(get_loose_segments(quality_dir))
+
+
+def pack_segments(quality_dir: Path, remove_loose: bool = True) -> Optional[Path]:
+    """
+    Pack every loose segment in a quality's directory into a single pack file.
+
+    Args:
+        quality_dir (Path): The directory holding the segments (e.g. videos/1/720p).
+        remove_loose (bool): Whether to delete the loose segments afterwards.
+
+    Returns:
+        Optional[Path]: The path to the pack, or None if there was nothing to pack.
+    """
+    segments = get_loose_segments(quality_dir)
+    if not segments:
+        return None
+    pack_path = quality_dir / PACK_FILE_NAME
+    temp_path = pack_path.with_suffix(".tmp")
+
+    sizes = [segment.stat().st_size for segment in segments]
+    offset = PACK_HEADER.size + PACK_INDEX_ENTRY.size * len(segments)
+    with temp_path.open("wb") as pack:
+        pack.write(PACK_HEADER.pack(PACK_MAGIC, len(segments), 0))
+        for size in sizes:
+            pack.write(PACK_INDEX_ENTRY.pack(offset, size))
+            offset += size
+        for segment in segments:
+            with segment.open("rb") as file:
+                while True:
+                    data = file.read(1024 * 1024)
+                    if not data:
+                        break
+                    pack.write(data)
+        pack.flush()
+        os.fsync(pack.fileno())
+    # swap it in all at once, so nobody ever sees half a pack
+    temp_path.replace(pack_path)
+
+    if remove_loose:
+        for segment in segments:
+            segment.unlink()
+    logger.info(f"Packed {len(segments)} segments into {pack_path}")
+    return pack_path
+
+
+class SegmentPack:
+    """
+    An open (mmapped) pack.
+    """
+
+    def __init__(self, path: Path) -> None:
+        with path.open("rb") as file:
+            # the mapping stays valid after the file's closed (or even deleted)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, _ = PACK_HEADER.unpack_from(self.map)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{path} is not a segment pack")
+        self.path = path
+
+    def __len__(self) -> int:
+        return self.count
+
+    def locate(self, segment_id: int) -> Tuple[int, int]:
+        """
+        Get the (offset, length) of a segment within the pack.
+        """
+        if not 0 <= segment_id < self.count:
+            raise FileNotFoundError(f"Segment {segment_id} not in pack {self.path}")
+        return PACK_INDEX_ENTRY.unpack_from(
+            self.map, PACK_HEADER.size + PACK_INDEX_ENTRY.size * segment_id
+        )
+
+    def view(self, segment_id: int) -> memoryview:
+        """
+        Get a segment's contents. (A view into the mapping, nothing is copied.)
+        """
+        offset, length = self.locate(segment_id)
+        return memoryview(self.map)[offset : offset + length]
+
+
+class PackStore:
+    """
+    Keeps packs open, so serving a packed segment doesn't touch the filesystem at all.
+    Also remembers which qualities aren't packed, so serving a loose segment doesn't go looking for a pack every time.
+    """
+
+    def __init__(self, server_path: Path) -> None:
+        self.server_path = server_path
+        self.lock = threading.Lock()
+        self.packs: Dict[Tuple[str, int], SegmentPack] = {}
+        self.unpacked: Set[Tuple[str, int]] = set()
+
+    def get(
+        self, video_id: str, quality: VideoQuality, recheck: bool = False
+    ) -> Optional[SegmentPack]:
+        """
+        Get the pack for a video's quality, or None if that quality isn't packed.
+
+        Args:
+            video_id (str): The video's ID.
+            quality (VideoQuality): The quality.
+            recheck (bool): Look for the pack even if it wasn't there last time. (A quality can get packed after
+                it's been served loose, say by misc/pack_videos.py, which removes the loose segments.)
+        """
+        key = (str(video_id), int(quality))
+        with self.lock:
+            pack = self.packs.get(key)
+            if pack is not None:
+                return pack
+            if key in self.unpacked and not recheck:
+                return None
+
+        pack_path = get_pack_path(self.server_path, str(video_id), quality)
+        try:
+            pack = SegmentPack(pack_path)
+        except FileNotFoundError:
+            with self.lock:
+                self.unpacked.add(key)
+            return None
+        with self.lock:
+            self.unpacked.discard(key)
+            # if someone else opened it in the meantime, use theirs
+            return self.packs.setdefault(key, pack)
+
+    def invalidate_video(self, video_id: str) -> None:
+        """
+        Forget every open pack of a video, and that its other qualities weren't packed.
+        (Call this whenever the video's segments change or are deleted.)
+        """
+        video_id = str(video_id)
+        with self.lock:
+            for key in [key for key in self.packs if key[0] == video_id]:
+                # not closed explicitly - a segment might still be being sent out of it.
+                # the mapping goes away once the last view of it does.
+                del self.packs[key]
+            self.unpacked = {key for key in self.unpacked if key[0] != video_id}
@@ -0,0 +1,150 @@
+"""
+Scheduling for FFmpeg runs.
+
+Transcoding has two kinds of work: orchestration (a job probing a video, waiting for its qualities, stitching chunks
+back together), which mostly waits, and encoding, which keeps cores busy. If both share one pool, a job waiting on
+its encodes can hold the very slot those encodes need - with enough uploads at once, nothing moves. So jobs run on
+their own threads (see jobs.py), and only ever hand encodes to an EncodeScheduler, which never waits on anything.
+
+The scheduler splits the cores it's given into slots, and every FFmpeg run is told (with -threads) to stay inside
+its slot's share, so a burst of uploads can't oversubscribe the machine. A run that encodes several outputs at once
+(see convert_video_ladder) takes a slot per output, with submit_wide. Slots are handed out in order, so a wide run
+isn't starved by narrow ones slipping in ahead of it.
+
+Live encodes (see ingest.py) can't wait for a slot, since the upload feeding them won't wait either. They take one
+with try_acquire if there's one free, and skip encoding live if there isn't.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from logging import getLogger
+from typing import Optional
+
+logger = getLogger(__name__)
+
+
+class EncodeScheduler(Executor):
+    """
+    An executor for encodes, with a fixed number of slots, each given a share of the cores.
+    Keeps track of how deep its queue is, and how long encodes wait for a slot.
+    """
+
+    def __init__(self, cpus: Optional[int] = None, threads_per_encode: int = 2):
+        """
+        Args:
+            cpus (Optional[int]): How many cores encoding may use. (Defaults to all of them.)
+            threads_per_encode (int): How many threads each FFmpeg run gets. (Passed to FFmpeg as -threads.)
+        """
+        self.cpus = cpus or os.cpu_count() or 1
+        self.threads_per_encode = max(1, min(threads_per_encode, self.cpus))
+        self.slots = max(1, self.cpus // self.threads_per_encode)
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.slots, thread_name_prefix="encode"
+        )
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        self.free_slots = self.slots
+        self.next_ticket = 0  # (slots go to whoever asked first, see acquire)
+        self.serving = 0
+        self.queued = 0
+        self.running = 0
+        self.started = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.submit_wide(1, fn, *args, **kwargs)
+
+    def submit_wide(self, width: int, fn, *args, **kwargs) -> Future:
+        """
+        Like submit, but the run takes width slots. (For FFmpeg runs that encode several outputs, each with
+        threads_per_encode threads.) Anything wider than the whole scheduler just takes every slot.
+        """
+        with self.lock:
+            self.queued += 1
+        return self.pool.submit(
+            self._run,
+            time.monotonic(),
+            min(max(1, width), self.slots),
+            fn,
+            args,
+            kwargs,
+        )
+
+    def acquire(self, width: int = 1) -> None:
+        """
+        Wait for width slots to be free, and take them. Whoever asked first goes first, even if a later (narrower)
+        request could fit already.
+        """
+        with self.slot_freed:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while self.serving != ticket or self.free_slots < width:
+                self.slot_freed.wait()
+            self.serving += 1
+            self.free_slots -= width
+            self.slot_freed.notify_all()
+
+    def try_acquire(self, width: int = 1) -> bool:
+        """
+        Take width slots if they're free right now (and nobody's waiting for them), without waiting.
+
+        Returns:
+            bool: Whether the slots were taken. (If they were, give them back with release.)
+        """
+        with self.slot_freed:
+            if self.serving != self.next_ticket or self.free_slots < width:
+                return False
+            self.free_slots -= width
+            return True
+
+    def release(self, width: int = 1) -> None:
+        with self.slot_freed:
+            self.free_slots += width
+            self.slot_freed.notify_all()
+
+    def _run(self, submitted: float, width: int, fn, args, kwargs):
+        # (there's a thread per slot, and every run holds at least one slot, so this never waits on a run
+        # that hasn't started)
+        self.acquire(width)
+        waited = time.monotonic() - submitted
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.started += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.last_wait = waited
+        if waited > 1:
+            logger.debug(f"{fn.__name__} waited {waited:.1f}s for an encode slot")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+            self.release(width)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.pool.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        """
+        Get the scheduler's counters. (Wait times are in seconds.)
+        """
+        with self.lock:
+            return {
+                "slots": self.slots,
+                "threads_per_encode": self.threads_per_encode,
+                "queue_depth": self.queued,
+                "running": self.running,
+                "free_slots": self.free_slots,
+                "completed": self.completed,
+                "mean_wait": self.total_wait / self.started if self.started else 0.0,
+                "max_wait": self.max_wait,
+                "last_wait": self.last_wait,
+            }
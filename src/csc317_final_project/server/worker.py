@@ -0,0 +1,109 @@
+"""
+A standalone transcoding worker.
+
+Runs transcoding jobs from the server's job queue (see jobs.py) in its own process, so FFmpeg (and all the
+bookkeeping around it) doesn't compete with the server for the GIL while it's handling clients. Run the server
+with --external-workers, and start as many of these as the machine can take:
+
+$ uv run final_worker --data-dir server_data --encode-cpus 8
+"""
+
+import os
+import signal
+from logging import getLogger
+from pathlib import Path
+
+from csc317_final_project.server.db import Database
+from csc317_final_project.server.jobs import JobQueue, JobRunner, TranscodeJobs
+from csc317_final_project.server.migrations import migrate
+from csc317_final_project.server.scheduler import EncodeScheduler
+
+logger = getLogger(__name__)
+
+
+def main():
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(description="Run a transcoding worker.")
+    parser.add_argument("--data-dir", type=Path, default=Path("server_data"))
+    # (named like the server's options, the old names still work)
+    parser.add_argument(
+        "--encode-cpus",
+        "--cpus",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="how many cores this worker may use (defaults to all of them)",
+    )
+    parser.add_argument(
+        "--threads-per-encode",
+        "--cpus-per-job",
+        type=int,
+        default=2,
+        help="how many threads each FFmpeg run gets (the cores are split into slots of this size)",
+    )
+    parser.add_argument(
+        "--name",
+        default=None,
+        help="the name to claim jobs under (defaults to hostname:pid, must be unique)",
+    )
+    parser.add_argument(
+        "--pack-segments",
+        action="store_true",
+        help="store processed videos as one pack file per quality",
+    )
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="decode each upload once and encode every quality but the lowest from that, instead of a run per quality (the higher qualities then all show up together, once the slowest is done)",
+    )
+    parser.add_argument(
+        "--chunk-length",
+        type=float,
+        default=None,
+        help="split long uploads into chunks of this many seconds (rounded up to a whole number of segments) and convert them in parallel",
+    )
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s (%(threadName)s) - %(levelname)s - %(message)s",
+        level=args.log_level.upper(),
+    )
+
+    migrate(args.data_dir)  # (in case we're started before the server)
+    db = Database(args.data_dir)
+    queue = JobQueue(args.data_dir)
+    encoder = EncodeScheduler(args.encode_cpus, args.threads_per_encode)
+    runner = JobRunner(
+        queue,
+        TranscodeJobs(
+            queue,
+            db,
+            args.data_dir,
+            encoder,
+            args.pack_segments,
+            args.single_pass,
+            args.chunk_length,
+        ).handlers,
+        encoder.slots,  # one job per slot, so we never claim more than we can start on
+        args.name,
+    )
+
+    def stop(signum, frame):
+        logger.info("Stopping after the running jobs finish...")
+        runner.stopping.set()
+        runner.wake()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.stop()
+        encoder.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    main()